@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import signal
+from functools import partial
+
+from telebot import asyncio_helper, util
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+from telebot.types import Message
+
+from config import *
+from database import create_async_database
+from dispatcher import ShardedTeleBot
+from bot import (balance_pager, bot, conversations, create_app, debts_pager, display_name,
+                 format_balances, format_debts, format_transactions, loan_lease, member_cache, remember_sender,
+                 transactions_pager, user_keyboard)
+from ledger import BANK_ID
+from metrics import instrument_async_api, instrument_bot, start_server, timed_handler
+from pager import parse_cursor, split_text
+from repository import AccountsRepo
+from router import CallbackRouter
+from tracing import install_profile_signal
+
+logger = logging.getLogger(__name__)
+
+if TELEGRAM_API_URL:
+    asyncio_helper.API_URL = TELEGRAM_API_URL
+
+# Асинхронный режим (BOT_RUNTIME=async). Списки — /balance, /debts, /transactions, их
+# страницы, /change_balance и /waiting_list — обрабатываются здесь: запрос к базе идет
+# через асинхронный движок, а имена участников запрашиваются у API параллельно.
+# Остальные апдейты передаются синхронным обработчикам bot.py, которые выполняются
+# в пуле потоков TeleBot, так что цикл событий не ждет их.
+async_bot = AsyncTeleBot(BOT_TOKEN)
+async_engines, async_session = create_async_database()
+async_callbacks = CallbackRouter(wrap=partial(timed_handler, 'callback'))
+
+api_limit = asyncio.Semaphore(ASYNC_API_CONCURRENCY)
+# Запросы имен, которые уже выполняются: параллельные списки ждут один вызов API
+inflight_members = {}
+
+
+async def fetch_member(chat_id, user_id):
+    async with api_limit:
+        try:
+            user = (await async_bot.get_chat_member(chat_id=chat_id, user_id=user_id)).user
+        except ApiTelegramException:
+            member_cache.put_missing(chat_id, user_id)
+            return None
+    member_cache.put(chat_id, user)
+    return user
+
+
+async def get_member(chat_id, user_id):
+    found, user = member_cache.peek(chat_id, user_id)
+    if found:
+        return user
+    key = (chat_id, user_id)
+    task = inflight_members.get(key)
+    if task is None:
+        task = inflight_members[key] = asyncio.ensure_future(fetch_member(chat_id, user_id))
+        task.add_done_callback(lambda _: inflight_members.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def get_user_names(chat_id, user_ids, full=False):
+    user_ids = list(dict.fromkeys(user_ids))
+    users = await asyncio.gather(*[get_member(chat_id, user_id) for user_id in user_ids])
+    return {user_id: display_name(user, user_id, full) for user_id, user in zip(user_ids, users)}
+
+
+async def send_page(message, page_text, markup, edit=False):
+    chunks = split_text(page_text)
+    for i, chunk in enumerate(chunks):
+        chunk_markup = markup if i == len(chunks) - 1 else None
+        if i > 0:
+            await async_bot.send_message(chat_id=message.chat.id, text=chunk, reply_markup=chunk_markup)
+        elif edit:
+            await async_bot.edit_message_text(chunk, chat_id=message.chat.id, message_id=message.message_id,
+                                              reply_markup=chunk_markup)
+        else:
+            await async_bot.reply_to(message, chunk, reply_markup=chunk_markup)
+
+
+async def has_conversation(message):
+    return await asyncio.to_thread(conversations.get, message.chat.id) is not None
+
+
+# Ответ на шаг диалога обрабатывает bot.py, как и в многопоточном режиме
+@async_bot.message_handler(func=has_conversation, content_types=util.content_type_media)
+async def forward_conversation(message):
+    await forward_message(message)
+
+
+async def select_users(query):
+    async with async_session() as session:
+        return (await session.execute(query)).scalars().all()
+
+
+@async_bot.message_handler(commands=['change_balance'])
+async def change_balance(message):
+    remember_sender(async_bot, message)
+    names = await get_user_names(message.chat.id, await select_users(AccountsRepo.ALL_IDS), full=True)
+    await async_bot.reply_to(message, "Выберите пользователя для изменения баланса:",
+                             reply_markup=user_keyboard('select', names))
+
+
+@async_bot.message_handler(commands=['waiting_list'])
+async def show_waiting_list(message):
+    remember_sender(async_bot, message)
+    names = await get_user_names(message.chat.id, await select_users(AccountsRepo.CLIENT_IDS))
+    await async_bot.reply_to(message, "Выберите пользователя, чтобы увидеть его список дел:",
+                             reply_markup=user_keyboard('waiting', names))
+
+
+async def balance_page(chat_id, direction='first', cursor=None):
+    async with async_session() as session:
+        accounts, markup = await balance_pager.fetch_async(session, direction, cursor)
+    names = await get_user_names(chat_id, [account.user_id for account in accounts if account.user_id != BANK_ID])
+    return format_balances(accounts, names), markup
+
+
+async def debts_page(chat_id, direction='first', cursor=None):
+    async with async_session() as session:
+        loans, markup = await debts_pager.fetch_async(session, direction, cursor)
+    names = await get_user_names(chat_id, [loan.user_id for loan in loans])
+    return format_debts(loans, names), markup
+
+
+async def transactions_page(chat_id, direction='first', cursor=None):
+    async with async_session() as session:
+        transactions, markup = await transactions_pager.fetch_async(session, direction, cursor)
+    names = await get_user_names(chat_id, [transaction.user_id for transaction in transactions], full=True)
+    return format_transactions(transactions, names), markup
+
+
+@async_bot.message_handler(commands=['balance'])
+async def show_balance(message):
+    remember_sender(async_bot, message)
+    await send_page(message, *await balance_page(message.chat.id))
+
+
+@async_bot.message_handler(commands=['debts'])
+async def show_debts(message):
+    remember_sender(async_bot, message)
+    await send_page(message, *await debts_page(message.chat.id))
+
+
+@async_bot.message_handler(commands=['transactions'])
+async def show_transactions(message):
+    remember_sender(async_bot, message)
+    await send_page(message, *await transactions_page(message.chat.id))
+
+
+@async_callbacks.route('balpage', str, parse_cursor)
+async def page_balance(call, direction, cursor):
+    await send_page(call.message, *await balance_page(call.message.chat.id, direction, cursor), edit=True)
+
+
+@async_callbacks.route('debtpage', str, parse_cursor)
+async def page_debts(call, direction, cursor):
+    await send_page(call.message, *await debts_page(call.message.chat.id, direction, cursor), edit=True)
+
+
+@async_callbacks.route('txpage', str, parse_cursor)
+async def page_transactions(call, direction, cursor):
+    await send_page(call.message, *await transactions_page(call.message.chat.id, direction, cursor), edit=True)
+
+
+# Передает сообщение или callback-запрос синхронным обработчикам bot.py.
+# С диспетчером — в очередь его чата (пользователя), чтобы сохранить порядок.
+def forward(event, process):
+    if not isinstance(bot, ShardedTeleBot):
+        process([event])
+        return
+    chat = event.chat if isinstance(event, Message) else getattr(event.message, 'chat', None)
+    key = event.from_user.id if DISPATCH_KEY == 'user' or chat is None else chat.id
+    bot.dispatcher.submit(key, process, [event])
+
+
+# Все остальные сообщения и callback-запросы уходят в синхронные обработчики bot.py
+@async_bot.message_handler(func=lambda message: True, content_types=util.content_type_media)
+async def forward_message(message):
+    remember_sender(async_bot, message)
+    await asyncio.to_thread(forward, message, bot.process_new_messages)
+
+
+@async_bot.callback_query_handler(func=lambda call: True)
+async def route_callback(call):
+    remember_sender(async_bot, call)
+    resolved = async_callbacks.resolve(call.data)
+    if resolved is None:
+        await asyncio.to_thread(forward, call, bot.process_new_callback_query)
+        return
+    handler, args = resolved
+    await handler(call, *args)
+
+
+instrument_bot(async_bot)
+
+
+async def run():
+    polling = asyncio.ensure_future(async_bot.infinity_polling())
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, polling.cancel)
+    try:
+        await polling
+    except asyncio.CancelledError:
+        logger.info("Async polling stopped")
+    finally:
+        for async_engine in async_engines:
+            await async_engine.dispose()
+
+
+def main():
+    create_app()
+    instrument_async_api()
+    start_server(METRICS_HOST, METRICS_PORT)
+    install_profile_signal(PROFILE_UPDATES)
+    loan_lease.start()
+    try:
+        asyncio.run(run())
+    finally:
+        bot.stop_bot()
+        loan_lease.stop()
+
+
+if __name__ == '__main__':
+    main()
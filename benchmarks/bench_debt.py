@@ -0,0 +1,37 @@
+# Микро-бенчмарк расчета долгов: стоимость одного кредита при поштучном и пакетном расчете.
+# Запуск: python benchmarks/bench_debt.py
+import os
+import random
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from debt import DAY, debt_schedule, debt_schedule_batch
+
+
+def make_loans(count):
+    now = time.time()
+    amounts = [random.choice([4, 8, 12, 16, 20]) for _ in range(count)]
+    starts = [now - random.uniform(0, 30 * DAY) for _ in range(count)]
+    return amounts, starts, now
+
+
+def per_loan_ns(func, count, repeat=5):
+    number = max(1, 100000 // count)
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return best / number / count * 1e9
+
+
+def main():
+    print(f"{'loans':>8} {'scalar ns/loan':>16} {'batch ns/loan':>16}")
+    for count in (1, 10, 100, 1000, 10000, 100000):
+        amounts, starts, now = make_loans(count)
+        scalar = per_loan_ns(lambda: [debt_schedule(a, s, now) for a, s in zip(amounts, starts)], count)
+        batch = per_loan_ns(lambda: debt_schedule_batch(amounts, starts, now), count)
+        print(f"{count:>8} {scalar:>16.1f} {batch:>16.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Порядок и пропускная способность обработки апдейтов: общий пул потоков (как в TeleBot)
+# против ShardedDispatcher. Обработчик спит случайное время, имитируя запросы к API и базе.
+# Запуск: python benchmarks/bench_dispatcher.py
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dispatcher import ShardedDispatcher
+
+CHATS = 20
+UPDATES_PER_CHAT = 20
+WORKERS = 8
+
+
+# Считает апдейты чата, начатые раньше, чем закончился предыдущий апдейт того же чата
+def make_handler():
+    running = {}
+    overlaps = [0]
+    lock = threading.Lock()
+
+    def handle(chat_id, sequence):
+        with lock:
+            if running.get(chat_id, 0) or running.get(('next', chat_id), 0) != sequence:
+                overlaps[0] += 1
+            running[chat_id] = running.get(chat_id, 0) + 1
+        time.sleep(random.uniform(0.0005, 0.003))
+        with lock:
+            running[chat_id] -= 1
+            running[('next', chat_id)] = sequence + 1
+    return handle, overlaps
+
+
+# Чаты пишут вперемешку в случайном порядке, внутри чата номера идут подряд
+def updates():
+    rng = random.Random(1)
+    chats = [chat_id for chat_id in range(CHATS) for _ in range(UPDATES_PER_CHAT)]
+    rng.shuffle(chats)
+    sequences = {}
+    stream = []
+    for chat_id in chats:
+        sequences[chat_id] = sequences.get(chat_id, -1) + 1
+        stream.append((chat_id, sequences[chat_id]))
+    return stream
+
+
+def run_pool():
+    handle, overlaps = make_handler()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(WORKERS) as pool:
+        for chat_id, sequence in updates():
+            pool.submit(handle, chat_id, sequence)
+    return time.perf_counter() - started, overlaps[0]
+
+
+def run_sharded():
+    handle, overlaps = make_handler()
+    dispatcher = ShardedDispatcher(WORKERS, queue_size=100)
+    started = time.perf_counter()
+    for chat_id, sequence in updates():
+        dispatcher.submit(chat_id, handle, chat_id, sequence)
+    depth = max(dispatcher.stats()['queue_depth'])
+    dispatcher.stop()
+    elapsed = time.perf_counter() - started
+    worst_lag = max(worst for _, worst in dispatcher.stats()['lag'].values())
+    return elapsed, overlaps[0], depth, worst_lag
+
+
+def main():
+    total = CHATS * UPDATES_PER_CHAT
+    elapsed, overlaps = run_pool()
+    print(f"thread pool: {total / elapsed:8.0f} updates/s, started before the previous update of the chat finished: {overlaps}")
+    elapsed, overlaps, depth, worst_lag = run_sharded()
+    print(f"sharded:     {total / elapsed:8.0f} updates/s, started before the previous update of the chat finished: {overlaps}")
+    print(f"             max queue depth {depth}, worst per-chat lag {worst_lag * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# Вызовы Bot API через Outbox: нажатие кнопки (delete + send против одной правки),
+# серия правок одного сообщения (склеивание) и ответ 429 с retry_after.
+# Запуск: python benchmarks/bench_outbox.py
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telebot.apihelper import ApiTelegramException
+
+from outbox import Outbox
+
+
+# Бот, который только считает вызовы; каждый вызов занимает latency секунд
+class FakeBot:
+    def __init__(self, latency=0.02, rate_limited=0):
+        self.latency = latency
+        self.rate_limited = rate_limited
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _request(self, method):
+        with self._lock:
+            self.calls[method] += 1
+            limited = self.rate_limited > 0
+            self.rate_limited -= limited
+        time.sleep(self.latency)
+        if limited:
+            raise ApiTelegramException(method, None, {'ok': False, 'error_code': 429,
+                                                      'description': "Too Many Requests: retry after 1",
+                                                      'parameters': {'retry_after': 1}})
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._request('sendMessage')
+
+    def delete_message(self, chat_id, message_id):
+        self._request('deleteMessage')
+
+    def edit_message_text(self, text, chat_id, message_id, reply_markup=None):
+        self._request('editMessageText')
+
+
+def message(chat_id=100, message_id=1):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=message_id, content_type='text')
+
+
+def main():
+    clicks = 50
+    bot = FakeBot(latency=0)
+    outbox = Outbox(bot, global_rate=1e6, chat_rate=1e6, chat_burst=1e6)
+    for i in range(clicks):
+        bot.delete_message(100, i)
+        bot.send_message(100, "text")
+    before = sum(bot.calls.values())
+    bot.calls.clear()
+    for i in range(clicks):
+        outbox.replace(message(message_id=i), "text")
+    print(f"{clicks} clicks: delete + send {before} calls, replace {sum(bot.calls.values())} calls")
+
+    bot = FakeBot(latency=0.05)
+    outbox = Outbox(bot)
+    with ThreadPoolExecutor(8) as pool:
+        for page in range(40):
+            pool.submit(outbox.edit_message_text, f"page {page}", 100, 1)
+    print(f"40 edits of one message in a burst: {bot.calls['editMessageText']} API calls")
+
+    bot = FakeBot(latency=0, rate_limited=2)
+    outbox = Outbox(bot)
+    started = time.perf_counter()
+    outbox.send_message(100, "text")
+    print(f"429 twice with retry_after=1: {bot.calls['sendMessage']} attempts, "
+          f"delivered after {time.perf_counter() - started:.1f}s")
+
+    bot = FakeBot(latency=0)
+    outbox = Outbox(bot, chat_rate=1, chat_burst=3)
+    started = time.perf_counter()
+    for _ in range(6):
+        outbox.send_message(100, "text")
+    print(f"6 sends to one chat at 1/s with burst 3: {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
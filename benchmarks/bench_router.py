@@ -0,0 +1,73 @@
+# Стоимость выбора обработчика callback-запроса: прежний перебор предикатов
+# startswith в порядке регистрации против CallbackRouter.
+# Запуск: python benchmarks/bench_router.py
+import os
+import random
+import sys
+import timeit
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from router import CallbackRouter
+
+# Маршруты бота в порядке регистрации: (действие, типы аргументов, пример callback_data)
+ROUTES = [
+    ('select', (int,), "select_123456789"),
+    ('confirm_balance', (int, float, int), "confirm_balance_123456789_15.0_987654321"),
+    ('cancel', (), "cancel"),
+    ('repay', (int,), "repay_42"),
+    ('loan', (int,), "loan_12"),
+    ('balpage', (str, str), "balpage_next_123456789"),
+    ('buy', (int,), "buy_7"),
+    ('sell', (int,), "sell_8"),
+    ('confirm', (int, int, float, str, str), "confirm_8_123456789_10.0_Уборка_sell"),
+    ('debtpage', (str, str), "debtpage_prev_15"),
+    ('send', (str,), "send_bank"),
+    ('add', (str,), "add_buy"),
+    ('remove', (int,), "remove_9"),
+    ('waiting', (int,), "waiting_123456789"),
+    ('task', (int, int), "task_31_123456789"),
+    ('txpage', (str, str), "txpage_next_1792310028127590_10"),
+]
+
+
+def handler(call, *args):
+    return args
+
+
+# Так выбирал обработчик TeleBot: первый предикат, вернувший True
+def predicate_scan(predicates, call):
+    for predicate, func in predicates:
+        if predicate(call):
+            return func(call, *call.data.split('_')[1:])
+
+
+def main():
+    predicates = []
+    router = CallbackRouter()
+    for action, converters, _ in ROUTES:
+        if converters:
+            predicates.append((lambda call, prefix=action + '_': call.data.startswith(prefix), handler))
+        else:
+            predicates.append((lambda call, data=action: call.data == data, handler))
+        router.route(action, *converters)(handler)
+
+    calls = [SimpleNamespace(data=random.choice(ROUTES)[2]) for _ in range(10000)]
+    number = 20
+    scan = min(timeit.repeat(lambda: [predicate_scan(predicates, call) for call in calls], number=number, repeat=5))
+    routed = min(timeit.repeat(lambda: [router.dispatch(call) for call in calls], number=number, repeat=5))
+    updates = len(calls) * number
+    print(f"predicate scan: {scan / updates * 1e9:8.1f} ns/update")
+    print(f"router:         {routed / updates * 1e9:8.1f} ns/update")
+
+    print("\nworst case (last registered route):")
+    last = [SimpleNamespace(data=ROUTES[-1][2])] * 10000
+    scan = min(timeit.repeat(lambda: [predicate_scan(predicates, call) for call in last], number=number, repeat=5))
+    routed = min(timeit.repeat(lambda: [router.dispatch(call) for call in last], number=number, repeat=5))
+    print(f"predicate scan: {scan / updates * 1e9:8.1f} ns/update")
+    print(f"router:         {routed / updates * 1e9:8.1f} ns/update")
+
+
+if __name__ == '__main__':
+    main()
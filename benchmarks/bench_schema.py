@@ -0,0 +1,84 @@
+# Планы основных запросов до и после миграций на базе со 100k строк в каждой таблице.
+# Работает в отдельной схеме bench_migrations, которая пересоздается при каждом запуске.
+# Запуск: DATABASE_URL=postgresql://... python benchmarks/bench_schema.py [rows]
+import os
+import sys
+
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import DATABASE_URL
+from db_url import sync_url
+from migrations import MIGRATIONS, migrate
+
+SCHEMA = 'bench_migrations'
+
+QUERIES = {
+    'active loan of user': "SELECT * FROM loans WHERE user_id = 4242 AND status = 'active'",
+    'tasks of user': "SELECT service_id, service_name FROM completed_services"
+                     " WHERE user_id = 4242 AND status = 'active'",
+    'services by type': "SELECT service_id, service_name, price FROM services WHERE type = 'buy'",
+    'closed services page': "SELECT user_id, service_name, type, end_date FROM completed_services"
+                            " WHERE status = 'closed' ORDER BY end_date, service_id LIMIT 20",
+}
+
+
+def seed(connection, rows):
+    connection.execute(text("""
+        INSERT INTO accounts (user_id, balance)
+        SELECT g, 100 FROM generate_series(0, :rows) g
+    """), {'rows': rows})
+    connection.execute(text("""
+        INSERT INTO services (service_name, price, type)
+        SELECT 'Услуга ' || g, g % 50, CASE WHEN g % 100 = 0 THEN 'buy' ELSE 'sell' END
+        FROM generate_series(1, :rows) g
+    """), {'rows': rows})
+    connection.execute(text("""
+        INSERT INTO completed_services (user_id, service_name, price, type, status, end_date)
+        SELECT g % 10000, 'Услуга ' || g, g % 50, 'buy',
+               CASE WHEN g % 10 = 0 THEN 'active' ELSE 'closed' END,
+               CASE WHEN g % 10 = 0 THEN ''
+                    ELSE TO_CHAR(now() - g * interval '1 minute', 'YYYY-MM-DD HH24:MI') END
+        FROM generate_series(1, :rows) g
+    """), {'rows': rows})
+    connection.execute(text("""
+        INSERT INTO loans (user_id, amount, start_date, end_date, interest_rate, status)
+        SELECT g % 10000, 4 * (1 + g % 5), TO_CHAR(now() - g * interval '1 hour', 'YYYY-MM-DD'), '', 0.25,
+               CASE WHEN g % 100 = 0 THEN 'active' ELSE 'closed' END
+        FROM generate_series(1, :rows) g
+    """), {'rows': rows})
+
+
+def explain(engine, title):
+    print(f"===== {title} =====")
+    with engine.connect() as connection:
+        connection.execute(text("ANALYZE"))
+        for name, query in QUERIES.items():
+            print(f"--- {name}")
+            for line, in connection.execute(text("EXPLAIN ANALYZE " + query)):
+                print(line)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    admin = create_engine(sync_url(DATABASE_URL))
+    with admin.begin() as connection:
+        connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        connection.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+    engine = create_engine(sync_url(DATABASE_URL), connect_args={'options': f'-csearch_path={SCHEMA}'})
+
+    migrate(engine, target=1)
+    with engine.begin() as connection:
+        seed(connection, rows)
+    explain(engine, f"before (version 1, {rows} rows)")
+
+    migrate(engine)
+    explain(engine, f"after (version {MIGRATIONS[-1][0]})")
+
+    with admin.begin() as connection:
+        connection.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# Время холодного старта в отдельном процессе: импорт bot.py, create_app() (логирование
+# и проверка схемы базы) и обработка первого апдейта (/help) через заглушку Bot API.
+# Каждый запуск — новый интерпретатор; выводятся медианы фаз и полное время до первого апдейта.
+# Запуск: DATABASE_URL=postgresql://... python benchmarks/bench_startup.py --runs 5
+import time
+
+STARTED = time.perf_counter()
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+sys.path.insert(0, BENCHMARKS)
+
+
+# Запуск внутри дочернего процесса: печатает длительность фаз в секундах
+def child():
+    phases = {}
+    import bot
+    phases['import'] = time.perf_counter() - STARTED
+    bot.create_app()
+    phases['create_app'] = time.perf_counter() - STARTED - phases['import']
+
+    import telebot
+    from telebot.types import Update
+    from fake_telegram import make_update
+
+    started = time.perf_counter()
+    bot.bot.threaded = False
+    telebot.TeleBot.process_new_updates(bot.bot, [Update.de_json(make_update(1, 100, 1, '/help'))])
+    phases['first_update'] = time.perf_counter() - started
+    print(json.dumps(phases))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    from fake_telegram import FakeBotApi
+
+    api = FakeBotApi(port=args.api_port, latency=0)
+    api.start()
+    env = dict(os.environ, TELEGRAM_API_URL=f'http://127.0.0.1:{args.api_port}/bot{{0}}/{{1}}', METRICS_PORT='0',
+               LOG_LEVEL='WARNING')
+    env.setdefault('BOT_TOKEN', '1:startup')
+    runs = []
+    try:
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'], env=env, check=True,
+                                    capture_output=True, text=True).stdout
+            total = time.perf_counter() - started
+            runs.append(dict(json.loads(output.splitlines()[-1]), process=total))
+    finally:
+        api.stop()
+
+    for phase in ('import', 'create_app', 'first_update', 'process'):
+        print(f"{phase:>12}: {statistics.median(run[phase] for run in runs) * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# Накладные расходы на подготовку запросов в обработчиках: text() с разбором SQL
+# при каждом вызове против запросов repository.py, разобранных один раз при импорте.
+# Апдейт здесь — запросы чтения, которые выполняют /loan, /waiting_list, выбор дел
+# пользователя и покупка услуги. Сначала меряется только построение запросов, затем
+# выполнение через сессию, а также чтение балансов нескольких счетов по одному
+# и одним запросом get_balances. Работает в отдельной схеме bench_statements
+# (или в пересоздаваемом файле SQLite).
+# Запуск: DATABASE_URL=postgresql://... python benchmarks/bench_statements.py [updates]
+import os
+import sys
+import timeit
+
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_url import sync_url
+
+SCHEMA = 'bench_statements'
+USERS = 1000
+
+
+def prepare_database():
+    url = sync_url(os.environ['DATABASE_URL'])
+    if url.get_backend_name() == 'sqlite':
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(url.database + suffix):
+                os.remove(url.database + suffix)
+        return
+    admin = create_engine(url)
+    with admin.begin() as connection:
+        connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        connection.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+    admin.dispose()
+    os.environ['DATABASE_URL'] = url.update_query_dict({'options': f'-csearch_path={SCHEMA}'}) \
+        .render_as_string(hide_password=False)
+
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    prepare_database()
+    os.environ.setdefault('METRICS_PORT', '0')
+
+    from database import engine, get_session
+    from migrations import migrate
+    from repository import AccountsRepo, CompletedServicesRepo, LoansRepo
+
+    migrate(engine)
+    with engine.begin() as connection:
+        AccountsRepo(connection).insert_many({user_id: 100 for user_id in range(USERS)})
+
+    # Запросы одного апдейта так, как их писали обработчики: (SQL, параметры, запрос репозитория)
+    statements = [
+        (LoansRepo.ACTIVE_FOR_USER.text, {'user_id': 42}, LoansRepo.ACTIVE_FOR_USER),
+        (AccountsRepo.CLIENT_IDS.text, {}, AccountsRepo.CLIENT_IDS),
+        (CompletedServicesRepo.ACTIVE_FOR_USER.text, {'user_id': 42}, CompletedServicesRepo.ACTIVE_FOR_USER),
+        (AccountsRepo.EXECUTOR.text, {'buyer_id': 42}, AccountsRepo.EXECUTOR),
+    ]
+
+    def build_inline():
+        for sql, _, _ in statements:
+            text(sql)
+
+    session = get_session()
+
+    def execute_inline():
+        for sql, params, _ in statements:
+            session.execute(text(sql), params).fetchall()
+        session.rollback()
+
+    def execute_precompiled():
+        for _, params, statement in statements:
+            session.execute(statement, params).fetchall()
+        session.rollback()
+
+    user_ids = list(range(1, 21))
+
+    def balances_one_by_one():
+        for user_id in user_ids:
+            session.execute(text("SELECT balance FROM accounts WHERE user_id = :user_id"),
+                            {'user_id': user_id}).scalar()
+        session.rollback()
+
+    def balances_batch():
+        AccountsRepo(session).get_balances(user_ids)
+        session.rollback()
+
+    def per_update_us(func, number):
+        execute_precompiled()
+        return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+    build = per_update_us(build_inline, updates)
+    inline = per_update_us(execute_inline, updates)
+    precompiled = per_update_us(execute_precompiled, updates)
+    one_by_one = per_update_us(balances_one_by_one, max(1, updates // 10))
+    batch = per_update_us(balances_batch, max(1, updates // 10))
+    session.close()
+    engine.dispose()
+
+    print(f"{engine.dialect.name}, {len(statements)} statements per update, {updates} updates")
+    print(f"text() construction only:       {build:8.1f} us per update")
+    print(f"executed, inline text():        {inline:8.1f} us per update")
+    print(f"executed, repository constants: {precompiled:8.1f} us per update"
+          f" ({inline - precompiled:+.1f} us saved)")
+    print(f"balances of {len(user_ids)} users, one by one: {one_by_one:8.1f} us")
+    print(f"balances of {len(user_ids)} users, get_balances: {batch:8.1f} us")
+
+
+if __name__ == '__main__':
+    main()
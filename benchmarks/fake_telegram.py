@@ -0,0 +1,164 @@
+# Локальная заглушка Telegram для проверки режима вебхука без сети.
+# Отвечает на вызовы Bot API (бот запускается с TELEGRAM_API_URL=http://127.0.0.1:8081/bot{0}/{1})
+# и отправляет на вебхук апдейты с секретом, как это делает сам Telegram.
+# Запуск: python benchmarks/fake_telegram.py --webhook http://127.0.0.1:8080/ --secret S --updates 100
+import argparse
+import itertools
+import json
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bank', 'username': 'bank_bot'}
+
+
+def make_user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+
+
+def make_message(message_id, chat_id, user, text):
+    return {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'group'},
+            'from': user, 'text': text}
+
+
+def make_update(update_id, chat_id, user_id, text):
+    return {'update_id': update_id, 'message': make_message(update_id, chat_id, make_user(user_id), text)}
+
+
+def make_callback(update_id, chat_id, user_id, data):
+    return {'update_id': update_id,
+            'callback_query': {'id': str(update_id), 'from': make_user(user_id), 'chat_instance': str(chat_id),
+                               'data': data, 'message': make_message(update_id, chat_id, BOT_USER, "")}}
+
+
+# Очередь соединений ядра по умолчанию (5) при всплеске запросов сбрасывает соединения
+class FakeHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+# Заглушка Bot API: на все методы отвечает успехом и считает вызовы
+class FakeBotApi:
+    def __init__(self, host='127.0.0.1', port=8081, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self.server = FakeHTTPServer((host, port), self._make_handler())
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def handle_method(self):
+                url = urllib.parse.urlsplit(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                params = dict(urllib.parse.parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                    params.update(urllib.parse.parse_qsl(body.decode()))
+                payload = json.dumps({'ok': True, 'result': api.answer(method, params)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = handle_method
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def answer(self, method, params):
+        with self._lock:
+            self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            # Апдейты приходят только на вебхук; для long polling просто ждем
+            time.sleep(1)
+            return []
+        if method == 'getChatMember':
+            return {'status': 'member', 'user': make_user(int(params.get('user_id', 0)))}
+        if method in ('setWebhook', 'deleteWebhook', 'answerCallbackQuery', 'deleteMessage'):
+            return True
+        chat_id = int(params.get('chat_id', 0))
+        return make_message(next(self._message_ids), chat_id, BOT_USER, params.get('text', ''))
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def post_update(url, secret, update):
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), method='POST',
+                                     headers={'Content-Type': 'application/json',
+                                              'X-Telegram-Bot-Api-Secret-Token': secret})
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--webhook', default='http://127.0.0.1:8080/')
+    parser.add_argument('--secret', required=True)
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--api-latency', type=float, default=0.0)
+    parser.add_argument('--updates', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--chats', type=int, default=4)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--text', action='append', help="текст сообщений (можно несколько раз)")
+    parser.add_argument('--linger', type=float, default=2.0, help="сколько ждать ответов бота после отправки")
+    args = parser.parse_args()
+    texts = args.text or ['/start', '/balance', '/help']
+
+    api = FakeBotApi(port=args.api_port, latency=args.api_latency)
+    api.start()
+
+    updates = [make_update(i, -1000 - i % args.chats, 100 + i % args.users, texts[i % len(texts)])
+               for i in range(1, args.updates + 1)]
+    latencies = []
+
+    def send(update):
+        started = time.perf_counter()
+        status = post_update(args.webhook, args.secret, update)
+        latencies.append(time.perf_counter() - started)
+        return status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        statuses = Counter(executor.map(send, updates))
+    elapsed = time.perf_counter() - started
+    time.sleep(args.linger)
+    api.stop()
+
+    latencies.sort()
+    print(json.dumps({
+        'updates': args.updates,
+        'seconds': round(elapsed, 3),
+        'statuses': {str(status): count for status, count in statuses.items()},
+        'post_p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'post_max_ms': round(latencies[-1] * 1000, 2),
+        'api_calls': dict(api.calls),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
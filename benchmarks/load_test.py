@@ -0,0 +1,229 @@
+# Нагрузочный прогон обработчиков bot.py. Bot API заменяет локальная заглушка
+# (FakeBotApi из fake_telegram.py) с настраиваемой задержкой, база заполняется в отдельной
+# схеме bench_load, которая пересоздается при каждом запуске. Апдейты из заданной смеси
+# команд подаются с частотой --rate; результат — JSON с p50/p95/p99 задержки обработки,
+# числом SQL-запросов и вызовов API на апдейт, по всем апдейтам и по видам, а также
+# временем одного прохода начисления процентов по всем просроченным кредитам.
+# Запуск: DATABASE_URL=postgresql://... python benchmarks/load_test.py --users 1000 --rate 50 > run.json
+# (или DATABASE_URL=sqlite:///bench.db — тогда пересоздается файл базы). Трассы медленных апдейтов
+# пишутся во временный каталог, если TRACE_FILE не задан.
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, event, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_url import sync_url
+from fake_telegram import FakeBotApi, make_callback, make_update
+
+SCHEMA = 'bench_load'
+CHAT_ID = -100
+DEFAULT_MIX = 'balance=3,debts=1,transactions=1,buy=2,buy_click=2,send=1,help=1'
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        kind, weight = part.split('=')
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+# Апдейт указанного вида от случайного пользователя
+def make_kind_update(kind, update_id, rng, users, buy_services):
+    user_id = rng.randint(1, users)
+    if kind == 'buy_click':
+        return make_callback(update_id, CHAT_ID, user_id, f"buy_{rng.choice(buy_services)}")
+    if kind == 'loan_click':
+        return make_callback(update_id, CHAT_ID, user_id, "loan_4")
+    return make_update(update_id, CHAT_ID, user_id, f"/{kind}")
+
+
+# Строки генерируются в Python, чтобы заполнение работало и в Postgres, и в SQLite
+def seed(engine, users, loans, services, closed):
+    from repository import AccountsRepo, CompletedServicesRepo, LoansRepo, ServicesRepo
+
+    today = datetime.now().astimezone().replace(hour=0, minute=0, second=0, microsecond=0)
+    now = datetime.now().astimezone()
+    with engine.begin() as connection:
+        AccountsRepo(connection).insert_many({0: 1000000000, **{g: 1000000 for g in range(1, users + 1)}})
+        ServicesRepo(connection).insert_many(
+            {'service_name': f'Услуга {g}', 'price': 1 + g % 10, 'type': 'buy' if g % 2 == 0 else 'sell'}
+            for g in range(1, services + 1))
+        # Кредиты начаты несколько дней назад, так что все они уже ждут начисления
+        LoansRepo(connection).insert_many(
+            {'user_id': g, 'amount': 4 * (1 + g % 5), 'start_date': today - timedelta(days=1 + g % 5),
+             'interest_rate': 0.25, 'status': 'active'}
+            for g in range(1, min(loans, users) + 1))
+        CompletedServicesRepo(connection).insert_many(
+            {'user_id': 1 + g % users, 'service_name': f'Услуга {g}', 'price': 1 + g % 10, 'type': 'buy',
+             'status': 'closed', 'end_date': now - timedelta(minutes=g)}
+            for g in range(1, closed + 1))
+        return connection.execute(text("SELECT service_id FROM services WHERE type = 'buy'")).scalars().all()
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+    return {'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'max': round(values[-1] * 1000, 2)}
+
+
+def summarize(samples):
+    count = len(samples)
+    return {
+        'count': count,
+        'errors': sum(1 for sample in samples if sample['error']),
+        'latency_ms': percentiles([sample['latency'] for sample in samples]),
+        'queue_delay_ms': percentiles([sample['queue_delay'] for sample in samples]),
+        'db_queries_per_update': round(sum(sample['queries'] for sample in samples) / count, 2) if count else 0,
+        'api_calls_per_update': round(sum(sample['api_calls'] for sample in samples) / count, 2) if count else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--loans', type=int, default=200)
+    parser.add_argument('--services', type=int, default=50)
+    parser.add_argument('--closed', type=int, default=10000, help="завершенных услуг в истории")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="вид=вес через запятую")
+    parser.add_argument('--rate', type=float, default=50, help="апдейтов в секунду")
+    parser.add_argument('--duration', type=float, default=10, help="секунд подачи апдейтов")
+    parser.add_argument('--concurrency', type=int, default=8, help="потоков обработки")
+    parser.add_argument('--api-latency', type=float, default=0.02, help="задержка ответа заглушки API, секунды")
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help="не снимать лимиты Outbox (по умолчанию снимаются, чтобы мерить обработчики)")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    url = sync_url(os.environ['DATABASE_URL'])
+    if url.get_backend_name() == 'sqlite':
+        # Файл базы SQLite пересоздается так же, как схема в Postgres
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(url.database + suffix):
+                os.remove(url.database + suffix)
+    else:
+        admin = create_engine(url)
+        with admin.begin() as connection:
+            connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+            connection.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+        admin.dispose()
+        # bot.py читает настройки при импорте, поэтому окружение готовится заранее
+        os.environ['DATABASE_URL'] = url.update_query_dict({'options': f'-csearch_path={SCHEMA}'}) \
+            .render_as_string(hide_password=False)
+    os.environ['TELEGRAM_API_URL'] = f'http://127.0.0.1:{args.api_port}/bot{{0}}/{{1}}'
+    os.environ.setdefault('BOT_TOKEN', '1:loadtest')
+    os.environ.setdefault('TRACE_FILE', os.path.join(tempfile.gettempdir(), 'load_test_slow_updates.jsonl'))
+    if not args.telegram_limits:
+        for name in ('OUTBOX_GLOBAL_RATE', 'OUTBOX_CHAT_RATE', 'OUTBOX_CHAT_BURST',
+                     'OUTBOX_GROUP_RATE', 'OUTBOX_GROUP_BURST'):
+            os.environ[name] = '1000000'
+
+    api = FakeBotApi(port=args.api_port, latency=args.api_latency)
+    api.start()
+
+    import telebot
+    from telebot import apihelper
+    from telebot.types import Update
+
+    import database
+    import bot
+    from loans import LoanScheduler
+
+    bot.create_app()
+    logging.getLogger().setLevel(logging.WARNING)
+    buy_services = seed(database.engine, args.users, args.loans, args.services, args.closed)
+
+    # Счетчики SQL-запросов и вызовов API потока, который обрабатывает апдейт
+    counters = threading.local()
+
+    def count(name):
+        setattr(counters, name, getattr(counters, name, 0) + 1)
+
+    for engine in {database.engine, database.replica_engine}:
+        event.listen(engine, 'before_cursor_execute', lambda *_: count('queries'))
+    send_request = apihelper.CUSTOM_REQUEST_SENDER
+
+    def counting_sender(method, url, **kwargs):
+        count('api_calls')
+        if send_request is not None:
+            return send_request(method, url, **kwargs)
+        return apihelper._get_req_session().request(method, url, **kwargs)
+
+    apihelper.CUSTOM_REQUEST_SENDER = counting_sender
+
+    # Обработчики выполняются прямо в потоке замера, без пула и диспетчера бота
+    bot.bot.threaded = False
+    samples = []
+    samples_lock = threading.Lock()
+
+    def handle(kind, update, scheduled_at):
+        counters.queries = counters.api_calls = 0
+        started = time.perf_counter()
+        error = False
+        try:
+            telebot.TeleBot.process_new_updates(bot.bot, [Update.de_json(update)])
+        except Exception:
+            logging.exception(f"Update {update['update_id']} ({kind}) failed")
+            error = True
+        finished = time.perf_counter()
+        with samples_lock:
+            samples.append({'kind': kind, 'latency': finished - started, 'queue_delay': started - scheduled_at,
+                            'queries': counters.queries, 'api_calls': counters.api_calls, 'error': error})
+
+    rng = random.Random(args.seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    total = int(args.rate * args.duration)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        for i in range(total):
+            scheduled_at = started + i / args.rate
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            kind = rng.choices(kinds, weights)[0]
+            pool.submit(handle, kind, make_kind_update(kind, i + 1, rng, args.users, buy_services), scheduled_at)
+    elapsed = time.perf_counter() - started
+
+    # Один проход начисления процентов по всем просроченным кредитам
+    scheduler = LoanScheduler(bot.create_connection)
+    scheduler.load()
+    now = time.time()
+    due = [entry for entry in scheduler._heap if entry[0] <= now]
+    accrual_started = time.perf_counter()
+    scheduler._accrue(due, now)
+    accrual_seconds = time.perf_counter() - accrual_started
+    api.stop()
+
+    by_kind = defaultdict(list)
+    for sample in samples:
+        by_kind[sample['kind']].append(sample)
+    result = {
+        'config': vars(args),
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(samples) / elapsed, 2),
+        **summarize(samples),
+        'by_kind': {kind: summarize(kind_samples) for kind, kind_samples in sorted(by_kind.items())},
+        'accrual': {'due_loans': len(due), 'seconds': round(accrual_seconds, 4)},
+    }
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
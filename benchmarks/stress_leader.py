@@ -0,0 +1,159 @@
+# Несколько процессов с LeaderLease и LoanScheduler над одной базой (схема bench_leader
+# или пересоздаваемый файл SQLite):
+# проценты по каждому кредиту должны начисляться ровно один раз, в том числе по кредитам,
+# добавленным при живом лидере (их находит перечитывание) и после того, как лидера убили
+# (их начисляет новый лидер). Проверяется, что у каждого пользователя ровно два кредита:
+# закрытый исходный и один открытый после начисления.
+# Запуск: DATABASE_URL=postgresql://... python benchmarks/stress_leader.py --workers 4
+# В SQLite аренду получает каждый процесс, поэтому там проверяется, что одновременные
+# начисления в транзакциях BEGIN IMMEDIATE не начисляют проценты дважды.
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import timedelta
+
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_url import sync_url
+
+SCHEMA = 'bench_leader'
+
+
+# Процесс-участник: берет аренду и, пока держит ее, начисляет проценты
+def worker(markers):
+    # SIGTERM ждет sigwait; маска наследуется потоками, которые запустятся дальше
+    signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGTERM])
+    from database import engine, get_session
+    from leader import LeaderLease
+    from loans import LoanScheduler
+
+    scheduler = LoanScheduler(get_session, reload_interval=1)
+
+    def on_acquire():
+        with open(os.path.join(markers, f'leader-{os.getpid()}'), 'w') as marker:
+            marker.write(str(time.time()))
+        scheduler.start()
+
+    lease = LeaderLease(engine, on_acquire, scheduler.stop, heartbeat=0.5, retry=0.5)
+    lease.start()
+    signal.sigwait([signal.SIGTERM])
+    lease.stop()
+
+
+# Пользователи first..first+count-1 с одним кредитом, срок начисления которого уже прошел
+def seed_loans(connection, first, count):
+    from loans import loan_start_date
+    from repository import LoansRepo
+
+    start_date = loan_start_date() - timedelta(days=2)
+    LoansRepo(connection).insert_many({'user_id': user_id, 'amount': 10, 'start_date': start_date,
+                                       'interest_rate': 0.25, 'status': 'active'}
+                                      for user_id in range(first, first + count))
+
+
+def wait_accrued(engine, users, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with engine.connect() as connection:
+            accrued = connection.execute(text("SELECT count(*) FROM loans WHERE status = 'closed'")).scalar()
+        if accrued >= users:
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def current_leader(markers, workers):
+    alive = {process.pid: process for process in workers if process.poll() is None}
+    found = [(os.path.getmtime(os.path.join(markers, name)), int(name.split('-')[1]))
+             for name in os.listdir(markers) if int(name.split('-')[1]) in alive]
+    return alive[max(found)[1]] if found else None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--loans', type=int, default=300, help="кредитов в каждой из трех партий")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        worker(args.worker)
+        return
+
+    url = sync_url(os.environ['DATABASE_URL'])
+    if url.get_backend_name() == 'sqlite':
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(url.database + suffix):
+                os.remove(url.database + suffix)
+    else:
+        admin = create_engine(url)
+        with admin.begin() as connection:
+            connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+            connection.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+        admin.dispose()
+        os.environ['DATABASE_URL'] = url.update_query_dict({'options': f'-csearch_path={SCHEMA}'}) \
+            .render_as_string(hide_password=False)
+    os.environ.setdefault('METRICS_PORT', '0')
+
+    from database import engine
+    from migrations import migrate
+
+    migrate(engine)
+    with engine.begin() as connection:
+        seed_loans(connection, 1, args.loans)
+
+    markers = tempfile.mkdtemp()
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', markers])
+               for _ in range(args.workers)]
+    ok = True
+    try:
+        ok &= wait_accrued(engine, args.loans, 30)
+        print(f"initial batch accrued: {ok}")
+
+        with engine.begin() as connection:
+            seed_loans(connection, args.loans + 1, args.loans)
+        ok &= wait_accrued(engine, 2 * args.loans, 30)
+        print(f"batch added under the same leader accrued: {ok}")
+
+        leader = current_leader(markers, workers)
+        leader.kill()
+        leader.wait()
+        killed_at = time.time()
+        with engine.begin() as connection:
+            seed_loans(connection, 2 * args.loans + 1, args.loans)
+        ok &= wait_accrued(engine, 3 * args.loans, 60)
+        if engine.dialect.name == 'sqlite':
+            print(f"batch added after killing one of the workers accrued: {ok}")
+        else:
+            new_leader = current_leader(markers, workers)
+            failover = os.path.getmtime(os.path.join(markers, f'leader-{new_leader.pid}')) - killed_at
+            print(f"batch added after killing the leader accrued: {ok}, failover took {failover:.1f}s")
+    finally:
+        for process in workers:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        for process in workers:
+            process.wait()
+
+    with engine.connect() as connection:
+        wrong = connection.execute(text("""
+            SELECT count(*) FROM (
+                SELECT user_id FROM loans GROUP BY user_id
+                HAVING count(*) FILTER (WHERE status = 'closed') <> 1
+                    OR count(*) FILTER (WHERE status = 'active') <> 1
+            ) t
+        """)).scalar()
+        total = connection.execute(text("SELECT count(*) FROM loans")).scalar()
+    print(f"{total} loans for {3 * args.loans} users, users not accrued exactly once: {wrong}")
+    if wrong or not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# Нагрузочная проверка ledger.transfer: много потоков переводят деньги между
+# несколькими счетами, после чего сумма балансов должна сохраниться, балансы
+# не должны уйти в минус, а журнал — сходиться с балансами.
+# Работает в отдельной схеме bench_ledger (или в пересоздаваемом файле SQLite).
+# Запуск: DATABASE_URL=postgresql://... python benchmarks/stress_ledger.py [threads] [transfers]
+# (или DATABASE_URL=sqlite:///stress.db)
+import os
+import random
+import sys
+import threading
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import DATABASE_URL
+from db_url import sync_url
+from ledger import transfer
+from migrations import migrate
+from sqlite_backend import create_sqlite_engine
+
+SCHEMA = 'bench_ledger'
+ACCOUNTS = 5
+START_BALANCE = 100
+
+
+def worker(session_factory, transfers, results):
+    session = session_factory()
+    done = 0
+    for _ in range(transfers):
+        from_id, to_id = random.sample(range(ACCOUNTS), 2)
+        if transfer(session, from_id, to_id, random.randint(1, 40), memo="stress"):
+            done += 1
+        session.commit()
+    session.close()
+    results.append(done)
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    transfers = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    url = sync_url(DATABASE_URL)
+    sqlite = url.get_backend_name() == 'sqlite'
+    if sqlite:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(url.database + suffix):
+                os.remove(url.database + suffix)
+        engine = create_sqlite_engine(url, pool_size=threads)
+    else:
+        admin = create_engine(url)
+        with admin.begin() as connection:
+            connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+            connection.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+        engine = create_engine(url, pool_size=threads, connect_args={'options': f'-csearch_path={SCHEMA}'})
+    migrate(engine, target=1)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO accounts (user_id, balance) VALUES (:user_id, :balance)"),
+                           [{'user_id': user_id, 'balance': START_BALANCE} for user_id in range(ACCOUNTS)])
+    migrate(engine)
+    session_factory = sessionmaker(bind=engine)
+    results = []
+    pool = [threading.Thread(target=worker, args=(session_factory, transfers, results)) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    with engine.connect() as connection:
+        total, lowest = connection.execute(text("SELECT SUM(balance), MIN(balance) FROM accounts")).fetchone()
+        # Баланс каждого счета должен равняться сумме его записей в журнале
+        mismatched = connection.execute(text("""
+            SELECT COUNT(*) FROM accounts a
+            JOIN account_stats s ON s.user_id = a.user_id
+            WHERE abs(a.balance - (s.earned - s.spent)) > 0.001
+               OR abs(a.balance - (SELECT COALESCE(SUM(CASE WHEN j.to_id = a.user_id THEN j.amount
+                                                            ELSE -j.amount END), 0)
+                                   FROM journal j
+                                   WHERE j.to_id = a.user_id OR j.from_id = a.user_id)) > 0.001
+        """)).scalar()
+    engine.dispose()
+    if not sqlite:
+        with admin.begin() as connection:
+            connection.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+
+    attempts = threads * transfers
+    print(f"{attempts} transfers from {threads} threads in {elapsed:.2f}s ({attempts / elapsed:.0f}/s),"
+          f" {sum(results)} succeeded")
+    print(f"total balance {total} (expected {ACCOUNTS * START_BALANCE}), lowest balance {lowest},"
+          f" {mismatched} accounts out of sync with the journal")
+    if total != ACCOUNTS * START_BALANCE or lowest < 0 or mismatched:
+        sys.exit("ledger invariant violated")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,159 @@
 import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from sqlalchemy import text
 import telebot
+from telebot import apihelper
 from telebot.apihelper import ApiTelegramException
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 import threading
 import logging
+import signal
+from functools import partial
 from config import *
-from database import get_session, close_session
+from database import engine, get_session, replica_reads, scope_sessions
+from catalog import ServiceCatalog
+from conversations import ConversationStore
+from debt import debt_schedule_batch
+from dispatcher import ShardedTeleBot
+from leader import LeaderLease
+from ledger import BANK_ID, set_balance, transfer
+from loans import LoanScheduler, loan_start_date
+from logs import setup_logging
+from metrics import DISPATCH_QUEUE_DEPTH, instrument_api, instrument_bot, start_server, timed_handler
+from migrations import migrate
+from outbox import Outbox
+from pager import KeysetPager, cursor_to_timestamp, parse_cursor, split_text, timestamp_to_cursor
+from pending import MISSING, OWN, TAKEN, create_pending_store
+from repository import AccountsRepo, CompletedServicesRepo, LoansRepo, ServicesRepo
+from router import CallbackRouter
+from tracing import install_profile_signal
+
+# Middleware нужен для прогрева кэша имен из входящих апдейтов
+apihelper.ENABLE_MIDDLEWARE = True
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL
+
+if DISPATCH_WORKERS:
+    bot = ShardedTeleBot(BOT_TOKEN, workers=DISPATCH_WORKERS, key=DISPATCH_KEY,
+                         queue_size=DISPATCH_QUEUE_SIZE, lag_warning=DISPATCH_LAG_WARNING)
+    DISPATCH_QUEUE_DEPTH.set_function(
+        lambda: {(str(shard),): depth for shard, depth in enumerate(bot.dispatcher.stats()['queue_depth'])})
+else:
+    bot = telebot.TeleBot(BOT_TOKEN)
+outbox = Outbox(bot, global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST,
+                group_rate=OUTBOX_GROUP_RATE, group_burst=OUTBOX_GROUP_BURST)
+
+logger = logging.getLogger(__name__)
+
+
+# LRU-кэш участников чата с TTL. Промахи (ApiTelegramException) тоже кэшируются,
+# а параллельные запросы одного и того же пользователя ждут один общий вызов API.
+class MemberCache:
+    def __init__(self, fetch, maxsize=1024, ttl=3600, negative_ttl=300):
+        self.fetch = fetch
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _store(self, key, user, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, user)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def put(self, chat_id, user):
+        self._store((chat_id, user.id), user, self.ttl)
+
+    def put_missing(self, chat_id, user_id):
+        self._store((chat_id, user_id), None, self.negative_ttl)
+
+    def peek(self, chat_id, user_id):
+        key = (chat_id, user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[1]
+
+    def get(self, chat_id, user_id):
+        key = (chat_id, user_id)
+        while True:
+            found, user = self.peek(chat_id, user_id)
+            if found:
+                return user
+            with self._lock:
+                waiter = self._inflight.get(key)
+                if waiter is None:
+                    waiter = self._inflight[key] = threading.Event()
+                    break
+            waiter.wait()
+
+        user = None
+        try:
+            user = self.fetch(chat_id, user_id)
+            self.put(chat_id, user)
+        except ApiTelegramException:
+            self.put_missing(chat_id, user_id)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            waiter.set()
+        return user
+
+
+member_cache = MemberCache(lambda chat_id, user_id: bot.get_chat_member(chat_id=chat_id, user_id=user_id).user,
+                           maxsize=NAME_CACHE_SIZE, ttl=NAME_CACHE_TTL, negative_ttl=NAME_CACHE_NEGATIVE_TTL)
+
+
+def display_name(user_info, user_id, full=False):
+    if user_info is None:
+        return f"Пользователь {user_id}"
+    user_name = user_info.first_name
+    if full and user_info.last_name:
+        user_name += f" {user_info.last_name}"
+    return user_name
 
-bot = telebot.TeleBot(BOT_TOKEN)
 
-# Enable logging to help with debugging
-logging.basicConfig(level=logging.DEBUG)
+def get_user_name(chat_id, user_id, full=False):
+    return display_name(member_cache.get(chat_id, user_id), user_id, full)
+
+
+# Имена сразу для списка пользователей: {user_id: имя}
+def get_user_names(chat_id, user_ids, full=False):
+    return {user_id: get_user_name(chat_id, user_id, full) for user_id in user_ids}
+
+
+# Отправляет страницу списка. Длинный текст делится на несколько сообщений,
+# кнопки навигации прикрепляются к последнему. При edit=True первая часть
+# заменяет текст сообщения с кнопками, на которое нажали.
+def send_page(message, page_text, markup, edit=False):
+    chunks = split_text(page_text)
+    for i, chunk in enumerate(chunks):
+        chunk_markup = markup if i == len(chunks) - 1 else None
+        if i > 0:
+            outbox.send_message(chat_id=message.chat.id, text=chunk, reply_markup=chunk_markup)
+        elif edit:
+            outbox.edit_message_text(chunk, chat_id=message.chat.id, message_id=message.message_id,
+                                     reply_markup=chunk_markup)
+        else:
+            outbox.reply_to(message, chunk, reply_markup=chunk_markup)
+
+
+# Каждый апдейт бесплатно сообщает имя отправителя — сохраняем его в кэш
+@bot.middleware_handler(update_types=['message', 'callback_query'])
+def remember_sender(bot_instance, update):
+    message = update if isinstance(update, telebot.types.Message) else update.message
+    if message is not None and update.from_user is not None:
+        member_cache.put(message.chat.id, update.from_user)
 
 
 # Функция для создания соединения с базой данных
@@ -21,149 +162,116 @@ def create_connection():
     return session
 
 
-# Создание таблиц, если они не существуют
-def create_tables():
-    logging.debug(f"create_connection data: {create_connection()}")
-
-    session = create_connection()
-    session.execute(text('''CREATE TABLE IF NOT EXISTS accounts
-                      (user_id INTEGER PRIMARY KEY,
-                       balance REAL)'''))
-
-    session.execute(text('''CREATE TABLE IF NOT EXISTS services
-                      (service_id SERIAL PRIMARY KEY,
-                       service_name TEXT,
-                       price REAL,
-                       type TEXT)'''))
-
-    session.execute(text('''CREATE TABLE IF NOT EXISTS completed_services
-                      (service_id SERIAL PRIMARY KEY,
-                       user_id INTEGER,
-                       service_name TEXT,
-                       price REAL,
-                       type TEXT,
-                       status TEXT,
-                       end_date TEXT)'''))
-
-    session.execute(text('''CREATE TABLE IF NOT EXISTS loans
-                      (loan_id SERIAL PRIMARY KEY,
-                       user_id INTEGER,
-                       amount REAL,
-                       start_date TEXT,
-                       end_date TEXT,
-                       interest_rate REAL,
-                       status TEXT)'''))
-
-    session.commit()
-    session.close()
+loan_scheduler = LoanScheduler(create_connection, reload_interval=LOAN_RELOAD_INTERVAL)
+# Начисление процентов запускается только в процессе, который держит аренду фоновых задач
+loan_lease = LeaderLease(engine, loan_scheduler.start, loan_scheduler.stop,
+                         heartbeat=LEADER_HEARTBEAT, retry=LEADER_RETRY)
+service_catalog = ServiceCatalog(create_connection, ttl=CATALOG_TTL)
+callbacks = CallbackRouter(wrap=partial(timed_handler, 'callback'))
+pending_actions = create_pending_store(PENDING_STORE, create_connection, ttl=PENDING_TTL)
+# Процесс не видит, как другие процессы задают и забирают шаги, поэтому при BOT_PROCESSES > 1
+# состояние диалога всегда читается из базы
+conversations = ConversationStore(create_connection, ttl=CONVERSATION_TTL,
+                                  maxsize=CONVERSATION_CACHE_SIZE if BOT_PROCESSES == 1 else 0,
+                                  wrap=partial(timed_handler, 'step'))
 
 
-# Создание таблиц при запуске бота
-create_tables()
+# Ответ на шаг начатого диалога (сумма, название услуги, фото) обрабатывается раньше команд
+@bot.message_handler(func=lambda message: conversations.get(message.chat.id) is not None,
+                     content_types=['text', 'photo', 'document', 'sticker'])
+def continue_conversation(message):
+    conversations.resume(message)
 
 
 # Обработчик команды /start
 @bot.message_handler(commands=['start'])
 def send_welcome(message):
     session = create_connection()
-    user_id = message.from_user.id
-    session.execute(text("INSERT INTO accounts (user_id, balance) VALUES (0, 0) ON CONFLICT (user_id) DO NOTHING"))
-    session.execute(text("INSERT INTO accounts (user_id, balance) VALUES (:user_id, 0)"
-                         " ON CONFLICT (user_id) DO NOTHING"), {'user_id': user_id})
+    AccountsRepo(session).ensure([BANK_ID, message.from_user.id])
     session.commit()
     session.close()
-    bot.reply_to(message, "Добро пожаловать в бот для покупки и оказания услуг!")
+    outbox.reply_to(message, "Добро пожаловать в бот для покупки и оказания услуг!")
+
+
+# Клавиатура выбора пользователя: по кнопке на каждого из names
+def user_keyboard(action, names):
+    markup = InlineKeyboardMarkup()
+    for user_id, user_name in names.items():
+        markup.add(InlineKeyboardButton(user_name, callback_data=f"{action}_{user_id}"))
+    return markup
 
 
 @bot.message_handler(commands=['change_balance'])
 def change_balance(message):
-    markup = InlineKeyboardMarkup()
     session = create_connection()
-    users = session.execute(text("SELECT user_id FROM accounts")).fetchall()
+    user_ids = AccountsRepo(session).all_ids()
     session.close()
-    for user in users:
-        user_id = user[0]
-        try:
-            user_info = bot.get_chat_member(chat_id=message.chat.id, user_id=user_id).user
-            user_name = user_info.first_name
-            if user_info.last_name:
-                user_name += f" {user_info.last_name}"
-            markup.add(InlineKeyboardButton(user_name, callback_data=f"select_{user_id}"))
-        except ApiTelegramException:
-            markup.add(InlineKeyboardButton(f"Пользователь {user_id}", callback_data=f"select_{user_id}"))
-    bot.reply_to(message, "Выберите пользователя для изменения баланса:", reply_markup=markup)
+    markup = user_keyboard('select', get_user_names(message.chat.id, user_ids, full=True))
+    outbox.reply_to(message, "Выберите пользователя для изменения баланса:", reply_markup=markup)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('select_'))
-def select_user(call):
-    target_user_id = int(call.data.split('_')[1])
+@callbacks.route('select', int)
+def select_user(call, target_user_id):
     clicking_user_id = call.from_user.id
     if target_user_id != 0:
-        user_info = bot.get_chat_member(chat_id=call.message.chat.id, user_id=target_user_id).user
-        user_name = user_info.first_name
-        if user_info.last_name:
-            user_name += f" {user_info.last_name}"
+        user_name = get_user_name(call.message.chat.id, target_user_id, full=True)
     else:
         user_name = 'Банк'
-    bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
-    bot.send_message(chat_id=call.message.chat.id, text=f"Введите сумму для изменения баланса пользователя {user_name}:")
-    bot.register_next_step_handler(call.message, process_balance_change, target_user_id, user_name, clicking_user_id)
+    outbox.replace(call.message, f"Введите сумму для изменения баланса пользователя {user_name}:")
+    conversations.set(call.message.chat.id, process_balance_change, target_user_id=target_user_id,
+                      user_name=user_name, clicking_user_id=clicking_user_id)
 
 
+@conversations.step
 def process_balance_change(message, target_user_id, user_name, clicking_user_id):
     try:
         amount = float(message.text)
+        token = pending_actions.put(clicking_user_id, {'target_user_id': target_user_id, 'amount': amount})
         markup = InlineKeyboardMarkup()
-        markup.add(InlineKeyboardButton("Подтвердить", callback_data=f"confirm_balance_{target_user_id}_{amount}_{clicking_user_id}"))
-        markup.add(InlineKeyboardButton("Отменить", callback_data="cancel"))
-        bot.send_message(chat_id=message.chat.id, text=f"Подтвердите изменение баланса на {amount} монет для пользователя {user_name}:", reply_markup=markup)
+        markup.add(InlineKeyboardButton("Подтвердить", callback_data=f"confirm_balance_{token}"))
+        markup.add(InlineKeyboardButton("Отменить", callback_data=f"cancel_{token}"))
+        outbox.send_message(chat_id=message.chat.id, text=f"Подтвердите изменение баланса на {amount} монет для пользователя {user_name}:", reply_markup=markup)
     except ValueError:
-        bot.send_message(chat_id=message.chat.id, text="Пожалуйста, введите корректную сумму.")
-
+        outbox.send_message(chat_id=message.chat.id, text="Пожалуйста, введите корректную сумму.")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('confirm_balance_'))
-def handle_confirm_balance(call):
-    data = call.data.split('_')
-    target_user_id = int(data[2])
-    amount = float(data[3])
-    clicking_user_id = int(data[4])
-    logging.debug(f"clicking_id: {clicking_user_id}, target_id: {target_user_id}, call_from: {call.from_user.id}")
 
-    if call.from_user.id == clicking_user_id:
+@callbacks.route('confirm_balance', str)
+def handle_confirm_balance(call, token):
+    status, action = pending_actions.take(token, call.from_user.id)
+    logger.debug("Balance change confirmation", extra={'token': token, 'status': status, 'action': action,
+                                                       'confirmed_by': call.from_user.id})
 
+    if status == OWN:
         bot.answer_callback_query(call.id, "Вы не можете подтвердить изменение собственного баланса.")
         return
+    if status == MISSING:
+        bot.answer_callback_query(call.id, "Запрос устарел или уже обработан.")
+        return
 
+    target_user_id, amount = action['target_user_id'], action['amount']
     session = create_connection()
-    session.execute(text("UPDATE accounts SET balance = :amount WHERE user_id = :user_id"),
-                    {'amount': amount, 'user_id': target_user_id})
+    set_balance(session, target_user_id, amount, memo=f"confirmed by {call.from_user.id}")
     session.commit()
     session.close()
 
     if target_user_id != 0:
-        user_info = bot.get_chat_member(chat_id=call.message.chat.id, user_id=target_user_id).user
-        user_name = user_info.first_name
-        if user_info.last_name:
-            user_name += f" {user_info.last_name}"
+        user_name = get_user_name(call.message.chat.id, target_user_id, full=True)
     else:
         user_name = 'Банк'
 
-    bot.send_message(chat_id=call.message.chat.id, text=f"Баланс пользователя {user_name} успешно изменен на {amount} монет.")
-    bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
+    outbox.replace(call.message, f"Баланс пользователя {user_name} успешно изменен на {amount} монет.")
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "cancel")
-def handle_cancel(call):
-    bot.send_message(chat_id=call.message.chat.id, text="Операция изменения баланса отменена.")
-    bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
+@callbacks.route('cancel', str)
+def handle_cancel(call, token):
+    pending_actions.discard(token)
+    outbox.replace(call.message, "Операция изменения баланса отменена.")
 
 
 @bot.message_handler(commands=['loan'])
 def show_loan_options(message):
     session = create_connection()
-    user_id = message.from_user.id
-    active_loan = session.execute(text("SELECT * FROM loans "
-                                       "WHERE user_id = :user_id AND status = 'active'"), {'user_id':user_id}).fetchone()
+    active_loan = LoansRepo(session).active_for_user(message.from_user.id)
     session.close()
 
     markup = InlineKeyboardMarkup()
@@ -175,298 +283,251 @@ def show_loan_options(message):
         for amount in loan_amounts:
             markup.add(InlineKeyboardButton(f"{amount} монет", callback_data=f"loan_{amount}"))
 
-    bot.reply_to(message, "Выберите действие:", reply_markup=markup)
+    outbox.reply_to(message, "Выберите действие:", reply_markup=markup)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('repay_'))
-def handle_repay_loan(call):
-    logging.debug(f"Received callback data: {call.data}")
-    loan_id = int(call.data.split('_')[1])
+@callbacks.route('repay', int)
+def handle_repay_loan(call, loan_id):
     session = create_connection()
-    loan = session.execute(text("SELECT user_id, amount, interest_rate FROM loans"
-                                " WHERE loan_id = :loan_id AND status = 'active'"), {'loan_id': loan_id}).fetchone()
-
-    bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
+    loan = LoansRepo(session).close(loan_id)
 
     if loan:
-        user_id, amount, interest_rate = loan
-        user_balance = session.execute(text("SELECT balance FROM accounts"
-                                            " WHERE user_id = :user_id"), {'user_id': user_id}).fetchone()[0]
-        total_amount = amount
-        if user_balance >= total_amount:
-            session.execute(text("UPDATE accounts SET balance = balance - :total_amount"
-                                 " WHERE user_id = :user_id"), {'total_amount': total_amount, 'user_id': user_id})
-            session.execute(text("UPDATE accounts SET balance = balance + :total_amount"
-                                 " WHERE user_id = 0"), {'total_amount': total_amount})
-            session.execute(text("UPDATE loans SET status = 'closed' WHERE loan_id = :loan_id"), {'loan_id': loan_id})
+        user_id, total_amount = loan
+        if transfer(session, user_id, BANK_ID, total_amount, memo=f"repay loan {loan_id}"):
             session.commit()
-            bot.send_message(chat_id=call.message.chat.id,
-                             text=f"Кредит на сумму {total_amount:.2f} монет успешно погашен.")
+            outbox.replace(call.message, f"Кредит на сумму {total_amount:.2f} монет успешно погашен.")
         else:
-            bot.send_message(chat_id=call.message.chat.id, text="У вас недостаточно средств для погашения кредита.")
+            session.rollback()
+            outbox.replace(call.message, "У вас недостаточно средств для погашения кредита.")
     else:
-        bot.send_message(chat_id=call.message.chat.id, text="Кредит не найден.")
+        outbox.replace(call.message, "Кредит не найден.")
     session.close()
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('loan_'))
-def handle_loan(call):
-    logging.debug(f"Received callback data: {call.data}")
-    amount = int(call.data.split('_')[1])
+@callbacks.route('loan', int)
+def handle_loan(call, amount):
     user_id = call.from_user.id
     session = create_connection()
 
-    bank_balance = session.execute(text("SELECT balance FROM accounts WHERE user_id = 0")).fetchone()[0]
-
-    active_loan = session.execute(text("SELECT * FROM loans"
-                                       " WHERE user_id = :user_id AND status = 'active'"),
-                                  {'user_id', user_id}).fetchone()
-
-    bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
+    # Перевод блокирует строку счета пользователя, поэтому параллельный второй кредит
+    # дождется коммита первого и не пройдет проверку NOT EXISTS
+    if not transfer(session, BANK_ID, user_id, amount, memo="loan"):
+        session.rollback()
+        outbox.replace(call.message, "В банке недостаточно средств для выдачи кредита.")
+        session.close()
+        return
 
-    if active_loan:
-        bot.send_message(chat_id=call.message.chat.id,
-                         text="Вы не можете взять новый кредит, пока не погасите текущий.")
-    elif bank_balance >= amount:
-        session.execute(text("UPDATE accounts SET balance = balance - :amount WHERE user_id = 0"), {'amount': amount})
-        session.execute(text("UPDATE accounts SET balance = balance + :amount"
-                             " WHERE user_id = :user_id"), {'amount': amount, 'user_id': user_id})
-        session.execute(text(
-            "INSERT INTO loans (user_id, amount, start_date, end_date, interest_rate, status)"
-            " VALUES (:user_id, :amount, :start_date, :end_date, :interest_rate, :status)"),
-            {'user_id': user_id,
-             'amount': amount,
-             'start_date': datetime.now().strftime("%Y-%m-%d"),
-             'end_date': '',
-             'interest_rate': 0.25,
-             'status': 'active'}
-        )
-        session.commit()
-        bot.send_message(chat_id=call.message.chat.id, text=f"Кредит на сумму {amount} монет успешно выдан.")
+    start_date = loan_start_date()
+    loan_id = LoansRepo(session).open(user_id, amount, start_date, interest_rate=0.25)
+    if loan_id is None:
+        session.rollback()
+        outbox.replace(call.message, "Вы не можете взять новый кредит, пока не погасите текущий.")
     else:
-        bot.send_message(chat_id=call.message.chat.id, text="В банке недостаточно средств для выдачи кредита.")
+        session.commit()
+        loan_scheduler.schedule(loan_id, amount, start_date.timestamp())
+        outbox.replace(call.message, f"Кредит на сумму {amount} монет успешно выдан.")
     session.close()
 
 
-@bot.message_handler(commands=['balance'])
-def show_balance(message):
+balance_pager = KeysetPager(
+    'balpage',
+    first=text("SELECT user_id, balance FROM accounts ORDER BY user_id LIMIT :limit"),
+    after=text("SELECT user_id, balance FROM accounts WHERE user_id > :user_id ORDER BY user_id LIMIT :limit"),
+    before=text("SELECT user_id, balance FROM accounts WHERE user_id < :user_id ORDER BY user_id DESC LIMIT :limit"),
+    to_cursor=lambda account: (account.user_id,),
+    from_cursor=lambda cursor: {'user_id': cursor[0]},
+    page_size=50,
+)
+
+
+def balance_page(chat_id, direction='first', cursor=None):
     session = create_connection()
-    accounts = session.execute(text("SELECT user_id, balance FROM accounts")).fetchall()
+    accounts, markup = balance_pager.fetch(session, direction, cursor)
     session.close()
+    names = get_user_names(chat_id, [account.user_id for account in accounts if account.user_id != BANK_ID])
+    return format_balances(accounts, names), markup
 
+
+def format_balances(accounts, names):
     balance_text = "Балансы счетов:\n"
     for account in accounts:
         user_id, balance = account
         if user_id == 0:
             balance_text += f"Банк: {balance}\n"
         else:
-            try:
-                user_info = bot.get_chat_member(chat_id=message.chat.id, user_id=user_id).user
-                user_name = user_info.first_name
-                balance_text += f"{user_name}: {balance}\n"
-            except ApiTelegramException:
-                balance_text += f"Пользователь {user_id}: {balance}\n"
+            balance_text += f"{names[user_id]}: {balance}\n"
+    return balance_text
 
-    bot.reply_to(message, balance_text)
+
+@bot.message_handler(commands=['balance'])
+@replica_reads
+def show_balance(message):
+    send_page(message, *balance_page(message.chat.id))
+
+
+@callbacks.route('balpage', str, parse_cursor)
+@replica_reads
+def page_balance(call, direction, cursor):
+    send_page(call.message, *balance_page(call.message.chat.id, direction, cursor), edit=True)
 
 
 # Обработчик команды /buy
 @bot.message_handler(commands=['buy'])
 def show_buy_services(message):
-    session = create_connection()
-    buy_services = session.execute(text("SELECT service_id, service_name, price FROM services "
-                                        "WHERE type = 'buy'")).fetchall()
-    session.close()
-    markup = InlineKeyboardMarkup()
-    for service in buy_services:
-        service_id, service_name, price = service
-        markup.add(InlineKeyboardButton(f"{service_name} - {price}", callback_data=f"buy_{service_id}"))
-    bot.reply_to(message, "Выберите услугу для покупки:", reply_markup=markup)
+    outbox.reply_to(message, "Выберите услугу для покупки:", reply_markup=service_catalog.keyboard('buy'))
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('buy_'))
-def handle_buy_service(call):
-    logging.debug(f"Received callback data: {call.data}")
-    service_id = int(call.data.split('_')[1])
+@callbacks.route('buy', int)
+def handle_buy_service(call, service_id):
     buyer_id = call.from_user.id
 
     session = create_connection()
-
-    service = session.execute(text("SELECT service_name, price, type FROM services"
-                                   " WHERE service_id = :service_id"), {'service_id': service_id}).fetchone()
-    executor_id = session.execute(text("SELECT user_id FROM accounts"
-                                       " WHERE user_id != 0 AND user_id != :buyer_id"),
-                                  {'buyer_id': buyer_id}).fetchone()[0]
-    buyer_balance = session.execute(text("SELECT balance FROM accounts "
-                                         "WHERE user_id = :buyer_id"), {'buyer_id': buyer_id}).fetchone()[0]
-    bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
-
-    if service:
-        service_name, price, type = service
-        if buyer_balance >= price:
+    # Цена из базы в той же транзакции, что и перевод: каталог другого процесса мог устареть
+    service = ServicesRepo(session).get(service_id)
+    executor_id = AccountsRepo(session).find_executor(buyer_id)
+
+    # Услуги с отрицательной ценой могли остаться от версий без проверки стоимости
+    if service and service.price >= 0 and executor_id is not None:
+        _, service_name, price, type = service
+        # Покупатель платит банку, банк сразу отдает исполнителю его 75%; бесплатная услуга без переводов
+        if price == 0 or transfer(session, buyer_id, BANK_ID, price, memo=f"buy {service_name}"):
             if service_name.startswith("Экспресс"):
-                session.execute(text("UPDATE accounts SET balance = balance - :price WHERE user_id = :buyer_id"),
-                                {'price': price, 'buyer_id': buyer_id}
-                                )
-                session.execute(text("UPDATE accounts SET balance = balance + :price WHERE user_id = 0"),
-                                {'price': price}
-                                )
-                bot.send_message(chat_id=call.message.chat.id, text=f"Вы выбрали услугу '{service_name}'"
-                                                                    f" стоимостью {price} монет. Все средства "
-                                                                    f"переведены в банк.")
+                outbox.replace(call.message, f"Вы выбрали услугу '{service_name}'"
+                                             f" стоимостью {price} монет. Все средства "
+                                             f"переведены в банк.")
             else:
-                logging.debug(f"Price: {price}")
-                session.execute(text("UPDATE accounts SET balance = balance + :price WHERE user_id = 0"),
-                                {'price': price * 0.25 - price * 0.75}
-                                )
-                session.execute(text("UPDATE accounts SET balance = balance - :price WHERE user_id = :buyer_id"),
-                                {'price': price + price * 0.75, 'buyer_id': buyer_id}
-                                )
-                session.execute(text("UPDATE accounts SET balance = balance + :price "
-                                     "WHERE user_id = (SELECT user_id FROM services WHERE service_id = :service_id)"),
-                                {'price': price * 0.75, 'service_id': service_id}
-                                )
-                bot.send_message(chat_id=call.message.chat.id,
-                                 text=f"Вы выбрали услугу '{service_name}' стоимостью {price} монет."
-                                      f" 75% средств переведены исполнителю, 25% - в банк.")
-            session.execute(text(
-                "INSERT INTO completed_services (user_id, service_name, price, type, status)"
-                " VALUES (:executor_id, :service_name, :price, :type, :status)"),
-                {'executor_id': executor_id,
-                 'service_name': service_name,
-                 'price': price,
-                 'type': type,
-                 'status': 'active'}
-            )
+                if price > 0:
+                    transfer(session, BANK_ID, executor_id, price * 0.75, memo=f"execute {service_name}",
+                             overdraft=True)
+                outbox.replace(call.message, f"Вы выбрали услугу '{service_name}' стоимостью {price} монет."
+                                             f" 75% средств переведены исполнителю, 25% - в банк.")
+            CompletedServicesRepo(session).add(executor_id, service_name, price, type, 'active')
             session.commit()
         else:
-            bot.send_message(chat_id=call.message.chat.id, text="У вас недостаточно средств для покупки этой услуги.")
+            session.rollback()
+            outbox.replace(call.message, "У вас недостаточно средств для покупки этой услуги.")
     else:
-        bot.send_message(chat_id=call.message.chat.id, text="Ошибка: услуга не найдена.")
+        if service is None:
+            service_catalog.invalidate()
+        outbox.replace(call.message, "Ошибка: услуга не найдена.")
     session.close()
 
 
 # Обработчик команды /sell
 @bot.message_handler(commands=['sell'])
 def show_sell_services(message):
-    session = create_connection()
-    sell_services = session.execute(text("SELECT service_id, service_name, price FROM services "
-                                         "WHERE type = 'sell'")).fetchall()
-    session.close()
-    markup = InlineKeyboardMarkup()
-    for service in sell_services:
-        service_id, service_name, price = service
-        markup.add(InlineKeyboardButton(f"{service_name} - {price}", callback_data=f"sell_{service_id}"))
-    bot.reply_to(message, "Выберите услугу, которую можете оказать:", reply_markup=markup)
+    outbox.reply_to(message, "Выберите услугу, которую можете оказать:", reply_markup=service_catalog.keyboard('sell'))
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('sell_'))
-def handle_sell_service(call):
-    logging.debug(f"Received callback data: {call.data}")
-    service_id = int(call.data.split('_')[1])
+@callbacks.route('sell', int)
+def handle_sell_service(call, service_id):
     session = create_connection()
-    service = session.execute(text("SELECT service_name, price, type FROM services"
-                                   " WHERE service_id = :service_id"), {'service_id': service_id}).fetchone()
+    service = ServicesRepo(session).get(service_id)
     session.close()
-    bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
-    if service:
-        service_name, price, type = service
-        bot.send_message(chat_id=call.message.chat.id,
-                         text=f"Вы выбрали услугу '{service_name}' стоимостью {price} монет."
-                              f" Пожалуйста, отправьте фото выполненной работы.")
-        bot.register_next_step_handler_by_chat_id(call.message.chat.id, receive_photo,
-                                                  service_id, service_name, price, type,
-                                                  call.from_user.id)
+    if service and service.price >= 0:
+        _, service_name, price, type = service
+        outbox.replace(call.message, f"Вы выбрали услугу '{service_name}' стоимостью {price} монет."
+                                     f" Пожалуйста, отправьте фото выполненной работы.")
+        conversations.set(call.message.chat.id, receive_photo, service_id=service_id, service_name=service_name,
+                          price=price, type=type, seller_id=call.from_user.id)
 
     else:
-        bot.send_message(chat_id=call.message.chat.id, text="Ошибка: услуга не найдена.")
+        if service is None:
+            service_catalog.invalidate()
+        outbox.replace(call.message, "Ошибка: услуга не найдена.")
 
 
+@conversations.step
 def receive_photo(message, service_id, service_name, price, type, seller_id):
     if message.content_type == 'photo':
-        bot.send_message(chat_id=message.chat.id, text="Фото получено. Ожидайте подтверждения.")
-        logging.debug(f"report: {service_id, service_name, price, type, seller_id}")
+        outbox.send_message(chat_id=message.chat.id, text="Фото получено. Ожидайте подтверждения.")
+        logger.debug("Service report photo received", extra={'service_id': service_id, 'service_name': service_name,
+                                                             'price': price, 'type': type, 'seller_id': seller_id})
 
         send_confirmation_request(message.chat.id, service_id, seller_id, price, service_name, type)
     else:
-        bot.send_message(chat_id=message.chat.id, text="Пожалуйста, отправьте фото выполненной работы.")
+        outbox.send_message(chat_id=message.chat.id, text="Пожалуйста, отправьте фото выполненной работы.")
 
 
 def send_confirmation_request(chat_id, service_id, seller_id, price, service_name, type):
+    token = pending_actions.put(seller_id, {'service_id': service_id,
+                                            'seller_id': seller_id,
+                                            'price': price,
+                                            'service_name': service_name,
+                                            'type': type})
     markup = InlineKeyboardMarkup()
-    markup.add(InlineKeyboardButton("Подтвердить выполнение",
-                                    callback_data=f"confirm_{service_id}_{seller_id}_{price}_{service_name}_{type}"))
-    bot.send_message(chat_id=chat_id, text="Подтвердите выполнение задачи:", reply_markup=markup)
+    markup.add(InlineKeyboardButton("Подтвердить выполнение", callback_data=f"confirm_{token}"))
+    outbox.send_message(chat_id=chat_id, text="Подтвердите выполнение задачи:", reply_markup=markup)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('confirm_'))
-def confirm_task(call):
-    service = call.data.split('_')
-    service_id, task_user_id, price, service_name, type = service[1], service[2], service[3], service[4], service[5]
-    logging.debug(f"callback data: {service}")
-    if call.from_user.id != int(task_user_id):
+@callbacks.route('confirm', str)
+def confirm_task(call, token):
+    status, action = pending_actions.take(token, call.from_user.id)
+    logger.debug("Task confirmation", extra={'token': token, 'status': status, 'action': action})
+    if status == TAKEN:
+        task_user_id, price = action['seller_id'], action['price']
+        service_name, type = action['service_name'], action['type']
         session = create_connection()
-        session.execute(text("UPDATE accounts SET balance = balance - :price WHERE user_id = 0"), {'price': price})
-        session.execute(text("UPDATE accounts SET balance = balance + :price WHERE user_id = :task_user_id"),
-                        {'price': price, 'task_user_id': task_user_id})
-        session.execute(text("INSERT INTO completed_services (user_id, service_name, price, type, status, end_date)"
-                             " VALUES (:user_id, :service_name, :price, :type, :status, :end_date)"),
-                        {'user_id': task_user_id,
-                         'service_name': service_name,
-                         'price': price,
-                         'type': type,
-                         'status': 'closed',
-                         'end_date': datetime.now().strftime("%Y-%m-%d %H:%M")
-                         }
-                        )
+        if price > 0:
+            transfer(session, BANK_ID, task_user_id, price, memo=f"sell {service_name}", overdraft=True)
+        CompletedServicesRepo(session).add(task_user_id, service_name, price, type, 'closed',
+                                           end_date=datetime.now().astimezone())
         session.commit()
         session.close()
-        bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
-        bot.send_message(chat_id=call.message.chat.id, text="Пользователь успешно закончил дело.")
-    else:
+        outbox.replace(call.message, "Пользователь успешно закончил дело.")
+    elif status == OWN:
         bot.answer_callback_query(call.id, "Вы не можете подтвердить выполнение своей задачи.")
+    else:
+        bot.answer_callback_query(call.id, "Запрос устарел или уже обработан.")
 
 
-@bot.message_handler(commands=['debts'])
-def show_debts(message):
+debts_pager = KeysetPager(
+    'debtpage',
+    first=text("SELECT loan_id, user_id, amount, start_date FROM loans"
+               " WHERE status = 'active' ORDER BY loan_id LIMIT :limit"),
+    after=text("SELECT loan_id, user_id, amount, start_date FROM loans"
+               " WHERE status = 'active' AND loan_id > :loan_id ORDER BY loan_id LIMIT :limit"),
+    before=text("SELECT loan_id, user_id, amount, start_date FROM loans"
+                " WHERE status = 'active' AND loan_id < :loan_id ORDER BY loan_id DESC LIMIT :limit"),
+    to_cursor=lambda loan: (loan.loan_id,),
+    from_cursor=lambda cursor: {'loan_id': cursor[0]},
+    page_size=50,
+)
+
+
+def debts_page(chat_id, direction='first', cursor=None):
     session = create_connection()
-    loans = session.execute(text("SELECT user_id, amount, start_date, interest_rate FROM loans "
-                                 "WHERE status = 'active'")).fetchall()
+    loans, markup = debts_pager.fetch(session, direction, cursor)
     session.close()
+    names = get_user_names(chat_id, [loan.user_id for loan in loans])
+    return format_debts(loans, names), markup
+
 
+def format_debts(loans, names):
     if loans:
         debts_text = "Состояние долгов пользователей:\n"
-        for loan in loans:
-            user_id, amount, start_date, interest_rate = loan
-            start_date = datetime.strptime(start_date, "%Y-%m-%d")
-            now = datetime.now()
-            elapsed_time = now - start_date
-            if amount <= 12:
-                if elapsed_time <= timedelta(hours=24):
-                    total_amount = amount
-                    remaining_time = timedelta(hours=24) - elapsed_time
-                else:
-                    periods = (elapsed_time - timedelta(hours=24)) // timedelta(hours=24)
-                    total_amount = amount * (1 + (periods + 1) * 0.25)
-                    remaining_time = timedelta(hours=24) - ((elapsed_time - timedelta(hours=24)) % timedelta(hours=24))
-            else:
-                if elapsed_time <= timedelta(hours=48):
-                    total_amount = amount
-                    remaining_time = timedelta(hours=48) - elapsed_time
-                else:
-                    periods = (elapsed_time - timedelta(hours=48)) // timedelta(hours=72)
-                    total_amount = amount * (1 + (periods + 1) * 0.25)
-                    remaining_time = timedelta(hours=72) - ((elapsed_time - timedelta(hours=48)) % timedelta(hours=72))
-            try:
-                user_info = bot.get_chat_member(chat_id=message.chat.id, user_id=user_id).user
-                user_name = user_info.first_name
-                debts_text += f"{user_name}: {total_amount:.2f} монет, следующее увеличение через: {remaining_time}\n"
-            except ApiTelegramException:
-                debts_text += f"Пользователь {user_id}: {total_amount:.2f} монет, следующее увеличение через: {remaining_time}\n"
+        _, user_ids, amounts, start_dates = zip(*loans)
+        now = time.time()
+        debts = debt_schedule_batch(amounts, [start_date.timestamp() for start_date in start_dates], now)
+        for user_id, total_amount, next_increase in zip(user_ids, debts.total, debts.next_increase):
+            remaining_time = timedelta(seconds=float(next_increase - now))
+            user_name = names[user_id]
+            debts_text += f"{user_name}: {total_amount:.2f} монет, следующее увеличение через: {remaining_time}\n"
     else:
         debts_text = "Нет активных долгов"
+    return debts_text
+
+
+@bot.message_handler(commands=['debts'])
+@replica_reads
+def show_debts(message):
+    send_page(message, *debts_page(message.chat.id))
+
 
-    bot.reply_to(message, debts_text)
+@callbacks.route('debtpage', str, parse_cursor)
+@replica_reads
+def page_debts(call, direction, cursor):
+    send_page(call.message, *debts_page(call.message.chat.id, direction, cursor), edit=True)
 
 
 @bot.message_handler(commands=['send'])
@@ -474,54 +535,36 @@ def send_money(message):
     markup = InlineKeyboardMarkup()
     markup.add(InlineKeyboardButton("Банк", callback_data="send_bank"))
     session = create_connection()
-    users = session.execute(text("SELECT user_id FROM accounts WHERE user_id != 0")).fetchall()
+    user_ids = AccountsRepo(session).client_ids()
     session.close()
-    for user in users:
-        user_id = user[0]
-        try:
-            user_info = bot.get_chat_member(chat_id=message.chat.id, user_id=user_id).user
-            user_name = user_info.first_name
-            markup.add(InlineKeyboardButton(user_name, callback_data=f"send_{user_id}"))
-        except ApiTelegramException:
-            markup.add(InlineKeyboardButton(f"Пользователь {user_id}", callback_data=f"send_{user_id}"))
-    bot.reply_to(message, "Выберите получателя:", reply_markup=markup)
+    for user_id, user_name in get_user_names(message.chat.id, user_ids).items():
+        markup.add(InlineKeyboardButton(user_name, callback_data=f"send_{user_id}"))
+    outbox.reply_to(message, "Выберите получателя:", reply_markup=markup)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('send_'))
-def select_recipient(call):
-    recipient_id = call.data.split('_')[1]
-    bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
-    bot.send_message(chat_id=call.message.chat.id, text=f"Введите сумму для отправки {recipient_id}:")
-    bot.register_next_step_handler(call.message, process_amount, recipient_id)
+@callbacks.route('send', str)
+def select_recipient(call, recipient_id):
+    outbox.replace(call.message, f"Введите сумму для отправки {recipient_id}:")
+    conversations.set(call.message.chat.id, process_amount, recipient_id=recipient_id)
 
 
+@conversations.step
 def process_amount(message, recipient_id):
     try:
         amount = float(message.text)
         user_id = message.from_user.id
+        recipient = BANK_ID if recipient_id == "bank" else int(recipient_id)
         session = create_connection()
-        user_balance = session.execute(text("SELECT balance FROM accounts "
-                                            "WHERE user_id = :user_id"), {'user_id': user_id}).fetchone()[0]
-        if user_balance >= amount:
-            session.execute(text("UPDATE accounts SET balance = balance - :amount WHERE user_id = :user_id"),
-                            {'amount': amount, 'user_id': user_id}
-                            )
-            if recipient_id == "bank":
-                session.execute(text("UPDATE accounts SET balance = balance + :amount WHERE user_id = 0"),
-                                {'amount', amount}
-                                )
-            else:
-                session.execute(text("UPDATE accounts SET balance = balance + :amount WHERE user_id = :user_id"),
-                                {'amount': amount, 'user_id': int(recipient_id)}
-                                )
+        if transfer(session, user_id, recipient, amount, memo="send"):
             session.commit()
             recipient_name = "банк" if recipient_id == "bank" else recipient_id
-            bot.send_message(chat_id=message.chat.id, text=f"Вы успешно отправили {amount} монет {recipient_name}.")
+            outbox.send_message(chat_id=message.chat.id, text=f"Вы успешно отправили {amount} монет {recipient_name}.")
         else:
-            bot.send_message(chat_id=message.chat.id, text="У вас недостаточно средств для отправки этой суммы.")
+            session.rollback()
+            outbox.send_message(chat_id=message.chat.id, text="У вас недостаточно средств для отправки этой суммы.")
         session.close()
     except ValueError:
-        bot.send_message(chat_id=message.chat.id, text="Пожалуйста, введите корректную сумму.")
+        outbox.send_message(chat_id=message.chat.id, text="Пожалуйста, введите корректную сумму.")
 
 
 @bot.message_handler(commands=['add_service'])
@@ -529,64 +572,52 @@ def add_service(message):
     markup = InlineKeyboardMarkup()
     markup.add(InlineKeyboardButton("Buy", callback_data="add_buy"))
     markup.add(InlineKeyboardButton("Sell", callback_data="add_sell"))
-    bot.reply_to(message, "Выберите категорию для добавления услуги:", reply_markup=markup)
+    outbox.reply_to(message, "Выберите категорию для добавления услуги:", reply_markup=markup)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('add_'))
-def select_category(call):
-    category = call.data.split('_')[1]
-    bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
-    bot.send_message(chat_id=call.message.chat.id, text=f"Введите название услуги и ее стоимость для {category}:")
-    bot.register_next_step_handler(call.message, process_service, category)
+@callbacks.route('add', str)
+def select_category(call, category):
+    outbox.replace(call.message, f"Введите название услуги и ее стоимость для {category}:")
+    conversations.set(call.message.chat.id, process_service, category=category)
 
 
+@conversations.step
 def process_service(message, category):
     try:
         message_text = message.text
         service_name, price = message_text.split(',')
         price = float(price.strip())
+        if not price > 0:
+            outbox.send_message(chat_id=message.chat.id, text="Стоимость услуги должна быть больше нуля.")
+            return
         session = create_connection()
-        session.execute(
-            text(
-                "INSERT INTO services (service_name, price, type) VALUES (:service_name, :price, :type)"
-            ),
-            {'service_name': service_name.strip(), 'price': price, 'type': category}
-        )
+        ServicesRepo(session).add(service_name.strip(), price, category)
         session.commit()
         session.close()
-        bot.send_message(chat_id=message.chat.id,
-                         text=f"Услуга '{service_name.strip()}' стоимостью {price} монет "
-                              f"успешно добавлена в категорию {category}.")
+        service_catalog.invalidate()
+        outbox.send_message(chat_id=message.chat.id,
+                            text=f"Услуга '{service_name.strip()}' стоимостью {price} монет "
+                                 f"успешно добавлена в категорию {category}.")
     except ValueError:
-        bot.send_message(chat_id=message.chat.id,
-                         text="Пожалуйста, введите корректное название и "
-                              "стоимость услуги в формате: название, стоимость.")
+        outbox.send_message(chat_id=message.chat.id,
+                            text="Пожалуйста, введите корректное название и "
+                                 "стоимость услуги в формате: название, стоимость.")
 
 
 # Обработчик команды /remove_service
 @bot.message_handler(commands=['remove_service'])
 def remove_service(message):
-    session = create_connection()
-    services = session.execute(text("SELECT service_id, service_name FROM services")).fetchall()
-    session.close()
-    markup = InlineKeyboardMarkup()
-    for service in services:
-        service_id, service_name = service
-        markup.add(InlineKeyboardButton(f"{service_name}", callback_data=f"remove_{service_id}"))
-    bot.reply_to(message, "Выберите услугу для удаления:", reply_markup=markup)
+    outbox.reply_to(message, "Выберите услугу для удаления:", reply_markup=service_catalog.keyboard('remove'))
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('remove_'))
-def handle_remove_service(call):
-    service_id = int(call.data.split('_')[1])
+@callbacks.route('remove', int)
+def handle_remove_service(call, service_id):
     session = create_connection()
-    session.execute(text("DELETE FROM services WHERE service_id = :service_id"),
-                    {'service_id': service_id}
-                    )
+    ServicesRepo(session).remove(service_id)
     session.commit()
     session.close()
-    bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
-    bot.send_message(chat_id=call.message.chat.id, text="Услуга успешно удалена.")
+    service_catalog.invalidate()
+    outbox.replace(call.message, "Услуга успешно удалена.")
 
 
 @bot.message_handler(commands=['help'])
@@ -614,152 +645,150 @@ def send_help(message):
         "Дополнительная информация:\n\n"
         "Со всех buy операций 25% идет в банк, кроме Экспресс услуг, за них 100% идет банку."
     )
-    bot.reply_to(message, help_text)
+    outbox.reply_to(message, help_text)
 
 
 @bot.message_handler(commands=['waiting_list'])
+@replica_reads
 def show_waiting_list(message):
-    markup = InlineKeyboardMarkup()
     session = create_connection()
-    users = session.execute(text("SELECT user_id FROM accounts WHERE user_id != 0")).fetchall()
+    user_ids = AccountsRepo(session).client_ids()
     session.close()
-    for user in users:
-        user_id = user[0]
-        try:
-            user_info = bot.get_chat_member(chat_id=message.chat.id, user_id=user_id).user
-            user_name = user_info.first_name
-            markup.add(InlineKeyboardButton(user_name, callback_data=f"waiting_{user_id}"))
-        except ApiTelegramException:
-            markup.add(InlineKeyboardButton(f"Пользователь {user_id}", callback_data=f"waiting_{user_id}"))
-    bot.reply_to(message, "Выберите пользователя, чтобы увидеть его список дел:", reply_markup=markup)
+    markup = user_keyboard('waiting', get_user_names(message.chat.id, user_ids))
+    outbox.reply_to(message, "Выберите пользователя, чтобы увидеть его список дел:", reply_markup=markup)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('waiting_'))
-def show_user_tasks(call):
-    user_id = call.data.split('_')[1]
+@callbacks.route('waiting', int)
+@replica_reads
+def show_user_tasks(call, user_id):
     session = create_connection()
-    tasks = session.execute(text("SELECT service_id, service_name FROM completed_services "
-                            "WHERE user_id = :user_id AND status = :status"),
-                            {'user_id': user_id, 'status': 'active'}).fetchall()
+    tasks = CompletedServicesRepo(session).active_for_user(user_id)
     session.close()
     markup = InlineKeyboardMarkup()
-    bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
     if tasks:
         for task in tasks:
             service_id, service_name = task
             markup.add(InlineKeyboardButton(service_name, callback_data=f"task_{service_id}_{user_id}"))
-        bot.send_message(chat_id=call.message.chat.id, text="Список дел пользователя:", reply_markup=markup)
+        outbox.replace(call.message, "Список дел пользователя:", reply_markup=markup)
     else:
-        bot.send_message(chat_id=call.message.chat.id, text="У пользователя нет дел.")
+        outbox.replace(call.message, "У пользователя нет дел.")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('task_'))
-def handle_task(call):
-    service_id, task_user_id = call.data.split('_')[1], call.data.split('_')[2]
-    if call.from_user.id != int(task_user_id):
+@callbacks.route('task', int, int)
+def handle_task(call, service_id, task_user_id):
+    if call.from_user.id != task_user_id:
         session = create_connection()
-        session.execute(text("UPDATE completed_services SET status = :status, end_date = :end_date"
-                             " WHERE service_id = :service_id"),
-                        {'status': 'closed',
-                         'end_date': datetime.now().strftime("%Y-%m-%d %H:%M"),
-                         'service_id': service_id
-                         }
-                        )
+        CompletedServicesRepo(session).close(service_id, datetime.now().astimezone())
         session.commit()
         session.close()
-        bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
-        bot.send_message(chat_id=call.message.chat.id, text="Дело успешно закончено.")
+        outbox.replace(call.message, "Дело успешно закончено.")
     else:
         bot.answer_callback_query(call.id, "Вы не можете удалить свое собственное дело.")
 
 
-@bot.message_handler(commands=['transactions'])
-def show_transactions(message):
+TRANSACTIONS_SELECT = """
+    SELECT
+        a.service_id,
+        a.user_id,
+        a.service_name,
+        a.type,
+        a.price,
+        a.end_date AS closed_date
+    FROM completed_services a
+    JOIN accounts b ON a.user_id = b.user_id
+    WHERE a.status = 'closed'
+"""
+
+transactions_pager = KeysetPager(
+    'txpage',
+    first=text(TRANSACTIONS_SELECT + " ORDER BY a.end_date, a.service_id LIMIT :limit"),
+    after=text(TRANSACTIONS_SELECT + " AND (a.end_date, a.service_id) > (:end_date, :service_id)"
+                                     " ORDER BY a.end_date, a.service_id LIMIT :limit"),
+    before=text(TRANSACTIONS_SELECT + " AND (a.end_date, a.service_id) < (:end_date, :service_id)"
+                                      " ORDER BY a.end_date DESC, a.service_id DESC LIMIT :limit"),
+    to_cursor=lambda transaction: (timestamp_to_cursor(transaction.closed_date), transaction.service_id),
+    from_cursor=lambda cursor: {'end_date': cursor_to_timestamp(cursor[0]), 'service_id': cursor[1]},
+)
+
+
+def transactions_page(chat_id, direction='first', cursor=None):
     session = create_connection()
-    transactions = session.execute(text("""
-        SELECT 
-            a.user_id,
-            a.service_name,
-            a.type,
-            a.price,
-            TO_CHAR(a.end_date::timestamp, 'YYYY-MM-DD HH24:MI') AS closed_date
-        FROM completed_services a
-        JOIN accounts b ON a.user_id = b.user_id
-        WHERE a.status = 'closed'
-    """)).fetchall()
+    transactions, markup = transactions_pager.fetch(session, direction, cursor)
     session.close()
+    names = get_user_names(chat_id, [transaction.user_id for transaction in transactions], full=True)
+    return format_transactions(transactions, names), markup
 
+
+def format_transactions(transactions, names):
     if transactions:
         transactions_text = "Завершенные услуги:\n"
         for transaction in transactions:
-            user_id = transaction[0]
-            service_name = transaction[1]
-            service_type = transaction[2]
-            closed_date = transaction[4]
-
-            try:
-                user_info = bot.get_chat_member(chat_id=message.chat.id, user_id=user_id).user
-                user_name = user_info.first_name
-                if user_info.last_name:
-                    user_name += f" {user_info.last_name}"
-            except ApiTelegramException:
-                user_name = f"Пользователь {user_id}"
+            user_id = transaction.user_id
+            service_name = transaction.service_name
+            service_type = transaction.type
+            closed_date = transaction.closed_date.astimezone().strftime("%Y-%m-%d %H:%M")
 
+            user_name = names[user_id]
             transactions_text += f"{user_name}, {service_name}, {service_type}, {closed_date}\n"
     else:
         transactions_text = "Нет завершенных услуг"
+    return transactions_text
 
-    bot.reply_to(message, transactions_text)
 
+@bot.message_handler(commands=['transactions'])
+@replica_reads
+def show_transactions(message):
+    send_page(message, *transactions_page(message.chat.id))
 
-def update_loans():
-    while True:
-        session = create_connection()
-        loans = session.execute(text("SELECT loan_id, user_id, amount, start_date, interest_rate FROM loans"
-                             " WHERE status = 'active'")).fetchall()
-        for loan in loans:
-            loan_id, user_id, amount, start_date, interest_rate = loan
-            start_date = datetime.strptime(start_date, "%Y-%m-%d")
-            now = datetime.now()
-            elapsed_time = now - start_date
-
-            if amount <= 12:
-                if elapsed_time > timedelta(hours=24):
-                    new_interest_rate = interest_rate + 0.25 * (
-                            (elapsed_time - timedelta(hours=24)) // timedelta(hours=24) + 1)
-                    session.execute(text("UPDATE loans SET status = 'closed' WHERE loan_id = :loan_id"),
-                                    {'loan_id': loan_id}
-                                    )
-                    session.execute(text(
-                        "INSERT INTO loans (user_id, amount, start_date, interest_rate, status)"
-                        " VALUES (:user_id, :amount, :start_date, :interest_rate, 'active')"),
-                        {'user_id': user_id,
-                         'amount': amount,
-                         'start_date': now.strftime("%Y-%m-%d"),
-                         'interest_rate': new_interest_rate
-                         }
-                    )
-            else:
-                if elapsed_time > timedelta(hours=48):
-                    new_interest_rate = interest_rate + 0.25 * (
-                            (elapsed_time - timedelta(hours=48)) // timedelta(hours=72) + 1)
-                    session.execute(text("UPDATE loans SET status = 'closed' WHERE loan_id = :loan_id"),
-                                    {'loan_id': loan_id})
-                    session.execute(text(
-                        "INSERT INTO loans (user_id, amount, start_date, interest_rate, status)"
-                        " VALUES (:user_id, :amount, :start_date, :interest_rate, 'active')"),
-                        {'user_id': user_id,
-                         'amount': amount,
-                         'start_date': now.strftime("%Y-%m-%d"),
-                         'interest_rate': new_interest_rate
-                         }
-                    )
-        session.commit()
-        session.close()
-        time.sleep(60)
 
+@callbacks.route('txpage', str, parse_cursor)
+@replica_reads
+def page_transactions(call, direction, cursor):
+    send_page(call.message, *transactions_page(call.message.chat.id, direction, cursor), edit=True)
+
+
+# Все callback-запросы проходят через один обработчик и маршрутизатор
+@bot.callback_query_handler(func=lambda call: True)
+def route_callback(call):
+    logger.debug("Callback received", extra={'data': call.data})
+    callbacks.dispatch(call)
+
+
+scope_sessions(bot)
+instrument_bot(bot)
+
+app_ready = False
+app_lock = threading.Lock()
+
+
+# Подготовка процесса к работе: логирование, замер вызовов API и приведение схемы базы к
+# последней версии. Импорт модуля ничего из этого не делает и к базе не подключается, так что
+# обработчики можно импортировать в бенчмарках; фоновые задачи запускает main(). Повторный вызов
+# ничего не делает.
+def create_app():
+    global app_ready
+    with app_lock:
+        if not app_ready:
+            setup_logging()
+            instrument_api()
+            migrate()
+            app_ready = True
+    return bot
+
+
+# Многопоточный режим (BOT_RUNTIME=threaded)
+def main():
+    create_app()
+    start_server(METRICS_HOST, METRICS_PORT)
+    install_profile_signal(PROFILE_UPDATES)
+    loan_lease.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: bot.stop_polling())
+    try:
+        bot.infinity_polling(none_stop=True)
+    finally:
+        bot.stop_bot()
+        loan_lease.stop()
 
-loan_thread = threading.Thread(target=update_loans)
-loan_thread.start()
 
-bot.infinity_polling(none_stop=True)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import namedtuple
+
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from database import get_session
+from repository import ServicesRepo
+
+Service = namedtuple('Service', ['service_id', 'service_name', 'price', 'type'])
+
+# Какие услуги попадают в клавиатуру, как подписана кнопка и какой у нее callback
+KEYBOARDS = {
+    'buy': (lambda service: service.type == 'buy',
+            lambda service: f"{service.service_name} - {service.price}",
+            'buy'),
+    'sell': (lambda service: service.type == 'sell',
+             lambda service: f"{service.service_name} - {service.price}",
+             'sell'),
+    'remove': (lambda service: True,
+               lambda service: f"{service.service_name}",
+               'remove'),
+}
+
+
+# Каталог услуг в памяти процесса: готовые клавиатуры /buy, /sell и /remove_service.
+# Запись в services должна вызывать invalidate(); ttl ограничивает устаревание,
+# если каталог поменял другой процесс. Поэтому цену и наличие услуги при покупке
+# и продаже обработчики читают из базы, а не из каталога.
+class ServiceCatalog:
+    def __init__(self, session_factory=get_session, ttl=300):
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._services = None
+        self._keyboards = None
+        self._loaded_at = 0
+
+    def _load(self):
+        with self._lock:
+            if self._services is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return self._services, self._keyboards
+            session = self.session_factory()
+            rows = ServicesRepo(session).all()
+            session.close()
+            services = {row[0]: Service(*row) for row in rows}
+            keyboards = {}
+            for kind, (include, label, action) in KEYBOARDS.items():
+                markup = InlineKeyboardMarkup()
+                for service in services.values():
+                    if include(service):
+                        markup.add(InlineKeyboardButton(label(service),
+                                                        callback_data=f"{action}_{service.service_id}"))
+                keyboards[kind] = markup
+            self._services, self._keyboards, self._loaded_at = services, keyboards, time.monotonic()
+            return services, keyboards
+
+    def keyboard(self, kind):
+        _, keyboards = self._load()
+        return keyboards[kind]
+
+    def invalidate(self):
+        with self._lock:
+            self._services = None
+            self._keyboards = None
@@ -6,3 +6,104 @@ load_dotenv()
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
+
+# Реплика только для чтения (пустая — все запросы идут в основную базу), размеры пулов
+# соединений основной базы и реплики и сколько секунд после записи чата его списки читаются
+# из основной базы, пока реплика не догнала ее
+DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL', '')
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+REPLICA_POOL_SIZE = int(os.environ.get('REPLICA_POOL_SIZE', 5))
+REPLICA_MAX_OVERFLOW = int(os.environ.get('REPLICA_MAX_OVERFLOW', 10))
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+
+# Оба пула: сколько секунд ждать свободного соединения, через сколько секунд заменять
+# соединение (раньше, чем его закроет сервер или балансировщик) и проверять ли соединение
+# запросом перед выдачей из пула (1 — да)
+DATABASE_POOL_TIMEOUT = float(os.environ.get('DATABASE_POOL_TIMEOUT', 30))
+DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE', 30 * 60))
+DATABASE_POOL_PRE_PING = os.environ.get('DATABASE_POOL_PRE_PING', '1') == '1'
+
+# SQLite (DATABASE_URL=sqlite:///bank.db, один процесс бота): PRAGMA каждого соединения
+SQLITE_PRAGMAS = os.environ.get('SQLITE_PRAGMAS', 'journal_mode=WAL,synchronous=NORMAL,busy_timeout=10000,'
+                                                  'cache_size=-16000,temp_store=MEMORY,mmap_size=134217728')
+
+# Кэш имен участников чата (секунды)
+NAME_CACHE_SIZE = int(os.environ.get('NAME_CACHE_SIZE', 1024))
+NAME_CACHE_TTL = int(os.environ.get('NAME_CACHE_TTL', 3600))
+NAME_CACHE_NEGATIVE_TTL = int(os.environ.get('NAME_CACHE_NEGATIVE_TTL', 300))
+
+# Время жизни каталога услуг в памяти (секунды)
+CATALOG_TTL = int(os.environ.get('CATALOG_TTL', 300))
+
+# Хранилище ожидающих подтверждения действий: memory или db (обязательно при BOT_PROCESSES > 1)
+PENDING_STORE = os.environ.get('PENDING_STORE', 'memory')
+PENDING_TTL = int(os.environ.get('PENDING_TTL', 24 * 60 * 60))
+
+# Незавершенные диалоги: время жизни (секунды) и размер кэша в памяти
+CONVERSATION_TTL = int(os.environ.get('CONVERSATION_TTL', 15 * 60))
+CONVERSATION_CACHE_SIZE = int(os.environ.get('CONVERSATION_CACHE_SIZE', 1000))
+
+# Режим работы: threaded (TeleBot с пулом потоков) или async (AsyncTeleBot)
+BOT_RUNTIME = os.environ.get('BOT_RUNTIME', 'threaded')
+# Сколько запросов к API в асинхронном режиме один список может делать одновременно
+ASYNC_API_CONCURRENCY = int(os.environ.get('ASYNC_API_CONCURRENCY', 16))
+
+# Получение апдейтов: polling (infinity_polling) или webhook (локальный HTTP-сервер)
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+# Публичный адрес вебхука для setWebhook; пустой — вебхук уже настроен снаружи
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', os.environ.get('PORT', 8080)))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 1000))
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 8))
+# Число процессов бота в режиме webhook: все слушают один порт (SO_REUSEPORT). Ядро раздает
+# соединения процессам без учета чата, поэтому порядок апдейтов одного чата соблюдается
+# только внутри процесса
+BOT_PROCESSES = int(os.environ.get('BOT_PROCESSES', 1))
+
+# Фоновые задачи выполняет один процесс-лидер: как часто лидер проверяет соединение
+# с блокировкой, как часто остальные пытаются ее взять (секунды) и как часто лидер
+# перечитывает активные кредиты, взятые через другие процессы
+LEADER_HEARTBEAT = float(os.environ.get('LEADER_HEARTBEAT', 5))
+LEADER_RETRY = float(os.environ.get('LEADER_RETRY', 5))
+LOAN_RELOAD_INTERVAL = float(os.environ.get('LOAN_RELOAD_INTERVAL', 5 * 60))
+
+# Адрес Bot API вида http://host:port/bot{0}/{1}, например для локальной заглушки
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+
+# Диспетчер апдейтов: число потоков (0 — общий пул TeleBot без порядка), ключ
+# упорядочивания chat или user, размер очереди потока и порог предупреждения о задержке
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', 8))
+DISPATCH_KEY = os.environ.get('DISPATCH_KEY', 'chat')
+DISPATCH_QUEUE_SIZE = int(os.environ.get('DISPATCH_QUEUE_SIZE', 100))
+DISPATCH_LAG_WARNING = float(os.environ.get('DISPATCH_LAG_WARNING', 5))
+
+# Лимиты исходящих сообщений Telegram (вызовов в секунду и размер всплеска)
+OUTBOX_GLOBAL_RATE = float(os.environ.get('OUTBOX_GLOBAL_RATE', 30))
+OUTBOX_CHAT_RATE = float(os.environ.get('OUTBOX_CHAT_RATE', 1))
+OUTBOX_CHAT_BURST = int(os.environ.get('OUTBOX_CHAT_BURST', 3))
+OUTBOX_GROUP_RATE = float(os.environ.get('OUTBOX_GROUP_RATE', 20 / 60))
+OUTBOX_GROUP_BURST = int(os.environ.get('OUTBOX_GROUP_BURST', 20))
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 — не публиковать)
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9108))
+
+# Трассировка апдейтов: апдейты не быстрее TRACE_SLOW_MS (мс) пишутся в файл JSONL TRACE_FILE
+# (пустой — не писать), в трассе не больше TRACE_MAX_SPANS отрезков
+TRACE_FILE = os.environ.get('TRACE_FILE', 'slow_updates.jsonl')
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', 1000))
+TRACE_MAX_SPANS = int(os.environ.get('TRACE_MAX_SPANS', 500))
+# Профилирование по сигналу SIGUSR1: сколько следующих апдейтов профилировать и куда сохранить
+PROFILE_UPDATES = int(os.environ.get('PROFILE_UPDATES', 100))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '.')
+
+# Логирование: корневой уровень, уровни подсистем вида "sqlalchemy.engine=INFO,outbox=DEBUG"
+# (SQL-запросы пишутся при sqlalchemy.engine=INFO), доля выводимых DEBUG-записей и размер
+# очереди записей, при переполнении которой записи отбрасываются
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.environ.get('LOG_LEVELS', 'sqlalchemy=WARNING')
+LOG_DEBUG_SAMPLE = float(os.environ.get('LOG_DEBUG_SAMPLE', 0.1))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
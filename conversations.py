@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import text
+
+from database import expires_at, get_session
+
+State = namedtuple('State', ['step', 'args'])
+
+SAVE_STATE = text("""
+    INSERT INTO conversations (chat_id, step, args, expires_at)
+    VALUES (:chat_id, :step, :args, :expires_at)
+    ON CONFLICT (chat_id) DO UPDATE SET
+        step = EXCLUDED.step, args = EXCLUDED.args, expires_at = EXCLUDED.expires_at
+""")
+PRUNE_STATES = text("DELETE FROM conversations WHERE expires_at <= now()")
+SELECT_STATE = text("SELECT step, args FROM conversations WHERE chat_id = :chat_id AND expires_at > now()")
+POP_STATE = text("DELETE FROM conversations WHERE chat_id = :chat_id AND expires_at > now()"
+                 " RETURNING step, args")
+
+
+# Состояние многошаговых диалогов (какой шаг ждет следующее сообщение чата).
+# Хранится в таблице conversations, поэтому переживает перезапуск; в памяти — только
+# ограниченный LRU-кэш (включая отметки "состояния нет"), так что брошенные диалоги
+# не копят память, а истекшие удаляются из таблицы по TTL. maxsize=0 отключает кэш: так
+# делают при нескольких процессах бота, где шаг мог задать или забрать другой процесс.
+# wrap(name, func), если задан, оборачивает функции шагов при регистрации.
+class ConversationStore:
+    def __init__(self, session_factory=get_session, ttl=15 * 60, maxsize=1000, prune_every=100, wrap=None):
+        self.session_factory = session_factory
+        self.wrap = wrap
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.prune_every = prune_every
+        self.steps = {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    # Регистрирует функцию шага по имени, чтобы ее можно было найти после перезапуска
+    def step(self, func):
+        self.steps[func.__name__] = self.wrap(func.__name__, func) if self.wrap is not None else func
+        return func
+
+    def _remember(self, chat_id, state):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._cache[chat_id] = (time.monotonic() + self.ttl, state)
+            self._cache.move_to_end(chat_id)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def _cached(self, chat_id):
+        with self._lock:
+            entry = self._cache.get(chat_id)
+            if entry is None:
+                return False, None
+            if entry[0] <= time.monotonic():
+                del self._cache[chat_id]
+                return True, None
+            self._cache.move_to_end(chat_id)
+            return True, entry[1]
+
+    def set(self, chat_id, step, **args):
+        session = self.session_factory()
+        session.execute(SAVE_STATE, {'chat_id': chat_id, 'step': step.__name__, 'args': json.dumps(args),
+                                     'expires_at': expires_at(self.ttl)})
+        self._writes += 1
+        if self._writes % self.prune_every == 0:
+            session.execute(PRUNE_STATES)
+        session.commit()
+        session.close()
+        self._remember(chat_id, State(step.__name__, args))
+
+    def get(self, chat_id):
+        found, state = self._cached(chat_id)
+        if found:
+            return state
+        session = self.session_factory()
+        row = session.execute(SELECT_STATE, {'chat_id': chat_id}).fetchone()
+        session.close()
+        state = State(row[0], json.loads(row[1])) if row else None
+        self._remember(chat_id, state)
+        return state
+
+    # Забирает состояние чата; следующий шаг получит только одно сообщение
+    def pop(self, chat_id):
+        if self.get(chat_id) is None:
+            return None
+        session = self.session_factory()
+        row = session.execute(POP_STATE, {'chat_id': chat_id}).fetchone()
+        session.commit()
+        session.close()
+        self._remember(chat_id, None)
+        return State(row[0], json.loads(row[1])) if row else None
+
+    # Продолжает диалог чата: вызывает сохраненный шаг с сообщением и его аргументами
+    def resume(self, message):
+        state = self.pop(message.chat.id)
+        if state is None or state.step not in self.steps:
+            return False
+        self.steps[state.step](message, **state.args)
+        return True
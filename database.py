@@ -1,15 +1,149 @@
-from sqlalchemy import create_engine
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from functools import lru_cache, wraps
+
+from sqlalchemy import TextClause, create_engine, event, make_url, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import Session as BaseSession, sessionmaker, scoped_session
 
-from config import DATABASE_URL
+from config import (DATABASE_MAX_OVERFLOW, DATABASE_POOL_PRE_PING, DATABASE_POOL_RECYCLE, DATABASE_POOL_SIZE,
+                    DATABASE_POOL_TIMEOUT, DATABASE_REPLICA_URL, DATABASE_URL, REPLICA_MAX_OVERFLOW,
+                    REPLICA_POOL_SIZE, REPLICA_STICKY_SECONDS)
+from db_url import sync_url
+from metrics import instrument_engine, instrument_pool
+from tracing import current_trace
 
 Base = declarative_base()
 
 DATABASE_URL = DATABASE_URL
 
-engine = create_engine(DATABASE_URL, echo=True)
-session_factory = sessionmaker(bind=engine)
+DIALECT = make_url(DATABASE_URL).get_backend_name()
+
+
+# Размеры пулов основной базы и реплики и общие настройки выдачи соединений
+PRIMARY_POOL = {'pool_size': DATABASE_POOL_SIZE, 'max_overflow': DATABASE_MAX_OVERFLOW,
+                'pool_timeout': DATABASE_POOL_TIMEOUT, 'pool_recycle': DATABASE_POOL_RECYCLE,
+                'pool_pre_ping': DATABASE_POOL_PRE_PING}
+REPLICA_POOL = dict(PRIMARY_POOL, pool_size=REPLICA_POOL_SIZE, max_overflow=REPLICA_MAX_OVERFLOW)
+
+if DIALECT == 'sqlite':
+    from sqlite_backend import create_sqlite_engine
+
+    # Реплика SQLite — тот же файл: отдельный пул соединений только для чтения, без отставания
+    engine = create_sqlite_engine(DATABASE_URL, **PRIMARY_POOL)
+    replica_engine = create_sqlite_engine(DATABASE_URL, writer=False, **REPLICA_POOL)
+else:
+    engine = create_engine(sync_url(DATABASE_URL), **PRIMARY_POOL)
+    replica_engine = create_engine(sync_url(DATABASE_REPLICA_URL), **REPLICA_POOL) if DATABASE_REPLICA_URL else engine
+instrument_engine(engine)
+instrument_pool(engine, 'primary')
+if replica_engine is not engine:
+    instrument_engine(replica_engine)
+    instrument_pool(replica_engine, 'replica')
+
+
+# Запрос в варианте для СУБД основной базы: dialect_text(postgresql="...", sqlite="...")
+def dialect_text(**variants):
+    return text(variants[DIALECT])
+
+
+# Срок хранения записи считается в Python, чтобы запрос был одинаковым для Postgres и SQLite
+def expires_at(ttl):
+    return datetime.now().astimezone() + timedelta(seconds=ttl)
+
+
+# Обработчик, помеченный replica_reads, читает из реплики
+prefer_replica = ContextVar('prefer_replica', default=False)
+
+LOCKING_READ = re.compile(r'\bFOR\s+(NO\s+KEY\s+)?(UPDATE|SHARE|KEY\s+SHARE)\b', re.IGNORECASE)
+
+# Чаты, которые недавно писали в основную базу: chat_id -> время записи
+recent_writes = OrderedDict()
+recent_writes_lock = threading.Lock()
+RECENT_WRITES_LIMIT = 10000
+
+
+@lru_cache(maxsize=1024)
+def is_read_sql(sql):
+    return sql.lstrip().upper().startswith('SELECT') and not LOCKING_READ.search(sql)
+
+
+# Запрос только читает: SELECT без FOR UPDATE/SHARE
+def is_read(clause):
+    if isinstance(clause, TextClause):
+        return is_read_sql(clause.text)
+    return getattr(clause, 'is_select', False) and getattr(clause, '_for_update_arg', None) is None
+
+
+def current_chat():
+    trace = current_trace.get()
+    return None if trace is None else trace.attrs.get('chat_id')
+
+
+def remember_write(chat_id):
+    with recent_writes_lock:
+        recent_writes[chat_id] = time.monotonic()
+        recent_writes.move_to_end(chat_id)
+        while len(recent_writes) > RECENT_WRITES_LIMIT:
+            recent_writes.popitem(last=False)
+
+
+def wrote_recently(chat_id):
+    with recent_writes_lock:
+        written = recent_writes.get(chat_id)
+    return written is not None and time.monotonic() - written < REPLICA_STICKY_SECONDS
+
+
+# Сессия, которая выбирает базу для каждого запроса. Чтение из реплики разрешено только
+# в обработчиках replica_reads (или сессиям с replica_reads=True), и только пока сессия
+# ничего не записала, а чат не писал в последние REPLICA_STICKY_SECONDS: так и сессия,
+# и следующий апдейт того же чата видят свои записи. Остальное идет в основную базу.
+class RoutingSession(BaseSession):
+    def __init__(self, primary, replica, replica_reads=None, **kwargs):
+        super().__init__(**kwargs)
+        self.primary = primary
+        self.replica = replica
+        self.replica_reads = replica_reads
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.replica is self.primary or self.info.get('wrote'):
+            return self.primary
+        if not is_read(clause):
+            self.info['wrote'] = True
+            return self.primary
+        replica_reads = prefer_replica.get() if self.replica_reads is None else self.replica_reads
+        if replica_reads and not wrote_recently(current_chat()):
+            return self.replica
+        return self.primary
+
+
+# Сессия переиспользуется в потоке (scoped_session): после транзакции признак записи
+# сбрасывается, а чат запоминается, чтобы его ближайшие списки не читали отстающую реплику
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def forget_write(session, transaction):
+    if transaction.parent is None and session.info.pop('wrote', False):
+        chat_id = current_chat()
+        if chat_id is not None:
+            remember_write(chat_id)
+
+
+# Обработчик, который только читает: его SELECT идут в реплику
+def replica_reads(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        token = prefer_replica.set(True)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            prefer_replica.reset(token)
+    return wrapper
+
+
+session_factory = sessionmaker(bind=engine, class_=RoutingSession, primary=engine, replica=replica_engine)
 Session = scoped_session(session_factory)
 
 
@@ -19,3 +153,53 @@ def get_session():
 
 def close_session():
     Session.remove()
+
+
+# Сессия потока живет не дольше одного вызова: после него, даже если он упал,
+# незавершенная транзакция откатывается, а соединение возвращается в пул
+def session_scope(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_session()
+    wrapper.session_scoped = True
+    return wrapper
+
+
+# Оборачивает session_scope все обработчики бота и их фильтры-функции: TeleBot проверяет
+# фильтры в потоке приема апдейтов, а обработчики выполняет в потоках пула или диспетчера
+def scope_sessions(bot):
+    for attribute, handlers in vars(bot).items():
+        if not attribute.endswith('_handlers') or not isinstance(handlers, list):
+            continue
+        for handler in handlers:
+            if not isinstance(handler, dict):
+                continue
+            func = handler.get('function')
+            if func is not None and not getattr(func, 'session_scoped', False):
+                handler['function'] = session_scope(func)
+            check = handler.get('filters', {}).get('func')
+            if check is not None and not getattr(check, 'session_scoped', False):
+                handler['filters']['func'] = session_scope(check)
+
+
+# Асинхронные движки основной базы и реплики для BOT_RUNTIME=async (драйвер asyncpg), создаются
+# только в этом режиме. Асинхронные обработчики выводят списки, поэтому их чтение идет в реплику.
+def create_async_database():
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    async_engine = create_async_engine(make_url(DATABASE_URL).set(drivername='postgresql+asyncpg'), **PRIMARY_POOL)
+    instrument_engine(async_engine.sync_engine)
+    instrument_pool(async_engine.sync_engine, 'async_primary')
+    async_replica = async_engine
+    if DATABASE_REPLICA_URL:
+        async_replica = create_async_engine(make_url(DATABASE_REPLICA_URL).set(drivername='postgresql+asyncpg'),
+                                            **REPLICA_POOL)
+        instrument_engine(async_replica.sync_engine)
+        instrument_pool(async_replica.sync_engine, 'async_replica')
+    session = async_sessionmaker(bind=async_engine, sync_session_class=RoutingSession,
+                                 primary=async_engine.sync_engine, replica=async_replica.sync_engine,
+                                 replica_reads=True)
+    return {async_engine, async_replica}, session
@@ -0,0 +1,10 @@
+from sqlalchemy import make_url
+
+
+# Для postgresql:// без драйвера SQLAlchemy 2.1 выбирает psycopg 3, а в зависимостях бота psycopg2.
+# Модуль ничего не создает при импорте, поэтому его используют и скрипты из benchmarks.
+def sync_url(url):
+    url = make_url(url)
+    if url.drivername == 'postgresql':
+        return url.set(drivername='postgresql+psycopg2')
+    return url
@@ -0,0 +1,43 @@
+from collections import namedtuple
+
+import numpy as np
+
+DAY = 24 * 60 * 60
+
+# Шаг увеличения долга за каждый просроченный период
+INTEREST_STEP = 0.25
+
+SMALL_LOAN_LIMIT = 12
+
+Debt = namedtuple('Debt', ['total', 'increases', 'next_increase'])
+
+
+# Льготный период и период начисления процентов в зависимости от суммы кредита
+def loan_periods(amount):
+    if amount <= SMALL_LOAN_LIMIT:
+        return DAY, DAY
+    return 2 * DAY, 3 * DAY
+
+
+# Долг по кредиту в закрытой форме. start и now — секунды эпохи.
+# increases — сколько раз долг уже увеличивался, next_increase — время следующего увеличения.
+def debt_schedule(amount, start, now, rate=INTEREST_STEP):
+    grace, period = loan_periods(amount)
+    elapsed = now - start
+    if elapsed <= grace:
+        increases = 0
+    else:
+        increases = int((elapsed - grace) // period) + 1
+    return Debt(amount * (1 + increases * rate), increases, start + grace + increases * period)
+
+
+# То же самое для массива кредитов за один векторный проход
+def debt_schedule_batch(amounts, starts, now, rate=INTEREST_STEP):
+    amounts = np.asarray(amounts, dtype=np.float64)
+    starts = np.asarray(starts, dtype=np.float64)
+    small = amounts <= SMALL_LOAN_LIMIT
+    grace = np.where(small, DAY, 2 * DAY)
+    period = np.where(small, DAY, 3 * DAY)
+    elapsed = now - starts
+    increases = np.where(elapsed > grace, (elapsed - grace) // period + 1, 0).astype(np.int64)
+    return Debt(amounts * (1 + increases * rate), increases, starts + grace + increases * period)
@@ -0,0 +1,129 @@
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import telebot
+
+from metrics import DISPATCH_LAG
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+USER_FIELDS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+               'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request')
+
+
+def update_user_id(update):
+    for field in USER_FIELDS:
+        event = getattr(update, field, None)
+        user = getattr(event, 'from_user', None)
+        if user is not None:
+            return user.id
+    return update.update_id
+
+
+def update_chat_id(update):
+    for field in MESSAGE_FIELDS:
+        message = getattr(update, field, None)
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    return update_user_id(update)
+
+
+UPDATE_KEYS = {'chat': update_chat_id, 'user': update_user_id}
+
+
+# Раскладывает задачи по workers очередям по ключу (чат или пользователь): задачи одного
+# ключа всегда попадают в одну очередь и выполняются по порядку, разные ключи — параллельно.
+# Очереди ограничены queue_size, так что при перегрузке submit() ждет, а не копит апдейты.
+# stats() отдает глубину очередей и задержку от постановки в очередь до начала обработки;
+# задержка по шардам также идет в метрику bot_dispatch_lag_seconds.
+class ShardedDispatcher:
+    def __init__(self, workers=8, queue_size=100, lag_warning=5.0, tracked_keys=1000):
+        self.workers = workers
+        self.lag_warning = lag_warning
+        self.tracked_keys = tracked_keys
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = []
+        self._lag = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._threads = [threading.Thread(target=self._work, args=(i, shard), name=f'dispatch-{i}', daemon=True)
+                             for i, shard in enumerate(self.queues)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key, task, *args):
+        if not self._threads:
+            self.start()
+        self.queues[hash(key) % self.workers].put((time.monotonic(), key, task, args))
+
+    def _work(self, index, shard):
+        label = str(index)
+        while True:
+            item = shard.get()
+            if item is None:
+                return
+            enqueued_at, key, task, args = item
+            lag = time.monotonic() - enqueued_at
+            DISPATCH_LAG.observe(label, value=lag)
+            self._record_lag(key, lag)
+            try:
+                task(*args)
+            except Exception:
+                logger.exception("Dispatched task failed", extra={'key': key})
+
+    def _record_lag(self, key, lag):
+        if lag >= self.lag_warning:
+            logger.warning("Update waited in the dispatch queue", extra={'key': key, 'lag': round(lag, 3)})
+        with self._lock:
+            last, worst = self._lag.pop(key, (0.0, 0.0))
+            self._lag[key] = (lag, max(worst, lag))
+            while len(self._lag) > self.tracked_keys:
+                self._lag.popitem(last=False)
+
+    # Глубина каждой очереди и задержки недавно активных ключей: {key: (последняя, максимальная)}
+    def stats(self):
+        with self._lock:
+            lag = dict(self._lag)
+        return {'queue_depth': [shard.qsize() for shard in self.queues], 'lag': lag}
+
+    # Дожидается обработки уже поставленных задач
+    def stop(self):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        if not threads:
+            return
+        for shard in self.queues:
+            shard.put(None)
+        for thread in threads:
+            thread.join()
+
+
+# TeleBot, который вместо общего пула потоков выполняет апдейты через ShardedDispatcher:
+# апдейты одного чата (key='chat') или пользователя (key='user') обрабатываются строго
+# по порядку, поэтому шаги диалога не обгоняют друг друга.
+class ShardedTeleBot(telebot.TeleBot):
+    def __init__(self, token, workers=8, key='chat', queue_size=100, lag_warning=5.0, **kwargs):
+        super().__init__(token, threaded=False, **kwargs)
+        self.update_key = UPDATE_KEYS[key]
+        self.dispatcher = ShardedDispatcher(workers, queue_size, lag_warning)
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            # Смещение для getUpdates сдвигается сразу, а не после обработки в очереди
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            self.dispatcher.submit(self.update_key(update), super().process_new_updates, [update])
+
+    def stop_bot(self):
+        self.stop_polling()
+        self.dispatcher.stop()
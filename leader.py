@@ -0,0 +1,112 @@
+import logging
+import threading
+
+from sqlalchemy import text
+
+from metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки фоновых задач (начисление процентов): "loan" в ASCII
+BACKGROUND_LOCK_ID = 0x6c6f616e
+
+# Базу SQLite использует один процесс бота, поэтому там аренда достается ему сразу
+TRY_LOCK = {
+    'postgresql': "SELECT pg_try_advisory_lock(:lock_id)",
+    'sqlite': "SELECT :lock_id IS NOT NULL",
+}
+
+IS_LEADER = Gauge('bot_leader', "1 if this process holds the background jobs lease")
+
+
+# Аренда фоновых задач среди нескольких процессов бота. Процесс, которому досталась
+# advisory-блокировка Postgres, держит ее на отдельном соединении и выполняет on_acquire;
+# остальные раз в retry секунд пробуют ее взять. Раз в heartbeat секунд лидер проверяет
+# соединение: если оно оборвалось, блокировка уже снята базой, и процесс вызывает on_release.
+# Когда процесс лидера завершается или теряет связь с базой, блокировку берет другой процесс.
+class LeaderLease:
+    def __init__(self, engine, on_acquire, on_release, lock_id=BACKGROUND_LOCK_ID, heartbeat=5, retry=5):
+        self.engine = engine
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.lock_id = lock_id
+        self.heartbeat = heartbeat
+        self.retry = retry
+        self.leader = False
+        self._connection = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        IS_LEADER.set(value=0)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='leader-lease', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if self.leader:
+                alive = self._check()
+            else:
+                alive = self._try_acquire()
+            if self.leader and not alive:
+                logger.warning("Lost the background jobs lease")
+                self._release()
+            self._stopped.wait(self.heartbeat if self.leader else self.retry)
+        if self.leader:
+            self._release()
+
+    def _try_acquire(self):
+        try:
+            connection = self.engine.connect()
+        except Exception:
+            logger.exception("Cannot connect to take the background jobs lease")
+            return False
+        try:
+            acquired = connection.execute(text(TRY_LOCK[self.engine.dialect.name]),
+                                          {'lock_id': self.lock_id}).scalar()
+            connection.commit()
+        except Exception:
+            logger.exception("Failed to take the background jobs lease")
+            connection.invalidate()
+            connection.close()
+            return False
+        if not acquired:
+            connection.close()
+            return False
+        self._connection = connection
+        self.leader = True
+        IS_LEADER.set(value=1)
+        logger.info("Took the background jobs lease")
+        try:
+            self.on_acquire()
+        except Exception:
+            logger.exception("Failed to start background jobs")
+            self._release()
+            return False
+        return True
+
+    def _check(self):
+        try:
+            self._connection.execute(text("SELECT 1"))
+            self._connection.commit()
+            return True
+        except Exception:
+            return False
+
+    def _release(self):
+        self.leader = False
+        IS_LEADER.set(value=0)
+        try:
+            self.on_release()
+        finally:
+            # Соединение не возвращается в пул: закрытие сессии Postgres снимает блокировку
+            self._connection.invalidate()
+            self._connection.close()
+            self._connection = None
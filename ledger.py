@@ -0,0 +1,134 @@
+import logging
+from collections import defaultdict
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from database import dialect_text
+
+logger = logging.getLogger(__name__)
+
+# Счет банка
+BANK_ID = 0
+
+# Проверка баланса и оба изменения выполняются одним запросом, который возвращает
+# (user_id, balance) измененных счетов. В Postgres сначала обе строки блокируются
+# в порядке user_id (встречные переводы не дают взаимоблокировки), затем списание
+# проходит только при достаточном балансе и существующем получателе, а зачисление —
+# только если списание прошло. В SQLite транзакция записи уже держит блокировку базы,
+# а условия UPDATE вычисляются до изменения строк.
+TRANSFER = dialect_text(postgresql="""
+    WITH locked AS (
+        SELECT user_id FROM accounts
+        WHERE user_id IN (:from_id, :to_id)
+        ORDER BY user_id
+        FOR UPDATE
+    ), debit AS (
+        UPDATE accounts SET balance = balance - :amount
+        WHERE user_id = :from_id
+          AND (balance >= :amount OR :overdraft)
+          AND EXISTS (SELECT 1 FROM locked WHERE user_id = :to_id)
+        RETURNING user_id, balance
+    ), credit AS (
+        UPDATE accounts SET balance = balance + :amount
+        WHERE user_id = :to_id AND EXISTS (SELECT 1 FROM debit)
+        RETURNING user_id, balance
+    )
+    SELECT user_id, balance FROM debit
+    UNION ALL
+    SELECT user_id, balance FROM credit
+""", sqlite="""
+    UPDATE accounts SET balance = balance + CASE WHEN user_id = :to_id THEN :amount ELSE -:amount END
+    WHERE user_id IN (:from_id, :to_id)
+      AND (SELECT balance >= :amount OR :overdraft FROM accounts WHERE user_id = :from_id)
+      AND (SELECT count(*) FROM accounts WHERE user_id IN (:from_id, :to_id)) = 2
+    RETURNING user_id, balance
+""")
+
+SET_BALANCE = text("UPDATE accounts SET balance = :amount WHERE user_id = :user_id")
+
+# Баланс до изменения, чтобы записать в журнал разницу. Строка блокируется до конца транзакции,
+# поэтому параллельный перевод не изменит баланс между чтением и SET_BALANCE. В SQLite вместо
+# SELECT пустое изменение: с него начинается пишущая транзакция (BEGIN IMMEDIATE).
+LOCK_BALANCE = dialect_text(
+    postgresql="SELECT balance FROM accounts WHERE user_id = :user_id FOR UPDATE",
+    sqlite="UPDATE accounts SET balance = balance WHERE user_id = :user_id RETURNING balance",
+)
+
+INSERT_JOURNAL = text("INSERT INTO journal (from_id, to_id, amount, memo)"
+                      " VALUES (:from_id, :to_id, :amount, :memo)")
+
+UPDATE_STATS = text("""
+    INSERT INTO account_stats (user_id, earned, spent, entries)
+    VALUES (:user_id, :earned, :spent, :entries)
+    ON CONFLICT (user_id) DO UPDATE SET
+        earned = account_stats.earned + EXCLUDED.earned,
+        spent = account_stats.spent + EXCLUDED.spent,
+        entries = account_stats.entries + EXCLUDED.entries
+""")
+
+
+# Записи журнала копятся в сессии и пишутся одной пачкой при session.commit()
+def journal(session, from_id, to_id, amount, memo):
+    session.info.setdefault('journal', []).append({'from_id': from_id,
+                                                   'to_id': to_id,
+                                                   'amount': amount,
+                                                   'memo': memo})
+
+
+# Перевод amount со счета from_id на счет to_id в текущей транзакции сессии.
+# Возвращает False, если средств недостаточно или счета нет; коммит — за вызывающим.
+# overdraft=True разрешает уйти в минус (банк платит за выполненные задачи).
+def transfer(session, from_id, to_id, amount, memo='', overdraft=False):
+    if amount <= 0:
+        raise ValueError(f"Transfer amount must be positive, got {amount}")
+    if from_id == to_id:
+        return True
+    balances = dict(session.execute(TRANSFER, {'from_id': from_id,
+                                               'to_id': to_id,
+                                               'amount': amount,
+                                               'overdraft': overdraft}).fetchall())
+    if from_id not in balances or to_id not in balances:
+        return False
+    journal(session, from_id, to_id, amount, memo)
+    return True
+
+
+def set_balance(session, user_id, amount, memo=''):
+    updated = session.execute(LOCK_BALANCE, {'user_id': user_id}).fetchone()
+    if updated is None:
+        return False
+    session.execute(SET_BALANCE, {'user_id': user_id, 'amount': amount})
+    # Корректировка баланса — запись журнала без отправителя
+    if amount != updated[0]:
+        journal(session, None, user_id, amount - updated[0], memo)
+    return True
+
+
+@event.listens_for(Session, 'before_commit')
+def flush_journal(session):
+    entries = session.info.pop('journal', None)
+    if not entries:
+        return
+    session.execute(INSERT_JOURNAL, entries)
+
+    # Доходы и расходы пользователей обновляются по записям этой транзакции
+    stats = defaultdict(lambda: {'earned': 0, 'spent': 0, 'entries': 0})
+    for entry in entries:
+        if entry['from_id'] is None:
+            target = stats[entry['to_id']]
+            target['earned' if entry['amount'] > 0 else 'spent'] += abs(entry['amount'])
+            target['entries'] += 1
+        else:
+            stats[entry['from_id']]['spent'] += entry['amount']
+            stats[entry['from_id']]['entries'] += 1
+            stats[entry['to_id']]['earned'] += entry['amount']
+            stats[entry['to_id']]['entries'] += 1
+    # Порядок по user_id, чтобы параллельные коммиты не блокировали друг друга
+    session.execute(UPDATE_STATS, [dict(values, user_id=user_id) for user_id, values in sorted(stats.items())])
+    logger.debug("Journaled entries", extra={'entries': len(entries), 'accounts': len(stats)})
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_journal(session):
+    session.info.pop('journal', None)
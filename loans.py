@@ -0,0 +1,201 @@
+import heapq
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+from database import DIALECT, dialect_text, get_session
+from debt import INTEREST_STEP, debt_schedule, debt_schedule_batch
+from metrics import LOAN_ACCRUAL_LAG, LOAN_ACCRUAL_LOANS, LOAN_ACCRUAL_SECONDS
+from repository import LoansRepo
+
+logger = logging.getLogger(__name__)
+
+# Верхняя граница сна планировщика, чтобы переход часов не усыплял его надолго
+MAX_SLEEP = 60 * 60
+# Пауза перед повторной попыткой, если начисление или первая загрузка кредитов упали с ошибкой
+RETRY_DELAY = 60
+
+# Закрываем все просроченные кредиты пачки и открываем вместо них новые
+# с увеличенной ставкой — одним запросом на пачку. В SQLite нет изменяющих CTE:
+# там новые кредиты вставляются по пачке из JSON, а старые закрываются вторым запросом
+# в той же транзакции.
+ACCRUE_LOANS = dialect_text(postgresql="""
+    WITH due AS (
+        SELECT * FROM unnest(CAST(:loan_ids AS integer[]), CAST(:increments AS real[]))
+            AS d(loan_id, increment)
+    ), closed AS (
+        UPDATE loans SET status = 'closed'
+        FROM due
+        WHERE loans.loan_id = due.loan_id AND loans.status = 'active'
+        RETURNING loans.user_id, loans.amount, loans.interest_rate + due.increment AS interest_rate
+    )
+    INSERT INTO loans (user_id, amount, start_date, interest_rate, status)
+    SELECT user_id, amount, :start_date, interest_rate, 'active' FROM closed
+    RETURNING loan_id, amount, start_date
+""", sqlite="""
+    INSERT INTO loans (user_id, amount, start_date, interest_rate, status)
+    SELECT loans.user_id, loans.amount, :start_date, loans.interest_rate + json_extract(due.value, '$[1]'), 'active'
+    FROM json_each(:due) AS due
+    JOIN loans ON loans.loan_id = json_extract(due.value, '$[0]')
+    WHERE loans.status = 'active'
+    RETURNING loan_id, amount, start_date
+""")
+
+CLOSE_ACCRUED_LOANS = text("""
+    UPDATE loans SET status = 'closed'
+    WHERE status = 'active' AND loan_id IN (SELECT json_extract(value, '$[0]') FROM json_each(:due))
+""")
+
+
+# Кредит отсчитывается от начала текущих суток
+def loan_start_date(now=None):
+    start = datetime.fromtimestamp(time.time() if now is None else now).astimezone()
+    return start.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+# Планировщик начисления процентов: держит кучу (срок, кредит) и спит
+# до ближайшего срока вместо ежеминутного обхода всех активных кредитов.
+# Работает только в процессе-лидере; кредиты, взятые через другие процессы, он
+# находит, перечитывая активные кредиты раз в reload_interval секунд.
+class LoanScheduler:
+    def __init__(self, session_factory=get_session, batch_size=500, rate=INTEREST_STEP, reload_interval=None):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.rate = rate
+        self.reload_interval = reload_interval
+        self._heap = []
+        # Кредиты, добавленные schedule(), пока load() читает снимок из базы: {loan_id: запись кучи}
+        self._added = None
+        self._loaded = False
+        self._loaded_at = 0
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def entry(self, loan_id, amount, start_ts):
+        return debt_schedule(amount, start_ts, start_ts, self.rate).next_increase, loan_id, amount, start_ts
+
+    # Кредит, взятый в этом процессе; если планировщик здесь не запущен, кредит подхватит лидер
+    def schedule(self, loan_id, amount, start_ts):
+        with self._cond:
+            if not self._running:
+                return
+            entry = self.entry(loan_id, amount, start_ts)
+            heapq.heappush(self._heap, entry)
+            if self._added is not None:
+                self._added[loan_id] = entry
+            self._cond.notify()
+
+    # Заменяет кучу всеми активными кредитами из базы. Кредиты, добавленные schedule() во время
+    # чтения, могли не попасть в снимок: они переносятся в новую кучу
+    def load(self):
+        with self._cond:
+            self._added = {}
+        session = self.session_factory()
+        try:
+            loans = LoansRepo(session).active()
+        finally:
+            session.close()
+        heap = []
+        for loan_id, amount, start_date in loans:
+            if start_date is None:
+                logger.warning("Skipping loan without start_date", extra={'loan_id': loan_id})
+                continue
+            heap.append(self.entry(loan_id, amount, start_date.timestamp()))
+        loaded = {loan_id for loan_id, _, _ in loans}
+        with self._cond:
+            heap.extend(entry for loan_id, entry in self._added.items() if loan_id not in loaded)
+            self._added = None
+            heapq.heapify(heap)
+            self._heap = heap
+            self._loaded = True
+            self._loaded_at = time.monotonic()
+            self._cond.notify()
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            # После потери и нового получения аренды кредиты загружаются заново
+            self._loaded = False
+            self._loaded_at = 0
+        self._thread = threading.Thread(target=self._run, name="loan-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    # Сколько секунд до загрузки кредитов: пока они ни разу не загрузились, попытки идут раз в RETRY_DELAY
+    def _reload_in(self):
+        if not self._loaded:
+            return self._loaded_at + RETRY_DELAY - time.monotonic() if self._loaded_at else 0
+        if self.reload_interval is None:
+            return MAX_SLEEP
+        return self._loaded_at + self.reload_interval - time.monotonic()
+
+    def _run(self):
+        while True:
+            if self._reload_in() <= 0:
+                try:
+                    self.load()
+                except Exception:
+                    logger.exception("Failed to load active loans")
+                    self._loaded_at = time.monotonic()
+            with self._cond:
+                if not self._running:
+                    return
+                now = time.time()
+                if not self._heap or self._heap[0][0] > now:
+                    timeout = self._heap[0][0] - now if self._heap else MAX_SLEEP
+                    self._cond.wait(max(0, min(timeout, MAX_SLEEP, self._reload_in())))
+                    continue
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap))
+            LOAN_ACCRUAL_LAG.observe(value=now - due[0][0])
+            started = time.perf_counter()
+            try:
+                self._accrue(due, now)
+                LOAN_ACCRUAL_LOANS.inc(amount=len(due))
+            except Exception:
+                logger.exception("Loan accrual failed, retrying later", extra={'loans': len(due)})
+                with self._cond:
+                    for _, loan_id, amount, start_ts in due:
+                        heapq.heappush(self._heap, (now + RETRY_DELAY, loan_id, amount, start_ts))
+            finally:
+                LOAN_ACCRUAL_SECONDS.observe(value=time.perf_counter() - started)
+
+    def _accrue(self, due, now):
+        start_date = loan_start_date(now)
+        session = self.session_factory()
+        try:
+            for i in range(0, len(due), self.batch_size):
+                batch = due[i:i + self.batch_size]
+                _, loan_ids, amounts, starts = zip(*batch)
+                increases = debt_schedule_batch(amounts, starts, now, self.rate).increases
+                increments = (increases * self.rate).tolist()
+                if DIALECT == 'sqlite':
+                    due_loans = json.dumps(list(zip(loan_ids, increments)))
+                    new_loans = session.execute(ACCRUE_LOANS, {'due': due_loans,
+                                                               'start_date': start_date}).fetchall()
+                    session.execute(CLOSE_ACCRUED_LOANS, {'due': due_loans})
+                else:
+                    new_loans = session.execute(ACCRUE_LOANS, {'loan_ids': list(loan_ids),
+                                                               'increments': increments,
+                                                               'start_date': start_date}).fetchall()
+                session.commit()
+                for loan_id, amount, new_start_date in new_loans:
+                    self.schedule(loan_id, amount, new_start_date.timestamp())
+                logger.debug("Accrued interest", extra={'accrued': len(new_loans), 'due': len(batch)})
+        finally:
+            session.close()
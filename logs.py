@@ -0,0 +1,125 @@
+import atexit
+import logging
+import os
+import queue
+import random
+import sys
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+from config import LOG_DEBUG_SAMPLE, LOG_LEVEL, LOG_LEVELS, LOG_QUEUE_SIZE
+from metrics import Counter
+from tracing import current_trace
+
+# Атрибуты, которые есть у любой записи; все остальные пришли через extra и выводятся как key=value
+STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+LOG_DROPPED = Counter('bot_log_records_dropped_total', "Log records dropped because the log queue was full")
+
+listener = None
+
+
+# В процессе, созданном через fork, потока записи нет: логирование настраивается заново
+def forget_listener():
+    global listener
+    listener = None
+
+
+os.register_at_fork(after_in_child=forget_listener)
+
+
+def format_value(value):
+    value = str(value)
+    if value and not any(char in value for char in ' "=\n\\'):
+        return value
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+
+# Запись одной строкой key=value: время, уровень, логгер, поток, сообщение, поля из extra
+# и контекст апдейта; трейсбек исключения — в поле exc
+class KeyValueFormatter(logging.Formatter):
+    def format(self, record):
+        fields = [
+            ('time', datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds')),
+            ('level', record.levelname),
+            ('logger', record.name),
+            ('thread', record.threadName),
+            ('msg', record.getMessage()),
+        ]
+        fields.extend((key, value) for key, value in vars(record).items() if key not in STANDARD_ATTRS)
+        if record.exc_info:
+            fields.append(('exc', self.formatException(record.exc_info)))
+        return ' '.join(f'{key}={format_value(value)}' for key, value in fields)
+
+
+# Записи DEBUG проходят с вероятностью rate (у прошедших есть поле sample_rate), остальные — все
+class DebugSampler(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        if random.random() >= self.rate:
+            return False
+        record.sample_rate = self.rate
+        return True
+
+
+# Кладет запись в ограниченную очередь, не форматируя ее: форматирование и вывод выполняет
+# поток QueueListener. Если очередь полна, запись отбрасывается, а не задерживает обработчик.
+class NonBlockingQueueHandler(QueueHandler):
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        trace = current_trace.get()
+        if trace is not None:
+            record.handler = trace.handler
+            for key, value in trace.attrs.items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+# "sqlalchemy.engine=INFO,TeleBot=WARNING" -> {'sqlalchemy.engine': 'INFO', 'TeleBot': 'WARNING'}
+def parse_levels(value):
+    levels = {}
+    for part in value.split(','):
+        if part.strip():
+            name, level = part.split('=')
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+# Настраивает логирование процесса: корневой уровень LOG_LEVEL, уровни подсистем из LOG_LEVELS,
+# выборка DEBUG и вывод в stderr из отдельного потока
+def setup_logging():
+    global listener
+    if listener is not None:
+        return
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(KeyValueFormatter())
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    handler.addFilter(DebugSampler(LOG_DEBUG_SAMPLE))
+
+    # pyTelegramBotAPI пишет в stderr своим обработчиком; его записи тоже идут через очередь
+    for logger in (logging.getLogger(), logging.getLogger('TeleBot')):
+        for existing in logger.handlers[:]:
+            logger.removeHandler(existing)
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL.upper())
+    for name, level in parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    listener = QueueListener(handler.queue, output)
+    listener.start()
+    # Перед выходом дописываем то, что осталось в очереди
+    atexit.register(listener.stop)
@@ -0,0 +1,23 @@
+from config import BOT_MODE, BOT_PROCESSES, BOT_RUNTIME, DATABASE_URL, PENDING_STORE
+
+# Точка входа: режим работы бота выбирается переменными BOT_RUNTIME и BOT_MODE
+if BOT_PROCESSES > 1 and (BOT_MODE != 'webhook' or BOT_RUNTIME != 'threaded'):
+    # getUpdates может читать только один процесс
+    raise SystemExit("BOT_PROCESSES > 1 is only supported with BOT_MODE=webhook and BOT_RUNTIME=threaded")
+if BOT_PROCESSES > 1 and PENDING_STORE != 'db':
+    # Подтверждение может прийти в другой процесс, чем запрос: токены должны быть общими
+    raise SystemExit("BOT_PROCESSES > 1 requires PENDING_STORE=db")
+if DATABASE_URL.startswith('sqlite') and (BOT_PROCESSES > 1 or BOT_RUNTIME == 'async'):
+    # Аренды фоновых задач между процессами у SQLite нет, асинхронного драйвера тоже
+    raise SystemExit("DATABASE_URL=sqlite:// is only supported with BOT_PROCESSES=1 and BOT_RUNTIME=threaded")
+if BOT_RUNTIME == 'async':
+    if BOT_MODE == 'webhook':
+        raise SystemExit("BOT_MODE=webhook is only supported with BOT_RUNTIME=threaded")
+    from async_bot import main
+elif BOT_MODE == 'webhook':
+    from webhook import main
+else:
+    from bot import main
+
+if __name__ == '__main__':
+    main()
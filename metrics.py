@@ -0,0 +1,347 @@
+import functools
+import inspect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import event, exc
+from telebot import apihelper
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержки (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REGISTRY = []
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+# Метрика с метками: значения хранятся по кортежу значений меток в порядке labelnames
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for labels, value in self.samples():
+            lines.append(f'{self.name}{format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+# Значение задается set() или считается при каждом запросе /metrics функцией из set_function(),
+# которая возвращает {кортеж меток: значение}
+class Gauge(Metric):
+    type = 'gauge'
+    _collect = None
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, collect):
+        self._collect = collect
+
+    def samples(self):
+        if self._collect is None:
+            return super().samples()
+        try:
+            return sorted(self._collect().items())
+        except Exception:
+            logger.exception("Failed to collect metric", extra={'metric': self.name})
+            return []
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *labels, value):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            return sorted((labels, (list(counts), total, count))
+                          for labels, (counts, total, count) in self._values.items())
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for labels, (counts, total, count) in self.samples():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = format_labels(self.labelnames, labels, 'le="%s"' % bound)
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            bucket_labels = format_labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{bucket_labels} {count}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', "Handler execution time", ['kind', 'handler'])
+HANDLER_ERRORS = Counter('bot_handler_errors_total', "Handlers that raised an exception", ['kind', 'handler'])
+DB_QUERY_SECONDS = Histogram('bot_db_query_seconds', "SQL statement execution time", ['statement'])
+DB_ERRORS = Counter('bot_db_errors_total', "SQL statements that failed", ['statement'])
+API_SECONDS = Histogram('bot_api_request_seconds', "Telegram Bot API request time", ['method'])
+API_ERRORS = Counter('bot_api_errors_total', "Telegram Bot API requests that failed", ['method'])
+LOAN_ACCRUAL_LAG = Histogram('bot_loan_accrual_lag_seconds', "Delay between the earliest due loan and its accrual")
+LOAN_ACCRUAL_SECONDS = Histogram('bot_loan_accrual_seconds', "Duration of one interest accrual cycle")
+LOAN_ACCRUAL_LOANS = Counter('bot_loan_accrual_loans_total', "Loans processed by interest accrual")
+DB_POOL_WAIT = Histogram('bot_db_pool_wait_seconds', "Time to get a connection from the pool, including opening one",
+                         ['pool'], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 5, 30))
+DB_POOL_TIMEOUTS = Counter('bot_db_pool_timeouts_total', "Checkouts that gave up waiting for a free connection",
+                           ['pool'])
+DB_POOL_IN_USE = Gauge('bot_db_pool_connections_in_use', "Connections checked out of the pool", ['pool'])
+DB_POOL_IDLE = Gauge('bot_db_pool_connections_idle', "Open connections waiting in the pool", ['pool'])
+DISPATCH_QUEUE_DEPTH = Gauge('bot_dispatch_queue_depth', "Updates waiting in each dispatcher queue", ['shard'])
+# Ключ (чат или пользователь) всегда попадает в один шард, поэтому задержка ключей видна по шардам;
+# метка по ключу дала бы по ряду на каждый чат
+DISPATCH_LAG = Histogram('bot_dispatch_lag_seconds', "Time an update waited in its dispatcher queue", ['shard'],
+                         buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+
+def observe_handler(root, kind, name, started, failed):
+    duration = time.perf_counter() - started
+    HANDLER_SECONDS.observe(kind, name, value=duration)
+    if failed:
+        HANDLER_ERRORS.inc(kind, name)
+    tracing.end(root, kind, name, started, duration, failed)
+
+
+# Оборачивает обработчик (обычный или async) замером времени, счетчиком ошибок и трассировкой.
+# cProfile включается только для обычных обработчиков: в async он захватил бы чужие задачи.
+def timed_handler(kind, name, func):
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            root = tracing.begin(kind, name, args)
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = await func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                observe_handler(root, kind, name, started, failed)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            root = tracing.begin(kind, name, args, profile=True)
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                observe_handler(root, kind, name, started, failed)
+    wrapper.instrumented = True
+    return wrapper
+
+
+# Замеряет все зарегистрированные обработчики бота (TeleBot или AsyncTeleBot).
+# Вызывается после регистрации обработчиков; kind — тип апдейта (message, callback_query, ...)
+def instrument_bot(bot):
+    for attribute, handlers in vars(bot).items():
+        if not attribute.endswith('_handlers') or not isinstance(handlers, list):
+            continue
+        kind = attribute[:-len('_handlers')]
+        for handler in handlers:
+            func = handler.get('function') if isinstance(handler, dict) else None
+            if func is not None and not getattr(func, 'instrumented', False):
+                handler['function'] = timed_handler(kind, func.__name__, func)
+
+
+# Первое слово запроса (select, insert, with, ...): метка с небольшим числом значений
+def statement_kind(statement):
+    words = statement.lstrip().split(None, 1)
+    return words[0].lower() if words else 'empty'
+
+
+# Время и ошибки SQL-запросов через события движка (подходит и sync_engine асинхронного)
+def instrument_engine(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_started'].pop()
+        duration = time.perf_counter() - started
+        kind = statement_kind(statement)
+        DB_QUERY_SECONDS.observe(kind, value=duration)
+        tracing.record('db', kind, started, duration, statement=' '.join(statement.split())[:200])
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        started = context.connection.info.get('query_started') if context.connection is not None else None
+        if started:
+            started.pop()
+        DB_ERRORS.inc(statement_kind(context.statement or ''))
+
+
+# Пулы соединений по имени метки: их заполненность считается при каждом запросе /metrics
+POOLS = {}
+DB_POOL_IN_USE.set_function(lambda: {(name,): engine.pool.checkedout() for name, engine in POOLS.items()})
+DB_POOL_IDLE.set_function(lambda: {(name,): engine.pool.checkedin() for name, engine in POOLS.items()})
+
+
+def time_checkout(pool, name):
+    connect = pool.connect
+
+    @functools.wraps(connect)
+    def timed_connect():
+        started = time.perf_counter()
+        try:
+            return connect()
+        except exc.TimeoutError:
+            DB_POOL_TIMEOUTS.inc(name)
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            DB_POOL_WAIT.observe(name, value=duration)
+            tracing.record('pool', name, started, duration)
+
+    pool.connect = timed_connect
+
+
+# Ожидание соединения из пула движка (QueuePool) и число занятых и свободных соединений.
+# engine.dispose() заменяет пул новым, поэтому замер ставится и на него.
+def instrument_pool(engine, name):
+    POOLS[name] = engine
+    time_checkout(engine.pool, name)
+
+    @event.listens_for(engine, 'engine_disposed')
+    def engine_disposed(engine):
+        time_checkout(engine.pool, name)
+
+
+def observe_api(api_method, started, failed):
+    duration = time.perf_counter() - started
+    API_SECONDS.observe(api_method, value=duration)
+    if failed:
+        API_ERRORS.inc(api_method)
+    tracing.record('api', api_method, started, duration, error=failed)
+
+
+# Замер вызовов Bot API в TeleBot: отправитель запросов встает поверх уже настроенного
+# apihelper.CUSTOM_REQUEST_SENDER (или обычной сессии requests). Ошибка — исключение или код не 200.
+def instrument_api():
+    send_request = apihelper.CUSTOM_REQUEST_SENDER
+
+    def sender(method, url, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        failed = True
+        try:
+            if send_request is not None:
+                response = send_request(method, url, **kwargs)
+            else:
+                response = apihelper._get_req_session().request(method, url, **kwargs)
+            failed = response.status_code != 200
+            return response
+        finally:
+            observe_api(api_method, started, failed)
+
+    apihelper.CUSTOM_REQUEST_SENDER = sender
+
+
+# То же для AsyncTeleBot: все методы asyncio_helper идут через _process_request.
+# asyncio_helper тянет aiohttp, поэтому импортируется только в асинхронном режиме
+def instrument_async_api():
+    from telebot import asyncio_helper
+
+    process_request = asyncio_helper._process_request
+
+    async def instrumented(token, url, *args, **kwargs):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await process_request(token, url, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            observe_api(url, started, failed)
+
+    asyncio_helper._process_request = instrumented
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+# Отдает /metrics на host:port в фоновом потоке; port=0 — метрики не публикуются
+def start_server(host, port):
+    if not port:
+        return None
+    server = MetricsHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info("Metrics available", extra={'url': f"http://{host}:{port}/metrics"})
+    return server
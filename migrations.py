@@ -0,0 +1,186 @@
+import logging
+
+from sqlalchemy import text
+
+from database import engine
+
+logger = logging.getLogger(__name__)
+
+# Текущее время столбца по умолчанию в SQLite в формате sqlite_backend.format_timestamp
+SQLITE_NOW = "(strftime('%Y-%m-%d %H:%M:%f000+00:00', 'now'))"
+
+# Версии схемы по порядку. Каждая версия применяется один раз в своей транзакции,
+# номер примененной версии сохраняется в schema_migrations. Запрос-строка общий для всех
+# СУБД; словарь задает варианты по диалектам, и без варианта для диалекта запрос пропускается.
+MIGRATIONS = [
+    (1, "initial tables", [
+        '''CREATE TABLE IF NOT EXISTS accounts
+           (user_id INTEGER PRIMARY KEY,
+            balance REAL)''',
+        {'postgresql': '''CREATE TABLE IF NOT EXISTS services
+                          (service_id SERIAL PRIMARY KEY,
+                           service_name TEXT,
+                           price REAL,
+                           type TEXT)''',
+         'sqlite': '''CREATE TABLE IF NOT EXISTS services
+                      (service_id INTEGER PRIMARY KEY,
+                       service_name TEXT,
+                       price REAL,
+                       type TEXT)'''},
+        # В SQLite столбцы времени сразу создаются с типом версии 2
+        {'postgresql': '''CREATE TABLE IF NOT EXISTS completed_services
+                          (service_id SERIAL PRIMARY KEY,
+                           user_id INTEGER,
+                           service_name TEXT,
+                           price REAL,
+                           type TEXT,
+                           status TEXT,
+                           end_date TEXT)''',
+         'sqlite': '''CREATE TABLE IF NOT EXISTS completed_services
+                      (service_id INTEGER PRIMARY KEY,
+                       user_id INTEGER,
+                       service_name TEXT,
+                       price REAL,
+                       type TEXT,
+                       status TEXT,
+                       end_date TIMESTAMPTZ)'''},
+        {'postgresql': '''CREATE TABLE IF NOT EXISTS loans
+                          (loan_id SERIAL PRIMARY KEY,
+                           user_id INTEGER,
+                           amount REAL,
+                           start_date TEXT,
+                           end_date TEXT,
+                           interest_rate REAL,
+                           status TEXT)''',
+         'sqlite': '''CREATE TABLE IF NOT EXISTS loans
+                      (loan_id INTEGER PRIMARY KEY,
+                       user_id INTEGER,
+                       amount REAL,
+                       start_date TIMESTAMPTZ,
+                       end_date TIMESTAMPTZ,
+                       interest_rate REAL,
+                       status TEXT)'''},
+    ]),
+    (2, "typed timestamp columns", [
+        {'postgresql': "ALTER TABLE loans ALTER COLUMN start_date TYPE TIMESTAMPTZ"
+                       " USING NULLIF(start_date, '')::timestamptz"},
+        {'postgresql': "ALTER TABLE loans ALTER COLUMN end_date TYPE TIMESTAMPTZ"
+                       " USING NULLIF(end_date, '')::timestamptz"},
+        {'postgresql': "ALTER TABLE completed_services ALTER COLUMN end_date TYPE TIMESTAMPTZ"
+                       " USING NULLIF(end_date, '')::timestamptz"},
+    ]),
+    (3, "lookup indexes", [
+        "CREATE INDEX IF NOT EXISTS loans_active_user_idx ON loans (user_id) WHERE status = 'active'",
+        "CREATE INDEX IF NOT EXISTS completed_services_user_status_idx ON completed_services (user_id, status)",
+        "CREATE INDEX IF NOT EXISTS completed_services_closed_idx ON completed_services (end_date, service_id)"
+        " WHERE status = 'closed'",
+        "CREATE INDEX IF NOT EXISTS services_type_idx ON services (type)",
+    ]),
+    (4, "transaction journal", [
+        {'postgresql': '''CREATE TABLE IF NOT EXISTS journal
+                          (entry_id BIGSERIAL PRIMARY KEY,
+                           created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                           from_id INTEGER,
+                           to_id INTEGER NOT NULL,
+                           amount REAL NOT NULL,
+                           memo TEXT)''',
+         'sqlite': f'''CREATE TABLE IF NOT EXISTS journal
+                       (entry_id INTEGER PRIMARY KEY,
+                        created_at TIMESTAMPTZ NOT NULL DEFAULT {SQLITE_NOW},
+                        from_id INTEGER,
+                        to_id INTEGER NOT NULL,
+                        amount REAL NOT NULL,
+                        memo TEXT)'''},
+        "CREATE INDEX IF NOT EXISTS journal_from_idx ON journal (from_id, entry_id)",
+        "CREATE INDEX IF NOT EXISTS journal_to_idx ON journal (to_id, entry_id)",
+        '''CREATE TABLE IF NOT EXISTS account_stats
+           (user_id INTEGER PRIMARY KEY,
+            earned REAL NOT NULL DEFAULT 0,
+            spent REAL NOT NULL DEFAULT 0,
+            entries INTEGER NOT NULL DEFAULT 0)''',
+        # Текущие балансы становятся начальными корректировками журнала
+        "INSERT INTO journal (from_id, to_id, amount, memo)"
+        " SELECT NULL, user_id, balance, 'opening balance' FROM accounts WHERE balance != 0",
+        {'postgresql': "INSERT INTO account_stats (user_id, earned, spent, entries)"
+                       " SELECT user_id, GREATEST(balance, 0), GREATEST(-balance, 0), 1"
+                       " FROM accounts WHERE balance != 0",
+         'sqlite': "INSERT INTO account_stats (user_id, earned, spent, entries)"
+                   " SELECT user_id, MAX(balance, 0), MAX(-balance, 0), 1 FROM accounts WHERE balance != 0"},
+    ]),
+    (5, "pending actions", [
+        '''CREATE TABLE IF NOT EXISTS pending_actions
+           (token TEXT PRIMARY KEY,
+            owner_id BIGINT,
+            payload TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL)''',
+        "CREATE INDEX IF NOT EXISTS pending_actions_expires_idx ON pending_actions (expires_at)",
+    ]),
+    (6, "conversation state", [
+        '''CREATE TABLE IF NOT EXISTS conversations
+           (chat_id BIGINT PRIMARY KEY,
+            step TEXT NOT NULL,
+            args TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL)''',
+        "CREATE INDEX IF NOT EXISTS conversations_expires_idx ON conversations (expires_at)",
+    ]),
+]
+
+
+SCHEMA_MIGRATIONS = {
+    'postgresql': '''CREATE TABLE IF NOT EXISTS schema_migrations
+                     (version INTEGER PRIMARY KEY,
+                      description TEXT,
+                      applied_at TIMESTAMPTZ DEFAULT now())''',
+    'sqlite': f'''CREATE TABLE IF NOT EXISTS schema_migrations
+                  (version INTEGER PRIMARY KEY,
+                   description TEXT,
+                   applied_at TIMESTAMPTZ DEFAULT {SQLITE_NOW})''',
+}
+
+
+# Запрос миграции для диалекта или None, если для него варианта нет
+def for_dialect(statement, dialect):
+    if isinstance(statement, dict):
+        return statement.get(dialect)
+    return statement
+
+
+# Ключ advisory-блокировки миграций: "migr" в ASCII
+MIGRATION_LOCK_ID = 0x6d696772
+
+
+# Первый запрос каждой транзакции миграций: процессы, которые стартуют одновременно
+# (например, дочерние процессы вебхука), проходят миграции по очереди. Блокировка берется
+# до CREATE TABLE IF NOT EXISTS: параллельные CREATE в Postgres падают на уникальности
+# pg_type. Транзакция записи SQLite и так держит блокировку всей базы.
+def lock_migrations(connection):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {'lock_id': MIGRATION_LOCK_ID})
+
+
+def current_version(connection):
+    connection.execute(text(SCHEMA_MIGRATIONS[connection.dialect.name]))
+    return connection.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")).scalar()
+
+
+# Приводит схему к версии target (по умолчанию — к последней)
+def migrate(bind=engine, target=None):
+    with bind.connect() as connection:
+        with connection.begin():
+            lock_migrations(connection)
+            version = current_version(connection)
+        for number, description, statements in MIGRATIONS:
+            if number <= version or (target is not None and number > target):
+                continue
+            with connection.begin():
+                lock_migrations(connection)
+                if current_version(connection) >= number:
+                    continue
+                logger.info("Applying migration", extra={'migration': number, 'description': description})
+                for statement in statements:
+                    statement = for_dialect(statement, connection.dialect.name)
+                    if statement is not None:
+                        connection.execute(text(statement))
+                connection.execute(text("INSERT INTO schema_migrations (version, description)"
+                                        " VALUES (:version, :description)"),
+                                   {'version': number, 'description': description})
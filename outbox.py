@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+# Правка ушла в API, новых для этого сообщения пока нет
+SENT = object()
+
+
+# Ведро токенов: rate вызовов в секунду, до capacity подряд. reserve() сразу занимает
+# токен (в долг, если их нет) и говорит, сколько подождать, так что ждущие идут по очереди.
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    # После 429 следующий вызов пойдет не раньше чем через seconds
+    def pause(self, seconds):
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+# Исходящие сообщения бота. Соблюдает лимиты Telegram (общий и на чат, для групп строже),
+# повторяет вызов после 429 через retry_after, склеивает частые правки одного сообщения
+# (уходит только последняя) и заменяет пару delete_message + send_message одной правкой.
+class Outbox:
+    def __init__(self, bot, global_rate=30, chat_rate=1, chat_burst=3, group_rate=20 / 60, group_burst=20,
+                 max_retries=3, tracked_chats=10000):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.tracked_chats = tracked_chats
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self._chats = OrderedDict()
+        self._edits = {}
+        self._lock = threading.Lock()
+
+    def _chat_bucket(self, chat_id):
+        with self._lock:
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                # Отрицательный id — группа или канал
+                if chat_id < 0:
+                    bucket = TokenBucket(self.group_rate, self.group_burst)
+                else:
+                    bucket = TokenBucket(self.chat_rate, self.chat_burst)
+                self._chats[chat_id] = bucket
+                while len(self._chats) > self.tracked_chats:
+                    self._chats.popitem(last=False)
+            else:
+                self._chats.move_to_end(chat_id)
+            return bucket
+
+    def _call(self, chat_id, method, *args, **kwargs):
+        chat_bucket = self._chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            delay = max(self.global_bucket.reserve(), chat_bucket.reserve())
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                return method(*args, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code != 429 or attempt == self.max_retries:
+                    raise
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                logger.warning("Rate limited, retrying", extra={'chat_id': chat_id, 'retry_after': retry_after})
+                chat_bucket.pause(retry_after)
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._call(chat_id, self.bot.send_message, chat_id, text, **kwargs)
+
+    def reply_to(self, message, text, **kwargs):
+        return self._call(message.chat.id, self.bot.reply_to, message, text, **kwargs)
+
+    def delete_message(self, chat_id, message_id):
+        return self._call(chat_id, self.bot.delete_message, chat_id, message_id)
+
+    # Правки одного сообщения, пришедшие, пока предыдущая ждет лимита или выполняется,
+    # не уходят отдельно: поток, который уже отправляет правку, отправит последнюю версию.
+    def edit_message_text(self, text, chat_id, message_id, reply_markup=None):
+        key = (chat_id, message_id)
+        with self._lock:
+            busy = key in self._edits
+            self._edits[key] = (text, reply_markup)
+        if busy:
+            return None
+
+        try:
+            while True:
+                with self._lock:
+                    text, reply_markup = self._edits[key]
+                    self._edits[key] = SENT
+                result = self._edit(text, chat_id, message_id, reply_markup)
+                with self._lock:
+                    if self._edits[key] is SENT:
+                        del self._edits[key]
+                        return result
+        except Exception:
+            with self._lock:
+                self._edits.pop(key, None)
+            raise
+
+    def _edit(self, text, chat_id, message_id, reply_markup):
+        try:
+            return self._call(chat_id, self.bot.edit_message_text, text, chat_id, message_id,
+                              reply_markup=reply_markup)
+        except ApiTelegramException as e:
+            if e.error_code == 400 and 'message is not modified' in e.description:
+                return None
+            raise
+
+    # Заменяет сообщение с кнопками новым текстом: одна правка вместо delete_message + send_message.
+    # Если сообщение нельзя отредактировать (не текст, слишком старое), удаляет его и отправляет новое.
+    # У недоступного сообщения (InaccessibleMessage, date 0) нет content_type — оно тоже заменяется.
+    def replace(self, message, text, reply_markup=None):
+        chat_id = message.chat.id
+        if getattr(message, 'content_type', None) == 'text':
+            try:
+                return self.edit_message_text(text, chat_id, message.message_id, reply_markup=reply_markup)
+            except ApiTelegramException as e:
+                if e.error_code != 400:
+                    raise
+                logger.info("Cannot edit message, sending a new one", extra={'chat_id': chat_id, 'message_id': message.message_id,
+                                                                        'reason': e.description})
+        self.delete_message(chat_id, message.message_id)
+        return self.send_message(chat_id, text, reply_markup=reply_markup)
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta, timezone
+
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+# Лимит длины одного сообщения Telegram
+MESSAGE_LIMIT = 4096
+PAGE_SIZE = 20
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+# Время в курсоре хранится целым числом микросекунд, чтобы не терять точность
+def timestamp_to_cursor(value):
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def cursor_to_timestamp(value):
+    return EPOCH + timedelta(microseconds=value)
+
+
+# Курсор из callback_data кнопки навигации: целые числа через "_"
+def parse_cursor(value):
+    return [int(part) for part in value.split('_')]
+
+
+# Делит текст на части не длиннее limit, по возможности по границам строк
+def split_text(text, limit=MESSAGE_LIMIT):
+    chunks = []
+    current = ''
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            chunks.append(current)
+            current = ''
+        current += line
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+
+# Постраничная выборка по ключу (keyset): каждая страница — один запрос с LIMIT
+# от курсора, который кнопки "Назад"/"Вперед" несут в callback_data.
+# first, after и before — запросы первой страницы, страницы после курсора
+# и страницы перед курсором (в обратном порядке).
+class KeysetPager:
+    def __init__(self, action, first, after, before, to_cursor, from_cursor, page_size=PAGE_SIZE):
+        self.action = action
+        self.first = first
+        self.after = after
+        self.before = before
+        self.to_cursor = to_cursor
+        self.from_cursor = from_cursor
+        self.page_size = page_size
+
+    def query(self, direction='first', cursor=None):
+        params = {'limit': self.page_size + 1}
+        if direction == 'first':
+            return self.first, params
+        params.update(self.from_cursor(cursor))
+        return (self.after if direction == 'next' else self.before), params
+
+    # Обрезает выборку до страницы и строит кнопки навигации
+    def page(self, rows, direction='first'):
+        more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+
+        if direction == 'prev':
+            rows.reverse()
+            has_prev, has_next = more, True
+        else:
+            has_prev, has_next = direction == 'next', more
+        return rows, self.markup(rows, has_prev, has_next)
+
+    def fetch(self, session, direction='first', cursor=None):
+        rows = session.execute(*self.query(direction, cursor)).fetchall()
+        return self.page(rows, direction)
+
+    # То же для асинхронной сессии (BOT_RUNTIME=async)
+    async def fetch_async(self, session, direction='first', cursor=None):
+        rows = (await session.execute(*self.query(direction, cursor))).fetchall()
+        return self.page(rows, direction)
+
+    def markup(self, rows, has_prev, has_next):
+        if not rows or not (has_prev or has_next):
+            return None
+        buttons = []
+        if has_prev:
+            cursor = '_'.join(map(str, self.to_cursor(rows[0])))
+            buttons.append(InlineKeyboardButton("◀ Назад", callback_data=f"{self.action}_prev_{cursor}"))
+        if has_next:
+            cursor = '_'.join(map(str, self.to_cursor(rows[-1])))
+            buttons.append(InlineKeyboardButton("Вперед ▶", callback_data=f"{self.action}_next_{cursor}"))
+        markup = InlineKeyboardMarkup()
+        markup.row(*buttons)
+        return markup
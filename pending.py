@@ -0,0 +1,109 @@
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+from database import expires_at, get_session
+
+# Результаты take()
+TAKEN = 'taken'
+MISSING = 'missing'
+OWN = 'own'
+
+INSERT_ACTION = text("INSERT INTO pending_actions (token, owner_id, payload, expires_at)"
+                     " VALUES (:token, :owner_id, :payload, :expires_at)")
+PRUNE_ACTIONS = text("DELETE FROM pending_actions WHERE expires_at <= now()")
+# Забрать действие может только не его инициатор
+TAKE_ACTION = text("DELETE FROM pending_actions"
+                   " WHERE token = :token AND expires_at > now() AND owner_id != :user_id"
+                   " RETURNING payload")
+SELECT_ACTION = text("SELECT payload FROM pending_actions WHERE token = :token AND expires_at > now()")
+DELETE_ACTION = text("DELETE FROM pending_actions WHERE token = :token")
+
+
+def new_token():
+    return secrets.token_hex(8)
+
+
+# Ожидающие подтверждения действия. В callback_data кнопки уходит только короткий
+# токен, а данные действия хранятся на сервере и забираются один раз при подтверждении.
+# owner_id — инициатор действия, он не может подтвердить его сам.
+class MemoryPendingStore:
+    def __init__(self, ttl=24 * 60 * 60, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._actions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, owner_id, payload):
+        token = new_token()
+        with self._lock:
+            self._actions[token] = (time.monotonic() + self.ttl, owner_id, payload)
+            while len(self._actions) > self.maxsize:
+                self._actions.popitem(last=False)
+        return token
+
+    def take(self, token, user_id):
+        with self._lock:
+            action = self._actions.get(token)
+            if action is None or action[0] <= time.monotonic():
+                self._actions.pop(token, None)
+                return MISSING, None
+            if action[1] == user_id:
+                return OWN, action[2]
+            del self._actions[token]
+            return TAKEN, action[2]
+
+    def discard(self, token):
+        with self._lock:
+            self._actions.pop(token, None)
+
+
+# То же в таблице pending_actions: переживает перезапуск и общая для всех процессов
+class DatabasePendingStore:
+    def __init__(self, session_factory=get_session, ttl=24 * 60 * 60, prune_every=100):
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self._puts = 0
+
+    def put(self, owner_id, payload):
+        token = new_token()
+        session = self.session_factory()
+        session.execute(INSERT_ACTION,
+                        {'token': token, 'owner_id': owner_id, 'payload': json.dumps(payload),
+                         'expires_at': expires_at(self.ttl)})
+        self._puts += 1
+        if self._puts % self.prune_every == 0:
+            session.execute(PRUNE_ACTIONS)
+        session.commit()
+        session.close()
+        return token
+
+    def take(self, token, user_id):
+        session = self.session_factory()
+        taken = session.execute(TAKE_ACTION, {'token': token, 'user_id': user_id}).scalar()
+        session.commit()
+        if taken is not None:
+            session.close()
+            return TAKEN, json.loads(taken)
+        own = session.execute(SELECT_ACTION, {'token': token}).scalar()
+        session.close()
+        if own is not None:
+            return OWN, json.loads(own)
+        return MISSING, None
+
+    def discard(self, token):
+        session = self.session_factory()
+        session.execute(DELETE_ACTION, {'token': token})
+        session.commit()
+        session.close()
+
+
+def create_pending_store(backend, session_factory=get_session, ttl=24 * 60 * 60):
+    if backend == 'db':
+        return DatabasePendingStore(session_factory, ttl=ttl)
+    return MemoryPendingStore(ttl=ttl)
@@ -0,0 +1,144 @@
+from sqlalchemy import bindparam, text
+
+
+# Запросы к таблицам бота. Каждый text() разбирается один раз при импорте модуля,
+# а не при каждом вызове обработчика. Репозиторий работает в транзакции переданной сессии
+# (или соединения): коммит и закрытие — за вызывающим. Методы *_many и ensure() передают
+# все строки одним вызовом execute (executemany драйвера).
+class AccountsRepo:
+    ENSURE = text("INSERT INTO accounts (user_id, balance) VALUES (:user_id, 0) ON CONFLICT (user_id) DO NOTHING")
+    INSERT = text("INSERT INTO accounts (user_id, balance) VALUES (:user_id, :balance)")
+    ALL_IDS = text("SELECT user_id FROM accounts")
+    CLIENT_IDS = text("SELECT user_id FROM accounts WHERE user_id != 0")
+    BALANCES = text("SELECT user_id, balance FROM accounts WHERE user_id IN :user_ids").bindparams(
+        bindparam('user_ids', expanding=True))
+    EXECUTOR = text("SELECT user_id FROM accounts WHERE user_id != 0 AND user_id != :buyer_id LIMIT 1")
+
+    def __init__(self, session):
+        self.session = session
+
+    # Создает счета с нулевым балансом тем из user_ids, у кого их еще нет
+    def ensure(self, user_ids):
+        self.session.execute(self.ENSURE, [{'user_id': user_id} for user_id in user_ids])
+
+    # balances: {user_id: баланс}
+    def insert_many(self, balances):
+        self.session.execute(self.INSERT, [{'user_id': user_id, 'balance': balance}
+                                           for user_id, balance in balances.items()])
+
+    def all_ids(self):
+        return self.session.execute(self.ALL_IDS).scalars().all()
+
+    # Все пользователи, кроме банка
+    def client_ids(self):
+        return self.session.execute(self.CLIENT_IDS).scalars().all()
+
+    # Балансы нескольких счетов одним запросом: {user_id: баланс}, без несуществующих счетов
+    def get_balances(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        return dict(self.session.execute(self.BALANCES, {'user_ids': user_ids}).fetchall())
+
+    # Пользователь, который выполнит купленную услугу (любой, кроме банка и покупателя)
+    def find_executor(self, buyer_id):
+        return self.session.execute(self.EXECUTOR, {'buyer_id': buyer_id}).scalar()
+
+
+class LoansRepo:
+    ACTIVE_FOR_USER = text("SELECT loan_id, user_id, amount, start_date, end_date, interest_rate, status FROM loans"
+                           " WHERE user_id = :user_id AND status = 'active'")
+    ACTIVE = text("SELECT loan_id, amount, start_date FROM loans WHERE status = 'active'")
+    # Новый кредит, только если у пользователя нет активного
+    OPEN = text("INSERT INTO loans (user_id, amount, start_date, interest_rate, status)"
+                " SELECT :user_id, :amount, :start_date, :interest_rate, 'active'"
+                " WHERE NOT EXISTS (SELECT 1 FROM loans WHERE user_id = :user_id AND status = 'active')"
+                " RETURNING loan_id")
+    INSERT = text("INSERT INTO loans (user_id, amount, start_date, interest_rate, status)"
+                  " VALUES (:user_id, :amount, :start_date, :interest_rate, :status)")
+    CLOSE = text("UPDATE loans SET status = 'closed' WHERE loan_id = :loan_id AND status = 'active'"
+                 " RETURNING user_id, amount")
+
+    def __init__(self, session):
+        self.session = session
+
+    def active_for_user(self, user_id):
+        return self.session.execute(self.ACTIVE_FOR_USER, {'user_id': user_id}).fetchone()
+
+    # Все активные кредиты: строки (loan_id, amount, start_date)
+    def active(self):
+        return self.session.execute(self.ACTIVE).fetchall()
+
+    # loan_id нового кредита или None, если активный кредит уже есть
+    def open(self, user_id, amount, start_date, interest_rate):
+        return self.session.execute(self.OPEN, {'user_id': user_id,
+                                                'amount': amount,
+                                                'start_date': start_date,
+                                                'interest_rate': interest_rate}).scalar()
+
+    # loans: словари с ключами user_id, amount, start_date, interest_rate, status
+    def insert_many(self, loans):
+        self.session.execute(self.INSERT, list(loans))
+
+    # (user_id, amount) закрытого кредита или None, если активного кредита loan_id нет
+    def close(self, loan_id):
+        return self.session.execute(self.CLOSE, {'loan_id': loan_id}).fetchone()
+
+
+class ServicesRepo:
+    ALL = text("SELECT service_id, service_name, price, type FROM services ORDER BY service_id")
+    GET = text("SELECT service_id, service_name, price, type FROM services WHERE service_id = :service_id")
+    INSERT = text("INSERT INTO services (service_name, price, type) VALUES (:service_name, :price, :type)")
+    DELETE = text("DELETE FROM services WHERE service_id = :service_id")
+
+    def __init__(self, session):
+        self.session = session
+
+    def all(self):
+        return self.session.execute(self.ALL).fetchall()
+
+    # Строка (service_id, service_name, price, type) или None, если услугу удалили
+    def get(self, service_id):
+        return self.session.execute(self.GET, {'service_id': service_id}).fetchone()
+
+    def add(self, service_name, price, type):
+        self.session.execute(self.INSERT, {'service_name': service_name, 'price': price, 'type': type})
+
+    # services: словари с ключами service_name, price, type
+    def insert_many(self, services):
+        self.session.execute(self.INSERT, list(services))
+
+    def remove(self, service_id):
+        self.session.execute(self.DELETE, {'service_id': service_id})
+
+
+class CompletedServicesRepo:
+    INSERT = text("INSERT INTO completed_services (user_id, service_name, price, type, status, end_date)"
+                  " VALUES (:user_id, :service_name, :price, :type, :status, :end_date)")
+    ACTIVE_FOR_USER = text("SELECT service_id, service_name FROM completed_services"
+                           " WHERE user_id = :user_id AND status = 'active'")
+    CLOSE = text("UPDATE completed_services SET status = 'closed', end_date = :end_date"
+                 " WHERE service_id = :service_id")
+
+    def __init__(self, session):
+        self.session = session
+
+    # Незавершенная услуга получает end_date при закрытии
+    def add(self, user_id, service_name, price, type, status, end_date=None):
+        self.session.execute(self.INSERT, {'user_id': user_id,
+                                           'service_name': service_name,
+                                           'price': price,
+                                           'type': type,
+                                           'status': status,
+                                           'end_date': end_date})
+
+    # services: словари с ключами user_id, service_name, price, type, status, end_date
+    def insert_many(self, services):
+        self.session.execute(self.INSERT, list(services))
+
+    # Незавершенные дела пользователя: строки (service_id, service_name)
+    def active_for_user(self, user_id):
+        return self.session.execute(self.ACTIVE_FOR_USER, {'user_id': user_id}).fetchall()
+
+    def close(self, service_id, end_date):
+        self.session.execute(self.CLOSE, {'service_id': service_id, 'end_date': end_date})
@@ -0,0 +1,86 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Ключ обработчика в узле дерева префиксов
+HANDLER = None
+
+
+# Собирает разбор аргументов маршрута один раз при регистрации.
+# Последний аргумент получает весь остаток строки вместе с "_".
+def make_parser(converters):
+    count = len(converters)
+    if count == 0:
+        def parse(rest):
+            if rest is not None:
+                raise ValueError(f"Unexpected callback arguments: {rest!r}")
+            return ()
+    elif count == 1:
+        convert = converters[0]
+
+        def parse(rest):
+            if rest is None:
+                raise ValueError("Missing callback argument")
+            return convert(rest),
+    else:
+        def parse(rest):
+            values = rest.split('_', count - 1) if rest is not None else []
+            if len(values) != count:
+                raise ValueError(f"Expected {count} callback arguments, got {rest!r}")
+            return tuple([convert(value) for convert, value in zip(converters, values)])
+    return parse
+
+
+# Маршрутизатор callback-запросов. callback_data вида "action_arg1_arg2" разбирается
+# один раз: действие ищется в дереве префиксов по токенам (самое длинное совпадение,
+# так что "confirm_balance" не перехватывается "confirm"), аргументы приводятся к типам
+# из route() и передаются обработчику. wrap(action, handler), если задан, оборачивает
+# каждый обработчик при регистрации (например, замером времени).
+class CallbackRouter:
+    def __init__(self, wrap=None):
+        self._root = {}
+        self.wrap = wrap
+
+    def route(self, action, *converters):
+        def decorator(handler):
+            node = self._root
+            for token in action.split('_'):
+                node = node.setdefault(token, {})
+            if HANDLER in node:
+                raise ValueError(f"Callback action {action!r} is already routed")
+            wrapped = self.wrap(action, handler) if self.wrap is not None else handler
+            node[HANDLER] = (wrapped, make_parser(converters))
+            return handler
+        return decorator
+
+    # Возвращает (обработчик, аргументы) или None, если данные не подходят ни под один маршрут
+    def resolve(self, data):
+        node = self._root
+        match = None
+        rest = data
+        while rest is not None:
+            token, separator, tail = rest.partition('_')
+            rest = tail if separator else None
+            node = node.get(token)
+            if node is None:
+                break
+            route = node.get(HANDLER)
+            if route is not None:
+                match = route, rest
+        if match is None:
+            return None
+
+        (handler, parse), rest = match
+        try:
+            return handler, parse(rest)
+        except ValueError:
+            return None
+
+    def dispatch(self, call):
+        resolved = self.resolve(call.data)
+        if resolved is None:
+            logger.warning("Unroutable callback data", extra={'data': call.data})
+            return False
+        handler, args = resolved
+        handler(call, *args)
+        return True
@@ -0,0 +1,78 @@
+import sqlite3
+from datetime import datetime, timezone
+
+from sqlalchemy import create_engine, event
+
+from config import SQLITE_PRAGMAS
+
+
+# Время хранится текстом в UTC с микросекундами, поэтому строки сравниваются
+# в том же порядке, что и моменты времени (expires_at > now(), курсоры страниц)
+def format_timestamp(value):
+    return value.astimezone(timezone.utc).isoformat(sep=' ', timespec='microseconds')
+
+
+def parse_timestamp(value):
+    return datetime.fromisoformat(value.decode())
+
+
+def now():
+    return format_timestamp(datetime.now(timezone.utc))
+
+
+sqlite3.register_adapter(datetime, format_timestamp)
+sqlite3.register_converter('TIMESTAMPTZ', parse_timestamp)
+
+
+# "journal_mode=WAL,synchronous=NORMAL" -> [('journal_mode', 'WAL'), ('synchronous', 'NORMAL')]
+def parse_pragmas(value):
+    pragmas = []
+    for part in value.split(','):
+        if part.strip():
+            name, setting = part.split('=')
+            pragmas.append((name.strip(), setting.strip()))
+    return pragmas
+
+
+# Транзакция, которая начинается с SELECT, читает; остальные запросы пишут
+def is_read_statement(statement):
+    return statement.lstrip().upper().startswith('SELECT')
+
+
+# Движок SQLite для одного процесса бота. Транзакция открывается перед первым запросом, и ее
+# вид зависит от этого запроса. Пишущая транзакция открывается BEGIN IMMEDIATE: писатели из
+# потоков TeleBot выстраиваются в очередь на блокировке базы (ждут до busy_timeout) еще до
+# первого запроса, а не падают при попытке поднять блокировку чтения до записи. Читающая
+# транзакция открывается обычным BEGIN и не мешает писателям; если в ней затем появляется
+# запись, чтение завершается и транзакция начинается заново как BEGIN IMMEDIATE — так же,
+# как в Postgres при READ COMMITTED, запрос записи видит последнее зафиксированное состояние.
+# Движок с writer=False только читает: в режиме WAL его транзакции идут параллельно с записью.
+def create_sqlite_engine(url, writer=True, **kwargs):
+    engine = create_engine(url, connect_args={'detect_types': sqlite3.PARSE_DECLTYPES}, **kwargs)
+    pragmas = parse_pragmas(SQLITE_PRAGMAS)
+    if not writer:
+        pragmas.append(('query_only', 'ON'))
+
+    @event.listens_for(engine, 'connect')
+    def configure(dbapi_connection, connection_record):
+        # Транзакции начинает before_cursor_execute, а не драйвер
+        dbapi_connection.isolation_level = None
+        dbapi_connection.create_function('now', 0, now)
+        cursor = dbapi_connection.cursor()
+        for name, setting in pragmas:
+            cursor.execute(f'PRAGMA {name} = {setting}')
+        cursor.close()
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def begin(connection, cursor, statement, parameters, context, executemany):
+        write = writer and not is_read_statement(statement)
+        if not cursor.connection.in_transaction:
+            cursor.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+            connection.info['sqlite_write'] = write
+        elif write and not connection.info.get('sqlite_write'):
+            # В транзакции пока только чтение: фиксировать нечего
+            cursor.execute('COMMIT')
+            cursor.execute('BEGIN IMMEDIATE')
+            connection.info['sqlite_write'] = True
+
+    return engine
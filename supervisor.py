@@ -0,0 +1,58 @@
+import logging
+import multiprocessing
+import signal
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+# Держит processes копий target(index) в отдельных процессах и перезапускает завершившиеся.
+# Процессы создаются через fork до того, как родитель открыл соединения с базой и запустил
+# потоки, поэтому каждый копирует только импортированные модули. stop() посылает всем SIGTERM
+# и ждет, пока они завершатся сами.
+class Supervisor:
+    def __init__(self, target, processes, restart_delay=1, stop_timeout=30):
+        self.target = target
+        self.processes = processes
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+        self.context = multiprocessing.get_context('fork')
+        self.workers = [None] * processes
+        self._stopped = threading.Event()
+
+    def _main(self, index):
+        # Обработчик SIGTERM родителя остановил бы из дочернего процесса соседние
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.target(index)
+
+    def _spawn(self, index):
+        process = self.context.Process(target=self._main, args=(index,), name=f'bot-{index}')
+        process.start()
+        self.workers[index] = process
+
+    def start(self):
+        for index in range(self.processes):
+            self._spawn(index)
+
+    # Следит за процессами, пока не вызван stop()
+    def run(self):
+        while not self._stopped.wait(self.restart_delay):
+            for index, process in enumerate(self.workers):
+                if not process.is_alive() and not self._stopped.is_set():
+                    logger.warning("Bot process exited, restarting",
+                                   extra={'process': index, 'exitcode': process.exitcode})
+                    self._spawn(index)
+
+    def stop(self):
+        self._stopped.set()
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.workers:
+            if process is None:
+                continue
+            process.join(self.stop_timeout)
+            if process.is_alive():
+                logger.warning("Bot process did not stop in time, killing it", extra={'pid': process.pid})
+                process.kill()
+                process.join()
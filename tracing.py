@@ -0,0 +1,172 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import signal
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime
+
+from config import PROFILE_DIR, TRACE_FILE, TRACE_MAX_SPANS, TRACE_SLOW_MS
+
+logger = logging.getLogger(__name__)
+
+# Трасса апдейта, который обрабатывается в текущем потоке или задаче asyncio
+current_trace = ContextVar('current_trace', default=None)
+
+
+# Трасса одного апдейта: внешний обработчик и вложенные в него отрезки — обработчики
+# callback и шагов диалога, SQL-запросы, вызовы Bot API — с временем от начала апдейта
+class Trace:
+    def __init__(self, kind, handler, attrs):
+        self.kind = kind
+        self.handler = handler
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.time = datetime.now().astimezone()
+        self.spans = []
+        self.dropped = 0
+
+    def add(self, kind, name, started, duration, attrs):
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped += 1
+            return
+        span = {'kind': kind, 'name': name, 'start_ms': round((started - self.started) * 1000, 3),
+                'ms': round(duration * 1000, 3)}
+        span.update(attrs)
+        self.spans.append(span)
+
+    def to_json(self, duration, failed):
+        return {'time': self.time.isoformat(), 'kind': self.kind, 'handler': self.handler, **self.attrs,
+                'ms': round(duration * 1000, 3), 'error': failed, 'spans': self.spans, 'dropped_spans': self.dropped}
+
+
+# Чат, пользователь и команда или данные кнопки из первого аргумента обработчика
+def event_attrs(event):
+    attrs = {}
+    user = getattr(event, 'from_user', None)
+    if user is not None:
+        attrs['user_id'] = user.id
+    message = getattr(event, 'message', event)
+    chat = getattr(message, 'chat', None)
+    if chat is not None:
+        attrs['chat_id'] = chat.id
+    data = getattr(event, 'data', None)
+    if isinstance(data, str):
+        attrs['data'] = data
+    text = getattr(event, 'text', None)
+    if isinstance(text, str) and text.startswith('/'):
+        attrs['command'] = text.split(None, 1)[0]
+    return attrs
+
+
+# Добавляет отрезок в трассу текущего апдейта; вне апдейта ничего не делает
+def record(kind, name, started, duration, **attrs):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(kind, name, started, duration, attrs)
+
+
+# Медленные апдейты (не быстрее TRACE_SLOW_MS) дописываются в TRACE_FILE строкой JSON
+class SlowUpdateLog:
+    def __init__(self, path, slow_ms):
+        self.path = path
+        self.slow = slow_ms / 1000
+        self._lock = threading.Lock()
+
+    def write(self, trace, duration, failed):
+        if not self.path or duration < self.slow:
+            return
+        line = json.dumps(trace.to_json(duration, failed), ensure_ascii=False, default=str)
+        try:
+            with self._lock, open(self.path, 'a', encoding='utf-8') as file:
+                file.write(line + '\n')
+        except OSError:
+            logger.exception("Failed to write slow update trace", extra={'path': self.path})
+
+
+# Профилирование cProfile следующих N апдейтов (включается arm(), например по SIGUSR1).
+# Одновременно профилируется один апдейт: остальные в это время идут без профиля и не
+# засчитываются. После N апдейтов статистика сохраняется в PROFILE_DIR и кратко пишется в лог.
+class Profiler:
+    def __init__(self, directory):
+        self.directory = directory
+        self.remaining = 0
+        self.stats = None
+        self._lock = threading.Lock()
+        self._busy = threading.Lock()
+
+    def arm(self, updates):
+        with self._lock:
+            self.remaining = updates
+            self.stats = None
+        logger.warning("Profiling armed", extra={'updates': updates})
+
+    def start(self):
+        if not self.remaining or not self._busy.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Уже работает другой профилировщик
+            self._busy.release()
+            return None
+        return profile
+
+    def stop(self, profile):
+        profile.disable()
+        self._busy.release()
+        with self._lock:
+            if self.remaining <= 0:
+                return
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.remaining -= 1
+            if self.remaining:
+                return
+            stats, self.stats = self.stats, None
+        self.dump(stats)
+
+    def dump(self, stats):
+        path = os.path.join(self.directory, f"profile-{datetime.now():%Y%m%d-%H%M%S}.pstats")
+        stats.dump_stats(path)
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats('cumulative').print_stats(20)
+        logger.warning("Profile saved", extra={'path': path, 'top': summary.getvalue()})
+
+
+slow_updates = SlowUpdateLog(TRACE_FILE, TRACE_SLOW_MS)
+profiler = Profiler(PROFILE_DIR)
+
+
+# Начало обработчика: если апдейт еще не трассируется, этот обработчик — корень трассы.
+# Возвращает то, что нужно передать в end()
+def begin(kind, handler, args, profile=False):
+    if current_trace.get() is not None:
+        return None
+    trace = Trace(kind, handler, event_attrs(args[0]) if args else {})
+    token = current_trace.set(trace)
+    return trace, token, profiler.start() if profile else None
+
+
+def end(root, kind, handler, started, duration, failed):
+    if root is None:
+        record('handler', handler, started, duration, handler_kind=kind, error=failed)
+        return
+    trace, token, profile = root
+    current_trace.reset(token)
+    if profile is not None:
+        profiler.stop(profile)
+    slow_updates.write(trace, duration, failed)
+
+
+# kill -USR1 <pid> включает профилирование следующих updates апдейтов
+def install_profile_signal(updates):
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.arm(updates))
@@ -0,0 +1,184 @@
+import hmac
+import json
+import logging
+import queue
+import secrets
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot.types import Update
+
+from config import *
+from bot import bot, create_app, loan_lease
+from dispatcher import ShardedTeleBot
+from logs import setup_logging
+from metrics import start_server
+from supervisor import Supervisor
+from tracing import install_profile_signal
+
+logger = logging.getLogger(__name__)
+
+# Самый большой апдейт, который примет вебхук (байты)
+MAX_BODY = 1024 * 1024
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+# Очередь соединений ядра по умолчанию (5) при всплеске запросов сбрасывает соединения.
+# С reuse_port несколько процессов слушают один порт, и ядро распределяет между ними соединения.
+class WebhookHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, handler, reuse_port=False):
+        self.allow_reuse_port = reuse_port
+        super().__init__(address, handler)
+
+
+# Прием апдейтов через вебхук (BOT_MODE=webhook) вместо infinity_polling.
+# HTTP-сервер проверяет секрет, разбирает Update и кладет его в ограниченную очередь,
+# которую разбирают workers потоков. Если очередь полна, Telegram получает 503
+# и повторит доставку позже — так нагрузка не копится в памяти бота.
+class WebhookServer:
+    def __init__(self, process, secret, host='0.0.0.0', port=8080, queue_size=1000, workers=8, reuse_port=False):
+        self.process = process
+        self.secret = secret.encode()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.workers = workers
+        self._threads = []
+        self.server = WebhookHTTPServer((host, port), self._make_handler(), reuse_port)
+
+    def _make_handler(self):
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                except ValueError:
+                    length = -1
+                if 0 <= length <= MAX_BODY:
+                    status = webhook.receive(self.headers.get(SECRET_HEADER, ''), self.rfile.read(length))
+                else:
+                    # Тело не читаем, поэтому соединение дальше использовать нельзя
+                    status = 413 if length > MAX_BODY else 400
+                    self.close_connection = True
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug("Webhook: " + format, *args)
+
+        return Handler
+
+    # Возвращает HTTP-код ответа Telegram
+    def receive(self, secret, body):
+        if not hmac.compare_digest(secret.encode(), self.secret):
+            return 403
+        try:
+            update = Update.de_json(json.loads(body))
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Webhook received a malformed update")
+            return 400
+        if update is None:
+            return 400
+        try:
+            self.queue.put_nowait(update)
+        except queue.Full:
+            logger.warning("Webhook queue is full, rejecting update", extra={'update_id': update.update_id})
+            return 503
+        return 200
+
+    def _work(self):
+        while True:
+            update = self.queue.get()
+            if update is None:
+                return
+            try:
+                self.process(update)
+            except Exception:
+                logger.exception("Failed to process update", extra={'update_id': update.update_id})
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._work, name=f'webhook-worker-{i}', daemon=True)
+                         for i in range(self.workers)]
+        self._threads.append(threading.Thread(target=self.server.serve_forever, name='webhook-server', daemon=True))
+        for thread in self._threads:
+            thread.start()
+        logger.info("Webhook listening", extra={'address': self.server.server_address})
+
+    # Перестает принимать апдейты и дожидается обработки уже принятых
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for _ in range(self.workers):
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def register_webhook(secret):
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=secret, max_connections=WEBHOOK_WORKERS * BOT_PROCESSES)
+
+
+# Один процесс бота: прием апдейтов, их обработка и, если досталась аренда, начисление процентов.
+# При BOT_PROCESSES > 1 это процесс номер index; его метрики — на порту METRICS_PORT + index
+def serve(secret, index=0, register=False):
+    create_app()
+    if isinstance(bot, ShardedTeleBot):
+        # Апдейты выполняет диспетчер; один поток вебхука передает их ему в порядке
+        # поступления, а при заполнении очередей диспетчера ждет, и вебхук отвечает 503
+        workers = 1
+    else:
+        # Обработчики выполняются прямо в потоках вебхука: тогда очередь — единственный буфер
+        # апдейтов и ее размер действительно ограничивает отставание
+        bot.threaded = False
+        workers = WEBHOOK_WORKERS
+    server = WebhookServer(lambda update: bot.process_new_updates([update]), secret,
+                           WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_QUEUE_SIZE, workers, reuse_port=BOT_PROCESSES > 1)
+    if register:
+        register_webhook(secret)
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    start_server(METRICS_HOST, METRICS_PORT + index if METRICS_PORT else 0)
+    install_profile_signal(PROFILE_UPDATES)
+    loan_lease.start()
+    server.start()
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        bot.stop_bot()
+        loan_lease.stop()
+
+
+def main():
+    # Случайный секрет общий для всех процессов, поэтому создается до их запуска
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    supervisor = None
+    if BOT_PROCESSES > 1:
+        supervisor = Supervisor(lambda index: serve(secret, index), BOT_PROCESSES)
+        supervisor.start()
+    # Логирование родителя настраивается после fork: поток записи не копируется в дочерние процессы
+    setup_logging()
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET is not set, using a random secret for this run")
+    if supervisor is None:
+        serve(secret, register=True)
+        return
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stop())
+    register_webhook(secret)
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        supervisor.stop()
+
+
+if __name__ == '__main__':
+    main()